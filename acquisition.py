@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+
+"""This is a Python module to run image acquisition without a GUI.
+
+The acquisition engine takes exposure stacks, exposure/dark series and
+voltage scans, finalizing FITs headers in the background while the next
+image is acquired.  Progress is reported through optional callbacks, so
+the same engine drives the GUI and the command line runner.
+"""
+
+import os
+import subprocess
+import logging
+import sqlite3
+import time
+
+import exposure
+import voltage
+import pipeline
+import scanplan
+import settle
+import catalog
+import quicklook
+import stacking
+import ptc
+import fe55
+import scansurface
+
+###############################################################################
+##
+##  Acquisition Engine
+##
+###############################################################################
+
+def series_exptimes(mintime, maxtime, timestep):
+    """Exposure times of a series from mintime to maxtime inclusive."""
+
+    if mintime > maxtime:
+        raise ValueError("Minimum time must be less than Maximum time.")
+    elif timestep <= 0.0:
+        raise ValueError("Time step must be greater than 0.")
+
+    exptime = mintime
+    exptimes = []
+    while exptime <= maxtime:
+        exptimes.append(exptime)
+        exptime += timestep
+
+    return exptimes
+
+class AcquisitionEngine(object):
+    """Takes sequences of images with pipelined FITs header updates.
+
+    Callbacks, all optional, are called from the acquiring thread:
+    on_start(num_images) when a sequence starts, on_taken() after each
+    image is read out, on_finalized(frame) after its header is updated and
+    on_seqnum(seqnum) when a sequence number is used.  Voltage scans set
+    rails with set_voltages(voltage_dict), which returns False on failure;
+    by default the persistent voltage session is used, with voltages giving
+    the rail values known before the scan, so clock pairs changed by half
+    keep their other rail.  Quick-look
+    statistics are computed for each image if use_quicklook, and finalized
+    images are recorded in the catalog of their data directory if
+    use_catalog.
+    """
+
+    def __init__(self, pipeline_depth=2, scan_order="weighted", set_voltages=None,
+                 on_start=None, on_taken=None, on_finalized=None, on_seqnum=None,
+                 use_catalog=True, use_quicklook=True, voltages=None):
+
+        self.pipeline_depth = pipeline_depth
+        self.scan_order = scan_order
+        self.use_catalog = use_catalog
+        self.use_quicklook = use_quicklook
+        self.set_voltages = set_voltages or self.apply_voltages
+        self.voltages = dict(voltages or {})
+
+        self.on_start = on_start
+        self.on_taken = on_taken
+        self.on_finalized = on_finalized
+        self.on_seqnum = on_seqnum
+
+        self.pipeline = None
+        self.cancelled = False
+        self.logger = logging.getLogger("sLogger")
+
+    def cancel(self):
+        """Finish the current image and stop the sequence."""
+
+        self.cancelled = True
+
+    def _notify(self, callback, *args):
+
+        if callback is not None:
+            callback(*args)
+
+    def _finalized(self, frame):
+
+        self._notify(self.on_finalized, frame)
+
+    def _run(self, acquire, data_dir, stages=()):
+        """Run an acquisition loop with a frame pipeline around it."""
+
+        self.cancelled = False
+        self.pipeline = pipeline.FramePipeline(depth=self.pipeline_depth,
+                                               on_finalized=self._finalized)
+        if self.use_quicklook:
+            self.pipeline.add_stage(quicklook.quicklook_stage)
+        for stage in stages:
+            self.pipeline.add_stage(stage)
+
+        ## Catalog images last, after every other stage is timed
+        frames = None
+        if self.use_catalog:
+            try:
+                frames = catalog.Catalog(data_dir)
+            except sqlite3.Error:
+                self.logger.exception("Unable to open image catalog in {0}.".format(data_dir))
+            else:
+                self.pipeline.add_stage(frames.catalog_stage)
+        self.pipeline.start()
+
+        try:
+            return acquire()
+        finally:
+            self.pipeline.close()
+            if frames is not None:
+                frames.close()
+            self.logger.info("{0} of {1} images finalized.".\
+                             format(self.pipeline.finalized, self.pipeline.acquired))
+
+    def take_image(self, mode, filename, exptime, seq_num, data_dir, **kwargs):
+        """Acquire one image and queue its header update.
+
+        Returns the filepath, or None if the image was not taken.
+        """
+
+        start = time.time()
+        try:
+            filepath = exposure.im_acq(mode, filename, exptime, seq_num,
+                                       data_dir, **kwargs)
+        except subprocess.CalledProcessError:
+            self.logger.exception("Error in executable {0}_acq. Image not taken.".\
+                                  format(mode))
+            return None
+        except OSError:
+            self.logger.exception("Executable {0}_acq not found. Image not taken.".\
+                                  format(mode))
+            return None
+        except Exception as e:
+            self.logger.exception("{0}".format(e))
+            return None
+
+        self.logger.info("Exposure finished successfully.")
+        self._notify(self.on_taken)
+
+        ## Queue FITs header corrections
+        frame = pipeline.Frame(filepath, mode, exptime, seq_num, **kwargs)
+        frame.filebase = filename
+        frame.acquired = start
+        frame.timings["im_acq"] = time.time() - start
+        self.pipeline.submit(frame)
+
+        return filepath
+
+    def stack(self, mode, filename, exptime, num_images, seq_num, data_dir, combine=None,
+              **kwargs):
+        """Take a stack of images with consecutive sequence numbers.
+
+        Fe55 images are analysed for gain and CTE as they are finalized.  If
+        combine is a stacking method, the stack is combined into a master
+        frame once its last image is finalized.  Returns True if every image
+        was taken.
+        """
+
+        if mode == 'bias':
+            exptime = 0.0
+
+        stages = []
+        if mode == 'fe55':
+            stages.append(fe55.fe55_stage)
+
+        ## Test images overwrite each other, so only named stacks are combined
+        if combine is not None and num_images > 1 and not kwargs.get('is_test', False):
+            stages.append(stacking.StackStage(num_images, combine))
+
+        def acquire():
+
+            self._notify(self.on_start, num_images)
+
+            for i in range(seq_num, seq_num+num_images):
+
+                ## Check if stack interrupted
+                if self.cancelled:
+                    self.logger.info("Exposure canceled.")
+                    return False
+
+                self.logger.info("Starting image {0} of {1}.".\
+                                 format(i+1-seq_num, num_images))
+                if self.take_image(mode, filename, exptime, i, data_dir, **kwargs) is None:
+                    return False
+                self._notify(self.on_seqnum, i)
+
+            self.logger.info("All exposures finished successfully.")
+            return True
+
+        return self._run(acquire, data_dir, stages)
+
+    def series(self, mode, filename, exptimes, seq_num, data_dir, pairs=False, **kwargs):
+        """Take one image at each exposure time, sharing a sequence number.
+
+        With pairs, two images are taken at each exposure time, the second
+        with the next sequence number.  The photon transfer curve of an
+        exposure series is updated as images are finalized.  Returns True
+        if every image was taken.
+        """
+
+        seq_nums = [seq_num, seq_num+1] if pairs else [seq_num]
+        num_images = len(exptimes)*len(seq_nums)
+
+        ## Test images overwrite each other, so only named series are analyzed
+        stages = []
+        if mode == "exp" and not kwargs.get('is_test', False):
+            stages.append(ptc.PTCStage(num_images))
+
+        def acquire():
+
+            self._notify(self.on_start, num_images)
+
+            for exptime in exptimes:
+                for pair_num in seq_nums:
+
+                    ## Check if series interrupted
+                    if self.cancelled:
+                        self.logger.info("Exposure series canceled.")
+                        return False
+
+                    self.logger.info("Starting {0}s image.".format(exptime))
+                    if self.take_image(mode, filename, exptime, pair_num, data_dir,
+                                       **kwargs) is None:
+                        return False
+
+            self._notify(self.on_seqnum, seq_nums[-1])
+            self.logger.info("All exposures finished successfully.")
+            return True
+
+        return self._run(acquire, data_dir, stages)
+
+    def scan(self, paramfile, filename, exptime, seq_num, data_dir, resume=False,
+             start_voltages=None, **kwargs):
+        """Take one image at each point of a voltage scan parameter file.
+
+        Completed points are journaled next to the images, and with resume
+        an interrupted scan skips points already taken.  The response
+        surface of the scan is updated as points are finalized.  Returns
+        True if every point was taken.
+        """
+
+        plan = scanplan.ScanPlan.from_file(paramfile, order=self.scan_order)
+        vnames = plan.vnames
+        num_images = len(plan)
+        self.logger.info(plan.summary(start_voltages))
+
+        ## Journal completed points so an interrupted scan can be resumed
+        journalpath = os.path.join(data_dir, "{0}.scan.journal".format(filename))
+        journal = scanplan.ScanJournal(journalpath, plan)
+
+        if resume:
+            try:
+                num_done = journal.resume()
+            except ValueError:
+                self.logger.exception("Unable to resume scan. Scan not started.")
+                return False
+            self.logger.info("Resuming scan, {0} of {1} points already completed.".\
+                             format(num_done, num_images))
+        else:
+            journal.start()
+
+        def acquire():
+
+            self._notify(self.on_start, num_images)
+
+            for i, vpoint in enumerate(plan):
+
+                if self.cancelled:
+                    self.logger.info("Exposure canceled.")
+                    return False
+
+                ## Skip points completed before the scan was interrupted
+                if journal.is_done(vpoint):
+                    self._notify(self.on_taken)
+                    self._notify(self.on_finalized, None)
+                    continue
+
+                new_voltage_dict = dict(zip(vnames, vpoint))
+                if self.set_voltages(new_voltage_dict) is False:
+                    return False
+                settle.wait()
+                kwargs.update(new_voltage_dict)
+
+                self.logger.info("Starting exposure {0} of {1}.".format(i+1, num_images))
+                if self.take_image("scan", filename, exptime, seq_num+i, data_dir,
+                                   **kwargs) is None:
+                    return False
+
+            self.logger.info("All exposures finished successfully.")
+            return True
+
+        ## Response surface of the scan, kept with the journal
+        surfacepath = os.path.join(data_dir, "{0}.scan.npz".format(filename))
+        surface = scansurface.SurfaceStage(plan, surfacepath, resume)
+
+        return self._run(acquire, data_dir, [journal.record, surface])
+
+    def apply_voltages(self, new_voltage_dict):
+        """Set rails with the persistent voltage session, logging failures.
+
+        Rails not being changed are taken from the session state, or else
+        from the known voltages.
+        """
+
+        try:
+            results = voltage.open_session().apply(new_voltage_dict, self.voltages)
+        except subprocess.CalledProcessError as e:
+            self.logger.exception("Error in executable {0}. Voltage not changed.".\
+                                  format(e.cmd[0]))
+            return False
+        except OSError as e:
+            self.logger.exception("{0} Voltage not changed.".format(e.strerror))
+            return False
+        except KeyError:
+            self.logger.exception("Unknown voltage name. Voltages not changed.")
+            return False
+
+        changed = []
+        for vnames, output in results:
+            self.logger.debug(output)
+            changed.extend("{0}={1}".format(vname, new_voltage_dict[vname])
+                           for vname in vnames)
+        if changed:
+            self.logger.info("Voltages set: {0}".format(", ".join(changed)))
+        self.voltages.update(new_voltage_dict)
+
+        return True
@@ -0,0 +1,564 @@
+#!/usr/bin/env python
+
+"""This is a Python module to select how controller commands are carried out.
+
+By default commands run the STA3800 controller executables.  A simulated
+controller can be selected instead, which writes realistic FITs images and
+models command latency, for benchmarking and testing without hardware.
+"""
+
+import abc
+import subprocess
+import errno
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+## Import astropy.io.fits or pyfits
+try:
+    from astropy.io import fits
+except ImportError:
+    import pyfits as fits
+
+## For Python 2.6 need to monkey patch check_output()
+if "check_output" not in dir( subprocess ):
+    def f(*popenargs, **kwargs):
+        if 'stdout' in kwargs:
+            raise ValueError('stdout argument not allowed, it will be overridden.')
+        process = subprocess.Popen(stdout=subprocess.PIPE, *popenargs, **kwargs)
+        output, unused_err = process.communicate()
+        retcode = process.poll()
+        if retcode:
+            cmd = kwargs.get("args")
+            if cmd is None:
+                cmd = popenargs[0]
+            error = subprocess.CalledProcessError(retcode,cmd)
+            error.output = output
+            raise error
+        return output
+    subprocess.check_output = f
+
+###############################################################################
+##
+##  Controller Backends
+##
+###############################################################################
+
+class Backend(object):
+    """Carries out controller commands given as executable argument lists.
+
+    Backends must provide run() and open_relay(); an incomplete backend
+    cannot be created.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    simulated = False
+
+    @abc.abstractmethod
+    def run(self, args):
+        """Run a command and return its output."""
+
+    def sleep(self, seconds):
+        """Wait for the controller, e.g. for voltages to settle."""
+
+        time.sleep(seconds)
+
+    def run_batch(self, commands):
+        """Run commands in order, stopping at the first failure.
+
+        The outputs of commands that succeeded are stored in the completed
+        attribute of the raised error.
+        """
+
+        completed = []
+        for args in commands:
+            try:
+                completed.append(self.run(args))
+            except (subprocess.CalledProcessError, OSError) as e:
+                e.completed = completed
+                raise
+
+        return completed
+
+    @abc.abstractmethod
+    def open_relay(self):
+        """Return an unattached back bias relay device."""
+
+class ShellBackend(Backend):
+    """Run the controller executables installed on the DAQ host."""
+
+    def run(self, args):
+
+        return subprocess.check_output(args)
+
+    def open_relay(self):
+
+        from Phidgets.Devices.InterfaceKit import InterfaceKit
+        return InterfaceKit()
+
+_backend = ShellBackend()
+
+def get_backend():
+    """Return the active controller backend."""
+
+    return _backend
+
+def set_backend(new_backend):
+    """Select the controller backend used for all commands."""
+
+    global _backend
+    close_relay()
+    _backend = new_backend
+
+def run(args):
+    """Run a controller command with the active backend."""
+
+    return _backend.run(args)
+
+###############################################################################
+##
+##  Back Bias Relay Connection
+##
+###############################################################################
+
+## Time to wait for the relay to attach, in milliseconds
+RELAY_ATTACH_TIMEOUT = 10000
+
+class RelayConnection(object):
+    """Reused connection to the back bias relay.
+
+    The device is opened and attached on first use and then kept open.  Its
+    attachment is checked before every command, and a device that was lost
+    is reopened once before giving up.
+    """
+
+    def __init__(self, open_device, timeout=RELAY_ATTACH_TIMEOUT):
+
+        self.open_device = open_device
+        self.timeout = timeout
+        self.device = None
+        self.attach_count = 0
+        self.lock = threading.Lock()
+
+    def is_healthy(self):
+        """Check the device is open and still attached."""
+
+        if self.device is None:
+            return False
+
+        try:
+            return self.device.isAttached()
+        except Exception:
+            return False
+
+    def connect(self):
+        """Return the attached device, attaching it if needed."""
+
+        if self.is_healthy():
+            return self.device
+
+        self.disconnect()
+        device = self.open_device()
+        device.openPhidget()
+
+        ## Phidgets raise on an attach timeout, stand-ins may not
+        try:
+            device.waitForAttach(self.timeout)
+        except Exception:
+            pass
+
+        if not device.isAttached():
+            try:
+                device.closePhidget()
+            except Exception:
+                pass
+            raise IOError("Unable to attach to the back bias relay.")
+
+        self.device = device
+        self.attach_count += 1
+
+        return device
+
+    def disconnect(self):
+        """Close the device, if open."""
+
+        if self.device is not None:
+            try:
+                self.device.closePhidget()
+            except Exception:
+                pass
+            self.device = None
+
+    def _call(self, method, *args):
+        """Call a device method, reconnecting once if the device was lost."""
+
+        with self.lock:
+            device = self.connect()
+            try:
+                return getattr(device, method)(*args)
+            except Exception:
+                self.disconnect()
+            return getattr(self.connect(), method)(*args)
+
+    def set_output(self, index, state):
+        """Set a relay output on or off."""
+
+        self._call("setOutputState", index, state)
+
+    def get_output(self, index):
+        """Return the state of a relay output."""
+
+        return self._call("getOutputState", index)
+
+    def close(self):
+
+        with self.lock:
+            self.disconnect()
+
+_relay = None
+
+def get_relay():
+    """Return the shared back bias relay connection of the active backend."""
+
+    global _relay
+
+    if _relay is None:
+        _relay = RelayConnection(_backend.open_relay)
+
+    return _relay
+
+def close_relay():
+    """Close the shared back bias relay connection, if open."""
+
+    global _relay
+
+    if _relay is not None:
+        _relay.close()
+        _relay = None
+
+###############################################################################
+##
+##  Simulated STA3800 Controller
+##
+###############################################################################
+
+## Segment geometry, in pixels
+PRESCAN = 10
+NCOLS = 512
+OVERSCAN = 20
+NROWS = 2002
+NSEGMENTS = 16
+
+## Blank cards reserved in the primary header for later keywords
+RESERVED_CARDS = 36
+
+## Fe55 X-ray deposits in electrons (K-alpha, K-beta) and relative rates
+FE55_ELECTRONS = (1620.0, 1778.0)
+FE55_FRACTIONS = (0.88, 0.12)
+
+## Command latency in seconds, before scaling
+LATENCY = {"exp_acq" : 4.0,
+           "dark_acq" : 4.0,
+           "sta3800_setup" : 8.0,
+           "sta3800_off" : 4.0,
+           "16ch_setup" : 0.5,
+           "sta3800_channels" : 0.5,
+           "sigload" : 0.5,
+           "patload" : 0.5,
+           "par_speed" : 0.1,
+           "gain" : 0.1,
+           "offset" : 0.1}
+VOLTAGE_LATENCY = 0.05
+RELAY_ATTACH_LATENCY = 1.0
+
+## Start-up voltages applied by sta3800_setup
+DEFAULT_VOLTAGES = {"VDD" : 19.0,
+                    "VOD" : 25.0,
+                    "VOG" : 0.0,
+                    "VRD" : 13.0,
+                    "RGHI" : 8.0,
+                    "RGLO" : -2.0,
+                    "PARHI" : 4.0,
+                    "PARLO" : -8.0,
+                    "SERHI" : 6.0,
+                    "SERLO" : -4.0}
+
+class SimRelay(object):
+    """Stand-in for the Phidget InterfaceKit switching the back bias.
+
+    Without a simulated controller the relay keeps its own outputs and
+    attaches without delay.  Calling detach simulates unplugging it.
+    """
+
+    def __init__(self, controller=None):
+
+        self.controller = controller
+        self.attached = False
+        self.opened = False
+
+        if controller is None:
+            self.outputs = {}
+        else:
+            self.outputs = controller.relay_outputs
+
+    def openPhidget(self):
+        self.opened = True
+
+    def waitForAttach(self, timeout):
+        if self.controller is not None:
+            self.controller.sleep(RELAY_ATTACH_LATENCY)
+        self.attached = self.opened
+
+    def isAttached(self):
+        return self.attached
+
+    def detach(self):
+        self.attached = False
+
+    def setOutputState(self, index, state):
+        if not self.attached:
+            raise IOError("Relay is not attached.")
+        self.outputs[index] = bool(state)
+
+    def getOutputState(self, index):
+        if not self.attached:
+            raise IOError("Relay is not attached.")
+        return self.outputs.get(index, False)
+
+    def closePhidget(self):
+        self.attached = False
+        self.opened = False
+
+class SimBackend(Backend):
+    """Simulated STA3800 controller.
+
+    Images are 16 segment FITs files with prescan and overscan columns.  The
+    bias level follows VOD and VRD, and pixels include read noise, dark
+    current, illumination for exp/flat images and X-ray hits for Fe55
+    images.  Command latency is multiplied by time_scale (0 disables it).
+    """
+
+    simulated = True
+
+    def __init__(self, time_scale=1.0, seed=None, gain=1.5, read_noise=6.0,
+                 dark_current=0.02, flux=1000.0, fe55_rate=2.0e-4):
+
+        self.time_scale = time_scale
+        self.random = np.random.RandomState(seed)
+        self.lock = threading.Lock()
+
+        ## Detector model, gain in e-/ADU, noise in e-, rates in e-/pixel/s
+        self.gain = gain
+        self.read_noise = read_noise
+        self.dark_current = dark_current
+        self.flux = flux
+        self.fe55_rate = fe55_rate
+
+        ## Per segment bias offsets and gain variations, in ADU and fraction
+        self.bias_offsets = 1000.0 + 50.0*self.random.randn(NSEGMENTS)
+        self.gain_scatter = 1.0 + 0.02*self.random.randn(NSEGMENTS)
+
+        self.powered = False
+        self.voltages = dict((vname, 0.0) for vname in DEFAULT_VOLTAGES)
+        self.offsets = {}
+        self.relay_outputs = {}
+        self.commands = []
+
+    def sleep(self, seconds):
+        """Wait for a simulated latency."""
+
+        if self.time_scale > 0:
+            time.sleep(seconds*self.time_scale)
+
+    def open_relay(self):
+
+        return SimRelay(self)
+
+    def run(self, args):
+
+        if isinstance(args, basestring):
+            args = [args]
+        args = [str(arg) for arg in args]
+        name = args[0]
+
+        with self.lock:
+            self.commands.append(args)
+
+        handler = getattr(self, "_cmd_" + name.replace("16ch", "ch16"), None)
+        if handler is None:
+            raise OSError(errno.ENOENT, "No such file or directory: {0}".format(name))
+
+        return handler(args)
+
+    def _fail(self, args, message):
+
+        error = subprocess.CalledProcessError(1, args)
+        error.output = message + "\n"
+        raise error
+
+    ## Power and configuration commands
+    def _cmd_sta3800_setup(self, args):
+
+        self.sleep(LATENCY["sta3800_setup"])
+        self.powered = True
+        self.voltages.update(DEFAULT_VOLTAGES)
+        return "STA3800 controller set up.\n"
+
+    def _cmd_sta3800_off(self, args):
+
+        self.sleep(LATENCY["sta3800_off"])
+        self.powered = False
+        for vname in self.voltages:
+            self.voltages[vname] = 0.0
+        return "STA3800 controller off.\n"
+
+    def _cmd_ch16_setup(self, args):
+
+        self.sleep(LATENCY["16ch_setup"])
+        self.powered = True
+        return "16 channel readout set up.\n"
+
+    def _cmd_sta3800_channels(self, args):
+
+        self.sleep(LATENCY["sta3800_channels"])
+        return "STA3800 channels set.\n"
+
+    def _cmd_sigload(self, args):
+
+        self.sleep(LATENCY["sigload"])
+        return "Loaded signal file {0}.\n".format(args[1])
+
+    def _cmd_patload(self, args):
+
+        self.sleep(LATENCY["patload"])
+        return "Loaded pattern file {0}.\n".format(args[1])
+
+    def _cmd_par_speed(self, args):
+
+        self.sleep(LATENCY["par_speed"])
+        return "Parallel speed {0}.\n".format(args[1])
+
+    def _cmd_gain(self, args):
+
+        self.sleep(LATENCY["gain"])
+        return "Gain {0}.\n".format(args[1])
+
+    def _cmd_offset(self, args):
+
+        self.sleep(LATENCY["offset"])
+        self.offsets[int(args[1])] = int(args[2])
+        return "Channel {0} offset {1}.\n".format(args[1], args[2])
+
+    ## Voltage commands
+    def _set_voltages(self, args, voltage_dict):
+
+        self.sleep(VOLTAGE_LATENCY)
+        if not self.powered:
+            self._fail(args, "Controller is not powered.")
+        for vname, value in voltage_dict.items():
+            self.voltages[vname] = float(value)
+        return " ".join(args) + "\n"
+
+    def _cmd_vdd(self, args):
+        return self._set_voltages(args, {"VDD" : args[1]})
+
+    def _cmd_vod(self, args):
+        return self._set_voltages(args, {"VOD" : args[1]})
+
+    def _cmd_vog(self, args):
+        return self._set_voltages(args, {"VOG" : args[1]})
+
+    def _cmd_vrd(self, args):
+        return self._set_voltages(args, {"VRD" : args[1]})
+
+    def _cmd_rg(self, args):
+        return self._set_voltages(args, {"RGLO" : args[1], "RGHI" : args[2]})
+
+    def _cmd_par_clks(self, args):
+        return self._set_voltages(args, {"PARLO" : args[1], "PARHI" : args[2]})
+
+    def _cmd_ser_clks(self, args):
+        return self._set_voltages(args, {"SERLO" : args[1], "SERHI" : args[2]})
+
+    def _cmd_v_clk(self, args):
+        return self._set_voltages(args, {})
+
+    ## Image acquisition commands
+    def _cmd_exp_acq(self, args):
+        return self._acquire(args, illuminated=True)
+
+    def _cmd_dark_acq(self, args):
+        return self._acquire(args, illuminated=False)
+
+    def _acquire(self, args, illuminated):
+
+        exptime = float(args[1])
+        filepath = args[2]
+
+        if not self.powered:
+            self._fail(args, "Controller is not powered.")
+
+        self.sleep(LATENCY[args[0]] + exptime)
+
+        ## The controller is not told the image mode, so the Fe55 source is
+        ## taken to be in place for images named as Fe55 images
+        fe55 = ".fe55." in filepath
+        self.write_image(filepath, exptime, illuminated, fe55)
+
+        return "Image written to {0}.\n".format(filepath)
+
+    def segment(self, seg, exptime, illuminated, fe55):
+        """Simulate the pixels of one segment, including prescan and overscan."""
+
+        shape = (NROWS, PRESCAN + NCOLS + OVERSCAN)
+        gain = self.gain*self.gain_scatter[seg]
+
+        ## Bias level responds to output and reset drain voltages
+        bias = (self.bias_offsets[seg]
+                + 4.0*(self.voltages["VOD"] - DEFAULT_VOLTAGES["VOD"])
+                + 2.5*(self.voltages["VRD"] - DEFAULT_VOLTAGES["VRD"]))
+
+        ## Signal in electrons for the imaging columns
+        electrons = np.zeros((NROWS, NCOLS))
+        mean = self.dark_current*exptime
+        if illuminated:
+            mean += self.flux*exptime
+        if mean > 0:
+            electrons += self.random.poisson(mean, size=electrons.shape)
+
+        if fe55:
+            num_hits = self.random.poisson(self.fe55_rate*NROWS*NCOLS*max(exptime, 1.0))
+            rows = self.random.randint(0, NROWS, num_hits)
+            cols = self.random.randint(0, NCOLS, num_hits)
+            energies = self.random.choice(FE55_ELECTRONS, num_hits, p=FE55_FRACTIONS)
+            np.add.at(electrons, (rows, cols), energies)
+
+        pixels = bias + (self.read_noise/gain)*self.random.randn(*shape)
+        pixels[:, PRESCAN:PRESCAN+NCOLS] += electrons/gain
+
+        return np.clip(np.rint(pixels), 0, 65535).astype(np.uint16)
+
+    def write_image(self, filepath, exptime, illuminated=False, fe55=False):
+        """Write a simulated 16 segment FITs image."""
+
+        prihdu = fits.PrimaryHDU()
+        prihdu.header['DATE'] = datetime.utcnow().strftime('%a %b %d %H:%M:%S UTC %Y')
+        prihdu.header['EXPTIME'] = float(exptime)
+
+        ## Reserve header space so keywords can be added without a rewrite
+        for i in range(RESERVED_CARDS):
+            prihdu.header.add_blank()
+        hdulist = fits.HDUList([prihdu])
+
+        datasec = '[{0}:{1},1:{2}]'.format(PRESCAN+1, PRESCAN+NCOLS, NROWS)
+        for seg in range(NSEGMENTS):
+            hdu = fits.ImageHDU(self.segment(seg, exptime, illuminated, fe55),
+                                name='SEGMENT{0}'.format(seg+1), uint=True)
+            hdu.header['CCDSEC'] = datasec
+            hdu.header['TRIMSEC'] = datasec
+            hdulist.append(hdu)
+
+        hdulist.writeto(filepath)
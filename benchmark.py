@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+"""This is a Python script to benchmark image acquisition throughput.
+
+Each acquisition stage is timed against the simulated STA3800 controller,
+reporting per-stage latency, images per hour, CPU time, memory and bytes
+written.  Results can be written as JSON to compare between versions.
+"""
+
+import sys
+import os
+import argparse
+import json
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import backend
+import exposure
+import voltage
+import scanplan
+import acquisition
+
+###############################################################################
+##
+##  Measurement Helpers
+##
+###############################################################################
+
+def bytes_written():
+    """Return bytes written to storage by this process, if known."""
+
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+
+    return None
+
+class Stage(object):
+    """Collects latency and bytes written for one acquisition stage."""
+
+    def __init__(self, name):
+
+        self.name = name
+        self.latencies = []
+        self.written = []
+
+    def time(self, func, *args, **kwargs):
+        """Call a function, recording its latency and bytes written."""
+
+        start_bytes = bytes_written()
+        start = time.time()
+        result = func(*args, **kwargs)
+        self.latencies.append(time.time() - start)
+        if start_bytes is not None:
+            self.written.append(bytes_written() - start_bytes)
+
+        return result
+
+    def results(self):
+
+        latencies = np.array(self.latencies)
+        result = {"count" : len(latencies),
+                  "p50" : float(np.percentile(latencies, 50)) if len(latencies) else None,
+                  "p95" : float(np.percentile(latencies, 95)) if len(latencies) else None,
+                  "total" : float(latencies.sum())}
+        if self.written:
+            result["bytes_written_mean"] = float(np.mean(self.written))
+
+        return result
+
+###############################################################################
+##
+##  Benchmarks
+##
+###############################################################################
+
+def bench_voltages(stages, num_points):
+    """Time single rail changes and batched voltage session changes."""
+
+    set_stage = stages.setdefault("set_voltage", Stage("set_voltage"))
+    apply_stage = stages.setdefault("session_apply", Stage("session_apply"))
+
+    session = voltage.open_session()
+
+    for i in range(num_points):
+        set_stage.time(voltage.set_voltage, 24.0 + 0.1*(i % 10), "VOD")
+        apply_stage.time(session.apply, {"VOD" : 25.0 + 0.1*(i % 10),
+                                         "VRD" : 13.0 + 0.1*(i % 10),
+                                         "PARLO" : -8.0 + 0.1*(i % 10)})
+
+def bench_frames(stages, num_frames, data_dir, mode="dark", exptime=0.0):
+    """Time image acquisition and FITs header update separately."""
+
+    acq_stage = stages.setdefault("im_acq", Stage("im_acq"))
+    hdr_stage = stages.setdefault("update_header", Stage("update_header"))
+
+    for i in range(num_frames):
+        filepath = acq_stage.time(exposure.im_acq, mode, "bench", exptime, i+1,
+                                  data_dir, is_test=False)
+        hdr_stage.time(exposure.update_header, filepath, mode, exptime, i+1)
+
+def bench_scan(stages, paramfile, order, data_dir, depth=2, exptime=0.0):
+    """Time a full voltage scan with the acquisition engine."""
+
+    point_stage = stages.setdefault("scan_point", Stage("scan_point"))
+    scan_stage = stages.setdefault("scan_total", Stage("scan_total"))
+
+    ## Time between images read out covers the voltage change and exposure
+    times = [time.time()]
+    def taken():
+        now = time.time()
+        point_stage.latencies.append(now - times[-1])
+        times.append(now)
+
+    engine = acquisition.AcquisitionEngine(depth, order, on_taken=taken)
+    times[0] = time.time()
+    scan_stage.time(engine.scan, paramfile, "benchscan", exptime, 1, data_dir,
+                    is_test=False)
+
+    return len(point_stage.latencies)
+
+def run(args):
+    """Run all benchmarks and return results as a dictionary."""
+
+    sim = backend.SimBackend(time_scale=args.time_scale, seed=args.seed)
+    backend.set_backend(sim)
+    sim.run(["sta3800_setup"])
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="ccdbench")
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    stages = {}
+
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    num_files = 0
+
+    try:
+        bench_voltages(stages, args.points)
+
+        bench_frames(stages, args.frames, data_dir)
+        num_files += args.frames
+
+        if args.scan is not None:
+            num_files += bench_scan(stages, args.scan, args.order, data_dir, args.depth)
+    finally:
+        voltage.close_session()
+        if args.data_dir is None:
+            shutil.rmtree(data_dir)
+
+    elapsed = time.time() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    return {"stages" : dict((name, stage.results()) for name, stage in stages.items()),
+            "files" : num_files,
+            "elapsed" : elapsed,
+            "files_per_hour" : 3600.0*num_files/elapsed if elapsed > 0 else None,
+            "cpu_user" : usage.ru_utime - usage_start.ru_utime,
+            "cpu_system" : usage.ru_stime - usage_start.ru_stime,
+            "max_rss_kb" : usage.ru_maxrss,
+            "time_scale" : args.time_scale}
+
+def report(results):
+    """Format benchmark results as a text table."""
+
+    lines = ["{0:<16}{1:>8}{2:>12}{3:>12}{4:>16}".format("stage", "count", "p50 (s)",
+                                                         "p95 (s)", "bytes written")]
+    for name in sorted(results["stages"]):
+        stage = results["stages"][name]
+        lines.append("{0:<16}{1:>8}{2:>12.4f}{3:>12.4f}{4:>16}".\
+                     format(name, stage["count"], stage["p50"], stage["p95"],
+                            int(stage.get("bytes_written_mean", 0))))
+
+    lines.append("files/hour: {0:.0f}  cpu: {1:.2f}s user, {2:.2f}s system  max RSS: {3} kB".\
+                 format(results["files_per_hour"], results["cpu_user"],
+                        results["cpu_system"], results["max_rss_kb"]))
+
+    return "\n".join(lines)
+
+###############################################################################
+##
+##  Main Function and Argument Parser
+##
+###############################################################################
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark image acquisition throughput",
+                                     prog='CCD Benchmark')
+    parser.add_argument("-n", "--frames", type=int, default=5, metavar='',
+                        help="Number of images to acquire")
+    parser.add_argument("-p", "--points", type=int, default=20, metavar='',
+                        help="Number of voltage changes to time")
+    parser.add_argument("-s", "--scan", default=None, metavar='',
+                        help="Scan parameter file to time a voltage scan")
+    parser.add_argument("--order", default="weighted", choices=scanplan.ORDERS,
+                        help="Scan point order")
+    parser.add_argument("--depth", type=int, default=2, metavar='',
+                        help="Pipeline depth for scan header updates")
+    parser.add_argument("-t", "--time-scale", type=float, default=0.0, metavar='',
+                        help="Scale simulated command latency (0 disables it)")
+    parser.add_argument("-d", "--data-dir", default=None, metavar='',
+                        help="Directory for images (temporary if not given)")
+    parser.add_argument("--seed", type=int, default=0, metavar='',
+                        help="Random seed for simulated images")
+    parser.add_argument("-o", "--output", default=None, metavar='',
+                        help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    results = run(args)
+
+    print report(results)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+
+    main()
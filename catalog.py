@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+"""This is a Python module to keep a catalog of acquired images.
+
+Every finalized image is recorded in an SQLite database in its data
+directory, with its mode, exposure time, sequence number, voltages,
+timestamps, quick-look statistics, Fe55 gain and the time taken by each
+acquisition stage.  Images can then be found with a query instead of
+opening every FITs header, e.g.
+
+    Catalog("/home/lsst/Data").query(mode="bias", VOD=25.0, VRD=13.0)
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+import argparse
+
+import quicklook
+
+## Catalog file name within a data directory
+CATALOG_NAME = "catalog.sqlite"
+
+## Voltages kept as columns so they can be queried
+VOLTAGE_NAMES = ["VDD", "VOD", "VOG", "VRD", "RGHI", "RGLO",
+                 "PARHI", "PARLO", "SERHI", "SERLO"]
+
+## Header keywords kept as columns, the rest are stored as JSON
+KEYWORD_COLUMNS = {"filter_name" : "filter",
+                   "monowl" : "monowl"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+    filepath TEXT PRIMARY KEY,
+    filebase TEXT,
+    mode TEXT,
+    exptime REAL,
+    seqnum INTEGER,
+    acquired REAL,
+    finalized REAL,
+    status TEXT,
+    acq_seconds REAL,
+    header_seconds REAL,
+    filter TEXT,
+    monowl REAL,
+    {0},
+    bias REAL,
+    noise REAL,
+    signal REAL,
+    saturated REAL,
+    quicklook TEXT,
+    gain REAL,
+    fe55 TEXT,
+    timings TEXT,
+    keywords TEXT
+);
+CREATE INDEX IF NOT EXISTS frames_mode ON frames (mode, exptime);
+CREATE INDEX IF NOT EXISTS frames_acquired ON frames (acquired);
+""".format(",\n    ".join("{0} REAL".format(vname) for vname in VOLTAGE_NAMES))
+
+###############################################################################
+##
+##  Exposure Catalog
+##
+###############################################################################
+
+class Catalog(object):
+    """SQLite catalog of the images in a data directory.
+
+    A catalog may be written from the frame pipeline thread while it is
+    queried from another.
+    """
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        self.filepath = os.path.join(directory, CATALOG_NAME)
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(self.filepath, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.executescript(SCHEMA)
+            self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+
+        with self.lock:
+            self.connection.close()
+
+    def add(self, filepath, mode, exptime, seqnum, filebase=None, acquired=None,
+            finalized=None, status="finalized", timings=None, quicklook=None, fe55=None,
+            **kwargs):
+        """Add or replace the entry for an image.
+
+        Timings is a dictionary of seconds taken by each stage; quicklook and
+        fe55 are lists of per-segment result dictionaries.  Keyword arguments
+        are the image's header keywords, including voltages.
+        """
+
+        if timings is None:
+            timings = {}
+        if quicklook is None:
+            quicklook = []
+        if fe55 is None:
+            fe55 = []
+
+        row = {"filepath" : os.path.abspath(filepath),
+               "filebase" : filebase,
+               "mode" : mode,
+               "exptime" : float(exptime),
+               "seqnum" : int(seqnum),
+               "acquired" : acquired,
+               "finalized" : finalized,
+               "status" : status,
+               "acq_seconds" : timings.get("im_acq"),
+               "header_seconds" : timings.get("header_stage"),
+               "timings" : json.dumps(timings, sort_keys=True),
+               "quicklook" : json.dumps(quicklook, sort_keys=True),
+               "fe55" : json.dumps(fe55, sort_keys=True)}
+
+        ## Frame values are the median over segments, saturation the worst
+        for column, key in [("bias", "bias"), ("noise", "noise"), ("signal", "median")]:
+            values = sorted(seg[key] for seg in quicklook)
+            row[column] = values[len(values)//2] if values else None
+        row["saturated"] = max([seg["saturated"] for seg in quicklook] or [None])
+        gains = sorted(seg["gain"] for seg in fe55 if seg["gain"] is not None)
+        row["gain"] = gains[len(gains)//2] if gains else None
+
+        keywords = dict(kwargs)
+        for vname in VOLTAGE_NAMES:
+            value = keywords.pop(vname, None)
+            row[vname] = None if value is None else float(value)
+        for key, column in KEYWORD_COLUMNS.items():
+            row[column] = keywords.pop(key, None)
+        row["keywords"] = json.dumps(keywords, sort_keys=True, default=str)
+
+        columns = sorted(row)
+        sql = "INSERT OR REPLACE INTO frames ({0}) VALUES ({1})".\
+            format(", ".join(columns), ", ".join("?"*len(columns)))
+
+        with self.lock:
+            self.connection.execute(sql, [row[column] for column in columns])
+            self.connection.commit()
+
+    def catalog_stage(self, frame):
+        """Pipeline stage recording a finalized image."""
+
+        ## Test images are overwritten and not catalogued
+        if frame.header_kwargs.get('is_test', False):
+            return
+
+        status = "finalized" if "header_stage" in frame.results else "header_failed"
+        keywords = dict((key, value) for key, value in frame.header_kwargs.items()
+                        if key != 'is_test')
+        stats = frame.results.get(quicklook.STAGE_NAME) or []
+        hits = frame.results.get("fe55_stage") or []
+
+        self.add(frame.filepath, frame.mode, frame.exptime, frame.seqnum,
+                 filebase=frame.filebase, acquired=frame.acquired,
+                 finalized=time.time(), status=status, timings=frame.timings,
+                 quicklook=[seg.as_dict() for seg in stats],
+                 fe55=[seg.as_dict() for seg in hits], **keywords)
+
+    def query(self, mode=None, exptime=None, filebase=None, seqnum=None, since=None,
+              until=None, status=None, tolerance=0.005, **voltages):
+        """Find images matching all of the given values.
+
+        Voltages are given by name (e.g. VOD=25.0) and match within the
+        tolerance in volts; since and until are Unix times.  Returns a list
+        of dictionaries ordered by acquisition time.
+        """
+
+        clauses = []
+        params = []
+
+        for column, value in [("mode", mode), ("filebase", filebase),
+                              ("seqnum", seqnum), ("status", status)]:
+            if value is not None:
+                clauses.append("{0} = ?".format(column))
+                params.append(value)
+
+        if exptime is not None:
+            clauses.append("ABS(exptime - ?) < 0.0005")
+            params.append(float(exptime))
+        if since is not None:
+            clauses.append("acquired >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("acquired < ?")
+            params.append(until)
+
+        for vname, value in voltages.items():
+            if vname.upper() not in VOLTAGE_NAMES:
+                raise KeyError("Voltage name {0} not found.".format(vname))
+            clauses.append("ABS({0} - ?) <= ?".format(vname.upper()))
+            params.extend([float(value), tolerance])
+
+        sql = "SELECT * FROM frames"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY acquired, seqnum"
+
+        with self.lock:
+            rows = self.connection.execute(sql, params).fetchall()
+
+        results = []
+        for row in rows:
+            entry = dict(zip(row.keys(), row))
+            entry["timings"] = json.loads(entry["timings"] or "{}")
+            entry["keywords"] = json.loads(entry["keywords"] or "{}")
+            entry["quicklook"] = json.loads(entry["quicklook"] or "[]")
+            entry["fe55"] = json.loads(entry["fe55"] or "[]")
+            results.append(entry)
+
+        return results
+
+    def filepaths(self, **criteria):
+        """Paths of the images matching a query."""
+
+        return [entry["filepath"] for entry in self.query(**criteria)]
+
+    def __len__(self):
+
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM frames").fetchone()[0]
+
+###############################################################################
+##
+##  Main Function and Argument Parser
+##
+###############################################################################
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Query the catalog of a data directory",
+                                     prog='CCD Catalog')
+    parser.add_argument("directory", help="Data directory")
+    parser.add_argument("-m", "--mode", default=None, metavar='',
+                        help="Image mode (exp, dark, bias, flat, fe55, scan)")
+    parser.add_argument("-e", "--exptime", type=float, default=None, metavar='',
+                        help="Exposure time in seconds")
+    parser.add_argument("-f", "--filebase", default=None, metavar='',
+                        help="Image title")
+    parser.add_argument("-v", "--voltage", action="append", default=[], metavar='',
+                        help="Voltage to match, e.g. VOD=25 (may be repeated)")
+    args = parser.parse_args()
+
+    voltages = {}
+    for setting in args.voltage:
+        vname, value = setting.split("=")
+        voltages[vname.upper()] = float(value)
+
+    with Catalog(args.directory) as catalog:
+        for filepath in catalog.filepaths(mode=args.mode, exptime=args.exptime,
+                                          filebase=args.filebase, **voltages):
+            print filepath
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+"""This is a Python script to take CCD images from the command line.
+
+Exposure stacks, exposure/dark series and voltage scans are run with the
+same acquisition engine as the GUI, without importing PyQt4, so unattended
+runs work on DAQ hosts without a display.
+"""
+
+import sys
+import argparse
+import logging
+from logging.config import fileConfig
+from ConfigParser import RawConfigParser
+
+import backend
+import ccdsetup
+import voltage
+import settle
+import scanplan
+import acquisition
+import sequence
+import stacking
+
+###############################################################################
+##
+##  Settings
+##
+###############################################################################
+
+class Settings(object):
+    """Acquisition settings shared with the GUI INI file."""
+
+    def __init__(self, filepath="./settings.ini"):
+
+        parser = RawConfigParser()
+        parser.optionxform = str
+        parser.read(filepath)
+
+        def section(name):
+            if parser.has_section(name):
+                return dict(parser.items(name))
+            return {}
+
+        general = section("General")
+        self.data_dir = general.get("DATA_DIRECTORY", "./")
+        self.pipeline_depth = int(general.get("PIPELINE_DEPTH", 2))
+        self.scan_order = general.get("SCAN_ORDER", "weighted")
+        self.stack_combine = general.get("STACK_COMBINE", "none")
+        self.series_pairs = general.get("SERIES_PAIRS", "false").lower() == "true"
+
+        ## FITs header information and nominal start-up voltages
+        self.fitsinfo = section("Settings")
+        self.voltages = dict((vname, float(value))
+                             for vname, value in section("Voltages").items())
+
+###############################################################################
+##
+##  Commands
+##
+###############################################################################
+
+def setup_controller(args, logger):
+    """Bring the controller to the STA3800 set-up."""
+
+    if args.power_cycle:
+        logger.info("Turning off sta3800 controller (sta3800_off).")
+        ccdsetup.sta3800_off()
+        logger.info("Turning on sta3800 controller (sta3800_setup).")
+        ccdsetup.sta3800_setup()
+    else:
+        sections = ccdsetup.sta3800_reconcile()
+        logger.info("Controller set-up is current, applied: {0}.".\
+                    format(", ".join(sections) or "nothing"))
+
+def acquire(args, settings, logger):
+    """Run an exposure stack, series or voltage scan.  Returns True on success."""
+
+    engine = acquisition.AcquisitionEngine(args.depth or settings.pipeline_depth,
+                                           args.order or settings.scan_order,
+                                           voltages=settings.voltages)
+    data_dir = args.data_dir or settings.data_dir
+
+    ## Build FITs header information
+    kwargs = dict(settings.fitsinfo)
+    if args.filter is not None:
+        kwargs['filter_name'] = args.filter
+    else:
+        kwargs['monowl'] = args.monowl
+    kwargs.update(settings.voltages)
+    kwargs.update(voltage.open_session().state.values)
+    kwargs['is_test'] = args.filename == 'test'
+
+    if args.command == "stack":
+        combine = args.combine or settings.stack_combine
+        return engine.stack(args.mode, args.filename, args.exptime, args.count,
+                            args.seqnum, data_dir,
+                            combine=None if combine == "none" else combine, **kwargs)
+
+    elif args.command == "series":
+        try:
+            exptimes = acquisition.series_exptimes(args.min, args.max, args.step)
+        except ValueError as e:
+            logger.warning("{0} Series not started.".format(e))
+            return False
+        return engine.series(args.mode, args.filename, exptimes, args.seqnum,
+                             data_dir, pairs=args.pairs or settings.series_pairs, **kwargs)
+
+    elif args.command == "scan":
+        start_voltages = dict((vname, kwargs[vname]) for vname in settings.voltages)
+        return engine.scan(args.paramfile, args.filename, args.exptime, args.seqnum,
+                           data_dir, resume=args.resume, start_voltages=start_voltages,
+                           **kwargs)
+
+    elif args.command == "sequence":
+        start_voltages = dict((vname, kwargs[vname]) for vname in settings.voltages)
+        try:
+            steps = sequence.Sequence.from_file(args.seqfile)
+        except (IOError, ValueError):
+            logger.exception("Invalid sequence file. Sequence not started.")
+            return False
+        runner = sequence.SequenceRunner(engine)
+        return runner.run(steps, args.seqnum, data_dir, start_voltages,
+                          **kwargs) == len(steps)
+
+###############################################################################
+##
+##  Main Function and Argument Parser
+##
+###############################################################################
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Take STA3800 CCD images without the GUI",
+                                     prog='CCD Acquire')
+    parser.add_argument("-c", "--config", default="./settings.ini", metavar='',
+                        help="Settings file shared with the GUI")
+    parser.add_argument("-s", "--simulate", action="store_true",
+                        help="Use a simulated controller instead of the hardware")
+    parser.add_argument("-t", "--time-scale", type=float, default=1.0, metavar='',
+                        help="Scale simulated command latency (0 disables it)")
+    subparsers = parser.add_subparsers(dest="command")
+
+    ## Controller set-up commands
+    setup_parser = subparsers.add_parser("setup", help="Set up the controller")
+    setup_parser.add_argument("--power-cycle", action="store_true",
+                              help="Turn the controller off and on instead of reconciling")
+    subparsers.add_parser("off", help="Turn off the controller")
+
+    ## Options shared by acquisition commands
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("-d", "--data-dir", default=None, metavar='',
+                        help="Directory for images (DATA_DIRECTORY if not given)")
+    common.add_argument("-f", "--filename", default="test", metavar='',
+                        help="Image title, 'test' overwrites test.fits")
+    common.add_argument("-n", "--seqnum", type=int, default=1, metavar='',
+                        help="First sequence number")
+    common.add_argument("--filter", default=None, metavar='',
+                        help="Broadband filter name")
+    common.add_argument("--monowl", type=float, default=0.0, metavar='',
+                        help="Monochromator wavelength, if no filter is given")
+    common.add_argument("--depth", type=int, default=None, metavar='',
+                        help="Pipeline depth for header updates")
+    common.add_argument("--order", default=None, choices=scanplan.ORDERS,
+                        help="Scan point order")
+    common.add_argument("--no-setup", action="store_true",
+                        help="Do not reconcile the controller set-up first")
+
+    stack_parser = subparsers.add_parser("stack", parents=[common],
+                                         help="Take a stack of images")
+    stack_parser.add_argument("mode", choices=["exp", "dark", "bias", "flat", "fe55"])
+    stack_parser.add_argument("-e", "--exptime", type=float, default=0.0, metavar='',
+                              help="Exposure time in seconds")
+    stack_parser.add_argument("-i", "--count", type=int, default=1, metavar='',
+                              help="Number of images")
+    stack_parser.add_argument("--combine", default=None, choices=stacking.METHODS + ["none"],
+                              help="Combine the stack into a master frame")
+
+    series_parser = subparsers.add_parser("series", parents=[common],
+                                          help="Take an exposure or dark series")
+    series_parser.add_argument("mode", choices=["exp", "dark"])
+    series_parser.add_argument("--min", type=float, required=True, metavar='',
+                               help="Minimum exposure time")
+    series_parser.add_argument("--max", type=float, required=True, metavar='',
+                               help="Maximum exposure time")
+    series_parser.add_argument("--step", type=float, required=True, metavar='',
+                               help="Exposure time step")
+    series_parser.add_argument("--pairs", action="store_true",
+                               help="Take two images at each exposure time for the PTC")
+
+    scan_parser = subparsers.add_parser("scan", parents=[common],
+                                        help="Take a voltage scan from a parameter file")
+    scan_parser.add_argument("paramfile", help="Scan parameter file")
+    scan_parser.add_argument("-e", "--exptime", type=float, default=0.0, metavar='',
+                             help="Exposure time in seconds")
+    scan_parser.add_argument("--resume", action="store_true",
+                             help="Skip points completed by an interrupted scan")
+
+    sequence_parser = subparsers.add_parser("sequence", parents=[common],
+                                            help="Run the steps of a sequence file back-to-back")
+    sequence_parser.add_argument("seqfile", help="JSON sequence file")
+    sequence_parser.add_argument("--estimate", action="store_true",
+                                 help="Only print the steps and estimated run time")
+
+    args = parser.parse_args()
+
+    ## Set up logging, echoing to the console
+    fileConfig(args.config)
+    logger = logging.getLogger('sLogger')
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+
+    if args.simulate:
+        backend.set_backend(backend.SimBackend(time_scale=args.time_scale))
+        logger.info("Using simulated STA3800 controller.")
+
+    settings = Settings(args.config)
+    settle.load_settings(args.config)
+
+    ## Estimate a sequence without touching the controller
+    if args.command == "sequence" and args.estimate:
+        try:
+            steps = sequence.Sequence.from_file(args.seqfile)
+        except (IOError, ValueError):
+            logger.exception("Invalid sequence file.")
+            sys.exit(1)
+        print steps.summary(settings.voltages, args.order or settings.scan_order)
+        return
+
+    ## Run in one process so simulated controller state is kept
+    result = True
+    try:
+        if args.command == "setup":
+            setup_controller(args, logger)
+        elif args.command == "off":
+            ccdsetup.sta3800_off()
+        else:
+            if not args.no_setup:
+                args.power_cycle = False
+                setup_controller(args, logger)
+            result = acquire(args, settings, logger)
+    finally:
+        voltage.close_session()
+        backend.close_relay()
+
+    sys.exit(0 if result else 1)
+
+if __name__ == '__main__':
+
+    main()
@@ -9,8 +9,8 @@ import atexit
 import subprocess
 import logging
 from logging.config import fileConfig
-from itertools import product
 import time
+import collections
 import numpy as np
 
 import design
@@ -18,6 +18,34 @@ import ccdsetup
 import exposure
 import restore
 import voltage
+import backend
+import acquisition
+import settle
+import sequence
+import quicklook
+import scansurface
+
+## Log display refresh interval in ms, and number of lines kept on display
+LOG_INTERVAL = 100
+LOG_MAX_LINES = 1000
+
+## Quick-look statistics shown for each segment, (column title, attribute)
+QUICKLOOK_COLUMNS = [("Bias", "bias"),
+                     ("Noise", "noise"),
+                     ("Mean", "mean"),
+                     ("Median", "median"),
+                     ("Saturated", "saturated")]
+
+## Heatmap colours from blue to red, with untaken scan points in grey
+SURFACE_COLORS = [QtGui.qRgb(128, 128, 128)] + \
+    [QtGui.qRgb(int(255*t), int(255*(1 - abs(2*t - 1))), int(255*(1 - t)))
+     for t in np.linspace(0.0, 1.0, 255)]
+
+## Controller states, set by the background power-up sequence
+CONTROLLER_OFF = "OFF"
+CONTROLLER_POWERING = "POWERING"
+CONTROLLER_READY = "READY"
+CONTROLLER_FAULT = "FAULT"
 
 ###############################################################################
 ##
@@ -45,15 +73,36 @@ class WorkerThread(QtCore.QThread):
         self.status = True
 
 class QtHandler(logging.Handler, object):
-    """Object to handle displaying log information to GUI."""
+    """Buffers log information for display in the GUI.
 
-    def __init__(self, sigEmitter):
+    Messages from any thread are kept in a ring buffer and taken in batches
+    by a GUI timer, so fast logging does not re-layout the display for
+    every record.
+    """
+
+    def __init__(self, max_lines=LOG_MAX_LINES):
         super(QtHandler, self).__init__()
-        self.sigEmitter = sigEmitter
+        self.buffer = collections.deque(maxlen=max_lines)
+        self.dropped = 0
 
     def emit(self, status):
-        message = str(status.getMessage())
-        self.sigEmitter.emit(QtCore.SIGNAL("logMsg(QString)"), message)
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append(str(status.getMessage()))
+
+    def take(self):
+        """Remove buffered messages, returning them and the number dropped."""
+
+        self.acquire()
+        try:
+            messages = list(self.buffer)
+            dropped = self.dropped
+            self.buffer.clear()
+            self.dropped = 0
+        finally:
+            self.release()
+
+        return messages, dropped
 
 ###############################################################################
 ##
@@ -66,21 +115,29 @@ class Controller(QtGui.QMainWindow, design.Ui_ccdcontroller):
     ## PyQt signals
     image_start = QtCore.pyqtSignal(int)
     image_taken = QtCore.pyqtSignal()
+    image_finalized = QtCore.pyqtSignal()
     exposure_cancel = QtCore.pyqtSignal()
     seqnum_inc = QtCore.pyqtSignal(int)
+    controller_state = QtCore.pyqtSignal(str)
+    controller_step = QtCore.pyqtSignal(int, str)
+    quicklook_ready = QtCore.pyqtSignal(str, object)
+    surface_ready = QtCore.pyqtSignal(object)
 
     def __init__(self, parent=None):
         super(Controller, self).__init__(parent)
         self.setupUi(self)
 
-        ## Set up Qt log handler
-        logEmitter = QtCore.QObject()
-        self.connect(logEmitter, QtCore.SIGNAL("logMsg(QString)"),
-                     self.statusEdit.append)
-
-        consoleHandler = QtHandler(logEmitter)
+        ## Set up Qt log handler, full output is only kept in the log file
+        self.logHandler = QtHandler()
+        self.logHandler.setLevel(logging.INFO)
         self.logger = logging.getLogger("sLogger")
-        self.logger.addHandler(consoleHandler)
+        self.logger.addHandler(self.logHandler)
+
+        ## Show buffered log messages in batches, keeping a limited history
+        self.statusEdit.document().setMaximumBlockCount(LOG_MAX_LINES)
+        self.logTimer = QtCore.QTimer(self)
+        self.logTimer.timeout.connect(self.showLog)
+        self.logTimer.start(LOG_INTERVAL)
 
         ## Dictionary for image exposure mode
         self.modedict = {"Exposure" : "exp",
@@ -90,7 +147,11 @@ class Controller(QtGui.QMainWindow, design.Ui_ccdcontroller):
                          "Fe55" : "fe55",
                          "Exposure Series" : "exp",
                          "Dark Series" : "dark",
-                         "Voltage Scan" : "scan"}
+                         "Voltage Scan" : "scan",
+                         "Sequence" : "sequence"}
+
+        ## Sequence files are chosen with the parameter file button
+        self.exptypeComboBox.addItem("Sequence")
 
         ## Dictionary holds voltage widget and value information
         self.voltage_dict = {"VOD" : (self.vodLineEdit, 0),
@@ -106,12 +167,24 @@ class Controller(QtGui.QMainWindow, design.Ui_ccdcontroller):
 
         ## Signals and slots for thread testing
         self.thread = WorkerThread(self.expose, ())
+        self.resume_scan = False
         self.thread.started.connect(lambda: self.exposeButton.setEnabled(False))
         self.thread.started.connect(lambda: self.cancelButton.setEnabled(True))
-        self.thread.finished.connect(lambda: self.exposeButton.setEnabled(True))
+        self.thread.finished.connect(lambda: self.exposeButton.setEnabled(self.isReady()))
         self.thread.finished.connect(lambda: self.cancelButton.setEnabled(False))
+        self.thread.started.connect(lambda: self.resumeButton.setEnabled(False))
+        self.thread.finished.connect(self.setDisplay)
         self.exposure_cancel.connect(self.thread.cancel)
-        self.exposeButton.clicked.connect(self.thread.start)
+        self.exposeButton.clicked.connect(lambda: self.startExposure(resume=False))
+        self.resumeButton.clicked.connect(lambda: self.startExposure(resume=True))
+
+        ## Controller power-up runs in its own thread so the GUI stays usable
+        self.state = CONTROLLER_OFF
+        self.resetThread = WorkerThread(self.resetController, (True,))
+        self.resetThread.started.connect(lambda: self.resetButton.setEnabled(False))
+        self.resetThread.finished.connect(lambda: self.resetButton.setEnabled(True))
+        self.controller_state.connect(self.setControllerState)
+        self.controller_step.connect(self.updateResetProgress)
 
         ## Connect signals and slots for functions
         self.resetButton.clicked.connect(self.confirmReset)
@@ -119,18 +192,90 @@ class Controller(QtGui.QMainWindow, design.Ui_ccdcontroller):
         self.directoryPushButton.clicked.connect(self.editDirectory)
         self.shutdownButton.clicked.connect(self.close)
         self.filterToggleButton.toggled.connect(self.toggleFilter)
-        self.setvoltageButton.clicked.connect(lambda: self.setVoltages())
+        self.setvoltageButton.clicked.connect(lambda: self.setVoltages(force=True))
         self.cancelButton.clicked.connect(self.cancelExposure)
         self.paramfileButton.clicked.connect(self.editParamFile)
 
         ## Progress bar signals
         self.image_start.connect(self.resetProgressBar)
         self.image_taken.connect(self.updateProgressBar)
+        self.image_finalized.connect(self.updateFinalizedBar)
         self.seqnum_inc.connect(self.autoIncrement)
+
+        ## Quick-look statistics of the last finalized image
+        self.quicklookTable = QtGui.QTableWidget(0, len(QUICKLOOK_COLUMNS))
+        self.quicklookTable.setHorizontalHeaderLabels([title for title, name
+                                                       in QUICKLOOK_COLUMNS])
+        self.quicklookTable.setEditTriggers(QtGui.QAbstractItemView.NoEditTriggers)
+        self.quicklookDock = QtGui.QDockWidget("Quick-look", self)
+        self.quicklookDock.setWidget(self.quicklookTable)
+        self.addDockWidget(QtCore.Qt.RightDockWidgetArea, self.quicklookDock)
+        self.quicklook_ready.connect(self.showQuickLook)
+
+        ## Live heatmap of the voltage scan response surface
+        self.surface = None
+        self.surfaceMetricComboBox = QtGui.QComboBox()
+        self.surfaceMetricComboBox.addItems(scansurface.METRICS)
+        self.surfaceMetricComboBox.setCurrentIndex(scansurface.METRICS.index("noise"))
+        self.surfaceXComboBox = QtGui.QComboBox()
+        self.surfaceYComboBox = QtGui.QComboBox()
+        self.surfaceImage = QtGui.QLabel()
+        self.surfaceImage.setMinimumSize(200, 200)
+        self.surfaceImage.setAlignment(QtCore.Qt.AlignCenter)
+        self.surfaceRange = QtGui.QLabel()
+
+        surfaceLayout = QtGui.QGridLayout()
+        surfaceLayout.addWidget(self.surfaceMetricComboBox, 0, 0)
+        surfaceLayout.addWidget(self.surfaceXComboBox, 0, 1)
+        surfaceLayout.addWidget(self.surfaceYComboBox, 0, 2)
+        surfaceLayout.addWidget(self.surfaceImage, 1, 0, 1, 3)
+        surfaceLayout.addWidget(self.surfaceRange, 2, 0, 1, 3)
+        surfaceWidget = QtGui.QWidget()
+        surfaceWidget.setLayout(surfaceLayout)
+        self.surfaceDock = QtGui.QDockWidget("Scan response", self)
+        self.surfaceDock.setWidget(surfaceWidget)
+        self.addDockWidget(QtCore.Qt.RightDockWidgetArea, self.surfaceDock)
+
+        self.surface_ready.connect(self.setSurface)
+        for comboBox in [self.surfaceMetricComboBox, self.surfaceXComboBox,
+                         self.surfaceYComboBox]:
+            comboBox.currentIndexChanged.connect(self.showSurface)
         
+        ## Persistent shell for voltage executables
+        self.vsession = voltage.open_session()
+
         ## Restore past GUI display settings and reset sta3800 controller
         self.restoreSettings()
-        self.resetController()
+
+        ## Acquisition engine reports progress with the GUI signals
+        self.engine = acquisition.AcquisitionEngine(
+            self.pipeline_depth, self.scan_order,
+            set_voltages=lambda new: self.setVoltages(new, update_display=False),
+            on_start=self.image_start.emit, on_taken=self.image_taken.emit,
+            on_finalized=self.emitFinalized, on_seqnum=self.seqnum_inc.emit)
+        self.exposure_cancel.connect(self.engine.cancel)
+        self.setControllerState(CONTROLLER_OFF)
+        self.startReset(power_cycle=False)
+
+    @QtCore.pyqtSlot()
+    def showLog(self):
+        """Append log messages buffered since the last update to the display."""
+
+        messages, dropped = self.logHandler.take()
+        if dropped:
+            messages.insert(0, "... {0} messages not shown, see log file.".format(dropped))
+        if not messages:
+            return
+
+        ## One insertion per batch; new lines become separate blocks
+        cursor = QtGui.QTextCursor(self.statusEdit.document())
+        cursor.movePosition(QtGui.QTextCursor.End)
+        if not self.statusEdit.document().isEmpty():
+            cursor.insertText("\n")
+        cursor.insertText("\n".join(messages))
+
+        scrollbar = self.statusEdit.verticalScrollBar()
+        scrollbar.setValue(scrollbar.maximum())
 
     @QtCore.pyqtSlot(int)
     def autoIncrement(self, seqnum_old):
@@ -141,6 +286,52 @@ class Controller(QtGui.QMainWindow, design.Ui_ccdcontroller):
             if not self.testimCheckBox.isChecked():
                 self.imnumSpinBox.setValue(seqnum_old+1)
 
+    def isReady(self):
+        """Check if the controller is powered up and ready for exposures."""
+
+        return self.state == CONTROLLER_READY
+
+    @QtCore.pyqtSlot(str)
+    def setControllerState(self, state):
+        """Record controller state and enable exposure controls only when ready."""
+
+        self.state = str(state)
+        ready = self.isReady() and not self.thread.isRunning()
+
+        ## Voltage display is only reset to nominal values on a successful power-up
+        if self.state == CONTROLLER_READY:
+            self.defaultVoltages()
+
+        self.exposeButton.setEnabled(ready)
+        self.setvoltageButton.setEnabled(ready)
+        self.resumeButton.setEnabled(ready and
+                                     str(self.exptypeComboBox.currentText()) == "Voltage Scan")
+
+        ## Busy progress bar while powering up, cleared otherwise
+        if self.state == CONTROLLER_POWERING:
+            self.progressBar.setRange(0, 2)
+            self.progressBar.setValue(0)
+            self.progressBar.setFormat("Powering up, %v of %m steps")
+        else:
+            self.progressBar.setRange(0, 1)
+            self.progressBar.setValue(0)
+            self.progressBar.setFormat("%p%")
+
+        self.statusBar.showMessage("Controller {0}".format(self.state))
+
+    @QtCore.pyqtSlot(int, str)
+    def updateResetProgress(self, step, description):
+        """Show progress of the controller power-up sequence."""
+
+        self.progressBar.setValue(step)
+        self.statusBar.showMessage("Controller {0}: {1}".format(self.state, description))
+
+    def startExposure(self, resume=False):
+        """Start exposure thread, optionally resuming an interrupted scan."""
+
+        self.resume_scan = resume
+        self.thread.start()
+
     @QtCore.pyqtSlot()
     def cancelExposure(self):
         """Emit signal to cancel exposure."""
@@ -153,13 +344,23 @@ class Controller(QtGui.QMainWindow, design.Ui_ccdcontroller):
     def resetProgressBar(self, max):
         """Reset progress bar to 0, and initialize maximum."""
 
+        self.acquired_count = 0
         self.progressBar.setValue(0)
         self.progressBar.setMaximum(max)
+        self.progressBar.setFormat("0 acquired, %v of %m finalized")
 
     @QtCore.pyqtSlot()
     def updateProgressBar(self):
-        """Set new value of progress bar."""
+        """Increase count of acquired images shown on progress bar."""
         
+        self.acquired_count += 1
+        self.progressBar.setFormat("{0} acquired, %v of %m finalized".\
+                                   format(self.acquired_count))
+
+    @QtCore.pyqtSlot()
+    def updateFinalizedBar(self):
+        """Set new value of progress bar when an image is finalized."""
+
         old_value = self.progressBar.value()
         self.progressBar.setValue(old_value+1)
 
@@ -168,8 +369,21 @@ class Controller(QtGui.QMainWindow, design.Ui_ccdcontroller):
 
         exptype = str(self.exptypeComboBox.currentText())
 
+        ## Only voltage scans can be resumed
+        self.resumeButton.setEnabled(exptype == "Voltage Scan" and self.isReady() and
+                                     not self.thread.isRunning())
+
+        ## Sequence files give the exposure parameters of each step
+        if exptype == "Sequence":
+            self.exptimeSpinBox.setEnabled(False)
+            self.imstackSpinBox.setEnabled(False)
+            self.imnumSpinBox.setEnabled(True)
+            self.minexpSpinBox.setEnabled(False)
+            self.maxexpSpinBox.setEnabled(False)
+            self.tstepSpinBox.setEnabled(False)
+
         ## If a series of exposures, enable exptime limit input widgets
-        if exptype in ["Exposure Series", "Dark Series"]:
+        elif exptype in ["Exposure Series", "Dark Series"]:
             self.exptimeSpinBox.setEnabled(False)
             self.imstackSpinBox.setEnabled(False)
             self.imnumSpinBox.setEnabled(False)
@@ -201,6 +415,10 @@ class Controller(QtGui.QMainWindow, design.Ui_ccdcontroller):
                                       QtGui.QMessageBox.Ok)
             return
 
+        ## Controller is already being reset
+        elif self.resetThread.isRunning():
+            return
+
         ## Confirmation box for resetting controller
         else:
             reply = QtGui.QMessageBox.\
@@ -210,7 +428,7 @@ class Controller(QtGui.QMainWindow, design.Ui_ccdcontroller):
                              QtGui.QMessageBox.No)
 
             if reply == QtGui.QMessageBox.Yes:
-                self.reset()
+                self.startReset(power_cycle=True)
 
     def editDirectory(self):
         """Open prompt for user to select a new directory to save data."""
@@ -233,7 +451,7 @@ class Controller(QtGui.QMainWindow, design.Ui_ccdcontroller):
             self.logger.info("Data directory changed to {0}.".format(new_directory))
 
     def editParamFile(self):
-        """Open prompt for user to select a parameter file for a voltage scan."""
+        """Open prompt for user to select a voltage scan parameter file or sequence file."""
 
         new_file = str(QtGui.QFileDialog.getOpenFileName(self, "Select File"))
 
@@ -246,7 +464,7 @@ class Controller(QtGui.QMainWindow, design.Ui_ccdcontroller):
         """Perform exposure using GUI parameters or parameters from file."""
 
         ## Build FITs header information
-        kwargs = self.fitsinfo
+        kwargs = dict(self.fitsinfo)
 
         if self.filterToggleButton.isChecked():
             kwargs['filter_name'] = str(self.filterComboBox.currentText())
@@ -266,221 +484,197 @@ class Controller(QtGui.QMainWindow, design.Ui_ccdcontroller):
         ## Get exposure parameters from GUI
         exptype = str(self.exptypeComboBox.currentText())
         mode = self.modedict[exptype]
-        
-        if mode == 'bias':
-            exptime = 0.0
-        else:
-            exptime = self.exptimeSpinBox.value()
+        exptime = self.exptimeSpinBox.value()
         num_images = self.imstackSpinBox.value()
         seq_num = self.imnumSpinBox.value()
         data_dir = DATA_DIRECTORY
 
         ## Exposure stack processing
         if exptype in ["Exposure", "Dark", "Bias", "Flat", "Fe55"]:
-            
-            ## Prep GUI for exposure
-            self.image_start.emit(num_images)
-            self.thread.reboot()
-
-            ## Begin exposure stack
-            for i in range(seq_num, seq_num+num_images):
 
-                ## Check if stack interrupted
-                if not self.thread.status:
-                    self.logger.info("Exposure canceled.")
-                    self.thread.reboot()
-                    return
-
-                ## Perform single exposure and check for errors
-                try:
-                    self.logger.info("Starting image {0} of {1}.".\
-                                     format(i+1-seq_num, num_images))
-                    filepath = exposure.im_acq(mode, filename, exptime, seq_num+i,
-                                               data_dir, **kwargs)
-                except subprocess.CalledProcessError:
-                    self.logger.exception("Error in executable {0}_acq. Image not taken.".\
-                                          format(mode))
-                    return
-                except OSError:
-                    self.logger.exception("Executable {0}_acq not found. Image not taken.".\
-                                          format(mode))
-                    return
-                except Exception as e:
-                    self.logger.exception("{0}".format(e))
-                    return
-                else:
-                    self.logger.info("Exposure finished successfully.")
-                    self.image_taken.emit()
-                    self.seqnum_inc.emit(i)
-
-                ## Perform FITs header corrections
-                try:
-                    exposure.update_header(filepath)
-                except IOError:
-                    self.logger.exception("An error occurred while updating the FITs header.")
-
-            else:
-                self.logger.info("All exposures finished successfully.")
-                #subprocess.Popen(['ds9', '-mosaicimage', 'iraf', filepath,
-                #                  '-zoom', 'to', 'fit', '-cmap', 'b'])
+            combine = None if self.stack_combine == "none" else self.stack_combine
+            self.engine.stack(mode, filename, exptime, num_images, seq_num,
+                              data_dir, combine=combine, **kwargs)
 
         ## Exposure series processing
         elif exptype in ["Exposure Series", "Dark Series"]:
 
-            ## Get additional GUI parameters
-            mintime = self.minexpSpinBox.value()
-            maxtime = self.maxexpSpinBox.value()
-            timestep = self.tstepSpinBox.value()
-
-            if mintime > maxtime:
-                self.logger.warning("Minimum time must be less than Maximum time. " +
-                                    "Series not started.")
-                return
-            elif timestep <= 0.0:
-                self.logger.warning("Time step must be greater than 0. Series not started.")
+            try:
+                exptimes = acquisition.series_exptimes(self.minexpSpinBox.value(),
+                                                       self.maxexpSpinBox.value(),
+                                                       self.tstepSpinBox.value())
+            except ValueError as e:
+                self.logger.warning("{0} Series not started.".format(e))
                 return
 
-            ## Construct array of exposure times
-            exptime = mintime
-            exptimes = []
-            while exptime <= maxtime:
-                exptimes.append(exptime)
-                exptime += timestep
-            num_images = len(exptimes)
-
-            ## Prepare GUI for exposure
-            self.image_start.emit(num_images)
-            self.thread.reboot()
-
-            ## Begin exposure series
-            for i, exptime in enumerate(exptimes):
-
-                ## Check if series interrupted
-                if not self.thread.status:
-                    self.logger.info("Exposure series canceled.")
-                    return
+            self.engine.series(mode, filename, exptimes, seq_num, data_dir,
+                               pairs=self.series_pairs, **kwargs)
 
-                ## Perform single exposure and check for errors
-                try:
-                    self.logger.info("Starting {0}s image.".format(exptime))
-                    filepath = exposure.im_acq(mode, filename, exptime, seq_num,
-                                               data_dir, **kwargs)
-                except subprocess.CalledProcessError:
-                    self.logger.exception("Error in executable {0}_acq. Image not taken.".\
-                                          format(mode))
-                    return
-                except OSError:
-                    self.logger.exception("Executable {0}_acq not found. Image not taken.".\
-                                          format(mode))
-                    return
-                except Exception as e:
-                    self.logger.exception("{0}".format(e))
-                    return
-                else:
-                    self.logger.info("Exposure finished successfully.")
-                    self.image_taken.emit()
-
-                ## Perform FITs header corrections
-                try:
-                    exposure.update_header(filepath)
+        elif exptype in ["Voltage Scan"]:
 
-                except IOError:
-                    self.logger.exception("An error occurred while updating the FITs header.")
+            paramfile = str(self.paramfileLineEdit.text())
+            if self.engine.scan(paramfile, filename, exptime, seq_num, data_dir,
+                                resume=self.resume_scan,
+                                start_voltages=self.getVoltageValues(), **kwargs):
+                self.updateVoltageDisplay()
 
-            else:
-                self.seqnum_inc.emit(seq_num)
-                self.logger.info("All exposures finished successfully.")
-                #subprocess.Popen(['ds9', '-mosaicimage', 'iraf', filepath,
-                #                  '-zoom', 'to', 'fit', '-cmap', 'b'])
+        ## Sequence file processing, each step sets its own test flag
+        elif exptype in ["Sequence"]:
 
-            
-        elif exptype in ["Voltage Scan"]:
+            seqfile = str(self.paramfileLineEdit.text())
+            try:
+                steps = sequence.Sequence.from_file(seqfile)
+            except (IOError, ValueError):
+                self.logger.exception("Invalid sequence file. Sequence not started.")
+                return
 
-            ## Read file to get voltage parameters
-            paramfile = str(self.paramfileLineEdit.text())
+            runner = sequence.SequenceRunner(self.engine)
+            runner.run(steps, seq_num, data_dir, self.getVoltageValues(), **kwargs)
+            self.updateVoltageDisplay()
 
-            with open(paramfile) as f:
-                lines = f.readlines()
+    def emitFinalized(self, frame):
+        """Emit signals that an image has finished post-processing."""
 
-                values_list = []
-                vnames = []
+        self.image_finalized.emit()
+        if frame is not None and frame.results.get(quicklook.STAGE_NAME):
+            self.quicklook_ready.emit(frame.filepath, frame.results[quicklook.STAGE_NAME])
 
-                for line in lines:
-                    params = line.split()
-                    vname = params[0]
-                    values = list(np.arange(float(params[1]),
-                                            float(params[2]),
-                                            float(params[3])))
+        ## The pipeline keeps adding points, so the GUI thread gets a copy
+        if frame is not None and frame.results.get(scansurface.STAGE_NAME) is not None:
+            self.surface_ready.emit(frame.results[scansurface.STAGE_NAME].copy())
 
-                    values_list.append(values)
-                    vnames.append(vname)
+    @QtCore.pyqtSlot(object)
+    def setSurface(self, surface):
+        """Show a scan response surface, choosing its axes if it is new."""
 
-            vpoints = list(product(*values_list))
-            num_images = len(vpoints)
+        if surface is not self.surface:
+            for comboBox in [self.surfaceXComboBox, self.surfaceYComboBox]:
+                comboBox.blockSignals(True)
+                comboBox.clear()
+            self.surfaceXComboBox.addItems(surface.vnames)
+            self.surfaceYComboBox.addItems(["(none)"] + surface.vnames)
+            self.surfaceYComboBox.setCurrentIndex(2 if len(surface.vnames) > 1 else 0)
+            for comboBox in [self.surfaceXComboBox, self.surfaceYComboBox]:
+                comboBox.blockSignals(False)
 
-            self.image_start.emit(num_images)
-            self.thread.reboot()
+        self.surface = surface
+        self.showSurface()
 
-            for i, vpoint in enumerate(vpoints):
+    def showSurface(self):
+        """Draw the selected slice of the scan response surface as a heatmap."""
 
-                if not self.thread.status:
-                    self.logger.info("Exposure canceled.")
-                    self.thread.reboot()
-                    return
-                
-                new_voltage_dict = dict((vnames[j], vpoint[j]) for j in range(len(vnames)))
-                self.setVoltages(new_voltage_dict, update_display=False)
-                kwargs.update(new_voltage_dict)
+        if self.surface is None:
+            return
 
-                try:
-                    self.logger.info("Starting exposure {0} of {1}.".format(i, num_images))
-                    filepath = exposure.im_acq(mode, filename, exptime, 1, data_dir,
-                                               **kwargs)
-                except subprocess.CalledProcessError:
-                    self.logger.exception("Error in executable. Image not taken.")
-                    return
-                except OSError:
-                    self.logger.exception("Executable not found. Image not taken.")
-                except Exception as e:
-                    self.logger.exception("{0}".format(e))
-                else:
-                    self.logger.info("Exposure finished successfully.")
-                    self.image_taken.emit()
+        metric = str(self.surfaceMetricComboBox.currentText())
+        xname = str(self.surfaceXComboBox.currentText())
+        yname = str(self.surfaceYComboBox.currentText())
+        if yname == "(none)":
+            yname = None
 
-                try:
-                    exposure.update_header(filepath)
-                except IOError:
-                    self.logger.exception("An error occurred while updating the FITs header.")
+        try:
+            values = self.surface.slice2d(metric, xname, yname)
+        except ValueError:
+            self.surfaceImage.clear()
+            self.surfaceRange.setText("Choose two different axes.")
+            return
 
+        ## Highest y values at the top
+        levels, (low, high) = scansurface.indexed_colors(values[::-1])
+        image = QtGui.QImage(levels.data, levels.shape[1], levels.shape[0],
+                             levels.strides[0], QtGui.QImage.Format_Indexed8).copy()
+        image.setColorTable(SURFACE_COLORS)
+        pixmap = QtGui.QPixmap.fromImage(image).scaled(self.surfaceImage.size(),
+                                                       QtCore.Qt.IgnoreAspectRatio,
+                                                       QtCore.Qt.FastTransformation)
+        self.surfaceImage.setPixmap(pixmap)
+
+        def axis_range(vname):
+            axis = self.surface.axis_values[self.surface.vnames.index(vname)]
+            return "{0} {1:g} to {2:g}".format(vname, axis[0], axis[-1])
+
+        ranges = [axis_range(xname) + " across"]
+        if yname is not None:
+            ranges.append(axis_range(yname) + " up")
+        self.surfaceRange.setText("{0} {1:.3g} to {2:.3g}, {3} of {4} points; {5}".\
+                                  format(metric, low, high, self.surface.filled(),
+                                         int(np.prod(self.surface.shape)),
+                                         ", ".join(ranges)))
+
+    @QtCore.pyqtSlot(str, object)
+    def showQuickLook(self, filepath, stats):
+        """Show quick-look statistics of each segment of an image."""
+
+        self.quicklookDock.setWindowTitle("Quick-look: {0}".format(path.split(str(filepath))[1]))
+        self.quicklookTable.setRowCount(len(stats))
+        self.quicklookTable.setVerticalHeaderLabels([seg.extname for seg in stats])
+
+        for row, seg in enumerate(stats):
+            for col, (title, name) in enumerate(QUICKLOOK_COLUMNS):
+                value = getattr(seg, name)
+                text = "{0:.2%}".format(value) if name == "saturated" else "{0:.1f}".format(value)
+                self.quicklookTable.setItem(row, col, QtGui.QTableWidgetItem(text))
+
+    def startReset(self, power_cycle=True):
+        """Start the reset thread, optionally without an off/on cycle."""
+
+        self.resetThread.args = (power_cycle,)
+        self.resetThread.start()
+
+    def resetController(self, power_cycle=True):
+        """Perform controller off/on cycle (sta3800_off/sta3800_on).
+
+        Without a power cycle, a controller left set up is only brought up
+        to date with the set-up commands that changed.  Runs in the reset
+        thread; state changes are emitted to the GUI.
+        """
+
+        self.controller_state.emit(CONTROLLER_POWERING)
+
+        ## Reconcile with the last applied set-up if it is known
+        if not power_cycle and ccdsetup.get_setup().applied:
+            try:
+                self.controller_step.emit(1, "reconcile")
+                self.logger.info("Reconciling sta3800 controller set-up.")
+                sections = ccdsetup.sta3800_reconcile()
+            except Exception:
+                self.logger.exception("Unable to reconcile sta3800 controller set-up!")
+                self.controller_state.emit(CONTROLLER_FAULT)
             else:
-                self.logger.info("All exposures finished successfully.")
-                self.updateVoltageDisplay()
-                                
-
-    def resetController(self):
-        """Perform controller off/on cycle (sta3800_off/sta3800_on)."""
+                self.vsession.state.invalidate()
+                self.controller_step.emit(2, "done")
+                self.logger.info("Controller set-up is current, applied: {0}.".\
+                                 format(", ".join(sections) or "nothing"))
+                self.controller_state.emit(CONTROLLER_READY)
+            return
 
         ## Turn off controller to bring to a known state
         try:
+            self.controller_step.emit(0, "sta3800_off")
             self.logger.info("Turning off sta3800 controller (sta3800_off).")
             ccdsetup.sta3800_off()
         except Exception:
             self.logger.exception("Unable to turn off controller! State may be unknown.")
-            raise
+            self.controller_state.emit(CONTROLLER_FAULT)
+            return
         else:
             self.logger.info("Controller turned off successfully.")
 
         ## Initialize controller
         try:
+            self.controller_step.emit(1, "sta3800_setup")
             self.logger.info("Turning on sta3800 controller (sta3800_setup).")
             ccdsetup.sta3800_setup()
         except Exception:
             self.logger.exception("Unable to turn on sta3800 controller!")
-            raise
+            self.controller_state.emit(CONTROLLER_FAULT)
         else:
-            ## If controller reset cycle is succesful, set voltage values to nominal values
-            self.defaultVoltages()
+            ## If controller reset cycle is succesful, force the next write of every rail;
+            ## voltage display is reset to nominal values when READY is received
+            self.vsession.state.invalidate()
+            self.controller_step.emit(2, "done")
             self.logger.info("Controller turned on successfully.")
+            self.controller_state.emit(CONTROLLER_READY)
                                 
     def restoreSettings(self):
         """Set GUI display widget values with values read from INI file."""
@@ -493,6 +687,10 @@ class Controller(QtGui.QMainWindow, design.Ui_ccdcontroller):
             self.settings = QtCore.QSettings("./settings.ini", 
                                              QtCore.QSettings.IniFormat)
             DATA_DIRECTORY = unicode(self.settings.value("DATA_DIRECTORY").toString())
+            self.pipeline_depth = self.settings.value("PIPELINE_DEPTH", 2).toInt()[0]
+            self.scan_order = str(self.settings.value("SCAN_ORDER", "weighted").toString())
+            self.stack_combine = str(self.settings.value("STACK_COMBINE", "none").toString())
+            self.series_pairs = self.settings.value("SERIES_PAIRS", False).toBool()
             restore.guirestore(self, self.settings)
 
             ## Restore FITs header settings
@@ -501,10 +699,17 @@ class Controller(QtGui.QMainWindow, design.Ui_ccdcontroller):
             for key in self.settings.childKeys():
                 self.fitsinfo[str(key)] = str(self.settings.value(key).toString())
             self.settings.endGroup()
+
+            ## Restore rail settle time model
+            settle.load_settings("./settings.ini")
             
         except:
             self.logger.warning("Failed to restore past settings.")
             DATA_DIRECTORY = "./"
+            self.pipeline_depth = 2
+            self.scan_order = "weighted"
+            self.stack_combine = "none"
+            self.series_pairs = False
         else:
             self.logger.info("GUI display widget values successfully restored.")
             self.setDisplay()
@@ -521,162 +726,54 @@ class Controller(QtGui.QMainWindow, design.Ui_ccdcontroller):
             self.filterComboBox.setEnabled(False)
             self.monoSpinBox.setEnabled(True)
 
-    def scan(self, filename, data_dir, *args, **kwargs):
-        """Perform a scan over voltages provided by arguments."""
-
-        ## Get voltage parameters
-        vparams = args[0]
-        vname = vparams[0]
-        values = vparams[1]
-
-        result = True
-
-        ## Iterate through possible values
-        for value in values:
-
-            ## Check if scan interrupted
-            if not self.thread.status:
-                return False
-
-            ## Update the voltage value
-            new_voltage_dict = {vname : value}
-            self.setVoltages(new_voltage_dict, update_display=False)
-            kwargs[vname] = value
-
-            ## If voltage arguments remain, create nested scan
-            if len(args) > 1:
-                result = self.scan(filename, data_dir, *args[1:], **kwargs)
+    def setVoltages(self, new_voltage_dict=None, update_display=True, force=False):
+        """Change the value of the specified voltages using an input dictionary.
 
-            else:
-
-                ## Perform a single exposure and check for errors
-                self.logger.info("Starting EO Test exposures.")
-                print "filepath = exposure.eotest_acq"
-                time.sleep(1)
-                raise OSError('Test')
-                self.logger.info("Exposure finished successfully.")
-                self.image_taken.emit()
-
-                ## Perform FITs header corrections
-                try:
-                    print "exposure.update_header(filepath)"
-                except IOError:
-                    self.logger.exception("An error occurred while updating the FITs header.")
-
-            if result is False:
-                return False
-                    
-        return True
-                    
-    def setVoltages(self, new_voltage_dict=None, update_display=True):
-        """Change the value of the specified voltages using an input dictionary."""
+        Rails already at the requested value are skipped unless force is True.
+        Returns False if any requested rail was not set, otherwise True.
+        """
 
         ## If no voltage dictionary given, get values from GUI.
         if new_voltage_dict is None:
             new_voltage_dict = {str(self.voltageComboBox.currentText()) :
                                 float(self.voltageSpinBox.value())}
 
-        ## For each voltage, make call to executable
-        for vname, value in new_voltage_dict.iteritems():
-
-            if vname in ['VOD', 'VRD', 'VOG', 'VDD']:
-                
-                try:
-                    output = voltage.set_voltage(value, vname)
-                except subprocess.CalledProcessError:
-                    self.logger.exception("Error in executable {0}." +
-                                          " Voltage not changed.".format(vname))
-                    break
-                except OSError:
-                    self.logger.exception("Executable {0} not found." +
-                                          " Voltage not changed.".format(vname))
-                    break
-                else:
-                    self.logger.info(output)
-                    self.logger.info("Voltage {0} set to {1}".format(vname, value))
-                    lineedit = self.voltage_dict[vname][0]
-                    self.voltage_dict[vname] = (lineedit, value)
-
-            ## Parallel clocks
-            elif 'PAR' in vname:
-
-                if 'LO' in vname:
-                    par_lo = value
-                    par_hi = self.voltage_dict['PARHI'][1]
-                else:
-                    par_lo = self.voltage_dict['PARLO'][1]
-                    par_hi = value
-            
-                try:
-                    output = voltage.par_clks(par_lo, par_hi)
-                except subprocess.CalledProcessError:
-                    self.logger.exception("Error in executable par_clks." +
-                                          " Voltage not changed.")
-                    break
-                except OSError:
-                    self.logger.exception("Executable par_clks not found." +
-                                          " Voltage not changed.")
-                    break
-                else:
-                    self.logger.info(output)
-                    self.logger.info("Voltage {0} set to {1}".format(vname, value))
-                    lineedit = self.voltage_dict[vname][0]
-                    self.voltage_dict[vname] = (lineedit, value)
-
-            ## Serial clocks
-            elif 'SER' in vname:
-
-                if 'LO' in vname:
-                    ser_lo = value
-                    ser_hi = self.voltage_dict['SERHI'][1]
-                else:
-                    ser_lo = self.voltage_dict['SERLO'][1]
-                    ser_hi = value
-            
-                try:
-                    output = voltage.ser_clks(ser_lo, ser_hi)
-                except subprocess.CalledProcessError:
-                    self.logger.exception("Error in executable ser_clks." +
-                                          " Voltage not changed.")
-                    break
-                except OSError:
-                    self.logger.exception("Executable ser_clks not found." +
-                                          " Voltage not changed.")
-                    break
-                else:
-                    self.logger.info(output)
-                    self.logger.info("Voltage {0} set to {1}".format(vname, value))
-                    lineedit = self.voltage_dict[vname][0]
-                    self.voltage_dict[vname] = (lineedit, value)
-
-            ## Reset clocks
-            elif 'RG' in vname:
-
-                if 'LO' in vname:
-                    rg_lo = value
-                    rg_hi = self.voltage_dict['RGHI'][1]
-                else:
-                    rg_lo = self.voltage_dict['RGLO'][1]
-                    rg_hi = value
-            
-                try:
-                    output = voltage.rg(rg_lo, rg_hi)
-                except subprocess.CalledProcessError:
-                    self.logger.exception("Error in executable rg. Voltage not changed.")
-                    break
-                except OSError:
-                    self.logger.exception("Executable rg not found.  Voltage not changed.")
-                    break
-                else:
-                    self.logger.info(output)
-                    self.logger.info("Voltage {0} set to {1}".format(vname, value))
-                    lineedit = self.voltage_dict[vname][0]
-                    self.voltage_dict[vname] = (lineedit, value)
+        ## Send all rail changes to the voltage session in one round trip
+        success = True
+        try:
+            results = self.vsession.apply(new_voltage_dict, self.getVoltageValues(),
+                                          force=force)
+        except subprocess.CalledProcessError as e:
+            self.logger.exception("Error in executable {0}. Voltage not changed.".\
+                                  format(e.cmd[0]))
+            results = e.completed
+            success = False
+        except OSError as e:
+            self.logger.exception("{0} Voltage not changed.".format(e.strerror))
+            results = getattr(e, 'completed', [])
+            success = False
+        except KeyError:
+            self.logger.exception("Unknown voltage name. Voltages not changed.")
+            results = []
+            success = False
+
+        ## Record voltages that were changed successfully
+        changed = []
+        for vnames, output in results:
+            self.logger.debug(output)
+            for vname in vnames:
+                value = new_voltage_dict[vname]
+                changed.append("{0}={1}".format(vname, value))
+                lineedit = self.voltage_dict[vname][0]
+                self.voltage_dict[vname] = (lineedit, value)
+        if changed:
+            self.logger.info("Voltages set: {0}".format(", ".join(changed)))
 
         ## Optionally update the display
         if update_display:
             self.updateVoltageDisplay()
-            
+
+        return success
 
     def updateVoltageDisplay(self):
         """Updates voltage displays with the current values."""
@@ -726,6 +823,11 @@ class Controller(QtGui.QMainWindow, design.Ui_ccdcontroller):
             QtGui.QMessageBox.warning(self, "Warning.", "Exposure in progress, unable to close program.", QtGui.QMessageBox.Ok)
             event.ignore()
 
+        ## Wait for controller power-up to finish before shutting down
+        elif self.resetThread.isRunning():
+            QtGui.QMessageBox.warning(self, "Warning.", "Controller is powering up, unable to close program.", QtGui.QMessageBox.Ok)
+            event.ignore()
+
         ## Confirmation dialog for 
         else:
 
@@ -762,15 +864,30 @@ def safe_shutdown():
         logger.exception("Unable to turn off controller! State may be unknown.")
     else:
         logger.info("Controller turned off successfully.")
+
+    voltage.close_session()
+    backend.close_relay()
         
 def main():
 
+    parser = argparse.ArgumentParser(description="STA3800 CCD controller GUI")
+    parser.add_argument("-s", "--simulate", action="store_true",
+                        help="Use a simulated controller instead of the hardware")
+    parser.add_argument("-t", "--time-scale", type=float, default=1.0, metavar='',
+                        help="Scale simulated command latency (0 disables it)")
+    args, qt_args = parser.parse_known_args()
+
     ## Set up logging
     fileConfig("settings.ini")
     logger = logging.getLogger('sLogger')
 
+    ## Select simulated controller for development without hardware
+    if args.simulate:
+        backend.set_backend(backend.SimBackend(time_scale=args.time_scale))
+        logger.info("Using simulated STA3800 controller.")
+
     ## Set up GUI
-    app = QtGui.QApplication(sys.argv)
+    app = QtGui.QApplication(sys.argv[:1] + qt_args)
     form = Controller()
     form.show()
     app.exec_()
@@ -6,14 +6,18 @@ by changing voltages.
 """
 
 import sys
+import os
 import argparse
 import subprocess
+import json
+import hashlib
+import time
+from multiprocessing.pool import ThreadPool
 
 import voltage
 import exposure
-
-from time import sleep
-from Phidgets.Devices.InterfaceKit import InterfaceKit
+import backend
+import settle
 
 ## For Python 2.6 need to monkey patch in check_output()
 if "check_output" not in dir( subprocess ):
@@ -40,21 +44,21 @@ if "check_output" not in dir( subprocess ):
 def par_speed(speed):
     """Set parallel clock speed"""
 
-    output = subprocess.check_output(["par_speed", "{0}".format(speed)])
+    output = backend.run(["par_speed", "{0}".format(speed)])
     print output
     return output
     
 def patload(pat_file):
     """Convert and load a pattern file"""
     
-    output = subprocess.check_output(["patload", "{0}".format(pat_file)])
+    output = backend.run(["patload", "{0}".format(pat_file)])
     print output
     return output
 
 def sigload(sig_file):
     """Convert and load a signal file"""
 
-    output = subprocess.check_output(["sigload", "{0}".format(sig_file)])
+    output = backend.run(["sigload", "{0}".format(sig_file)])
     print output
     return output
 
@@ -65,56 +69,114 @@ def set_bbias(state):
                   "Off" : False}
     setting = state_dict[state]
 
-    ## Attach to Phidget controller
-    relay = InterfaceKit()
-    relay.openPhidget()
-    relay.waitForAttach(10000)
-
-    ## Check if successful
-    if relay.isAttached():
-        print "Done!"
-    else:
-        print "Failed to connect to Phidget controller"
-
-    ## Set output to 0 and close
-    relay.setOutputState(0, setting)
+    ## Set output 0 on the shared Phidget connection, attached on first use
+    backend.get_relay().set_output(0, setting)
     print "BSS is now {0}".format(state)
-    relay.closePhidget()
 
     return
 
+## ADC channel read out for each CCD segment
+CHAN_DICT = { 1 :  1,
+              2 :  5,
+              3 :  2,
+              4 :  6,
+              5 :  3,
+              6 :  7,
+              7 :  4,
+              8 :  8,
+              9 :  9,
+             10 : 13,
+             11 : 10,
+             12 : 14,
+             13 : 11,
+             14 : 15,
+             15 : 12,
+             16 : 16}
+
 def offset(chan, val):
     """Set channel to specified value"""
     
-    output = subprocess.check_output(["offset", "{0}".chan, "{0}".value])
+    output = backend.run(["offset", "{0}".format(chan), "{0}".format(val)])
     print output
     return output
 
 def seg_offset(seg, val):
     """Set segment channel to specified value"""
 
-    chan_dict = { 1 :  1,
-                  2 :  5,
-                  3 :  2,
-                  4 :  6,
-                  5 :  3,
-                  6 :  7,
-                  7 :  4,
-                  8 :  8,
-                  9 :  9,
-                 10 : 13,
-                 11 : 10,
-                 12 : 14,
-                 13 : 11,
-                 14 : 15,
-                 15 : 12,
-                 16 : 16}
-
-    chan = chan_dict[seg]
+    chan = CHAN_DICT[seg]
     offset(chan, val)
 
     return
 
+class OffsetResult(object):
+    """Outcome of programming the ADC offset of one segment."""
+
+    def __init__(self, seg, chan, value):
+
+        self.seg = seg
+        self.chan = chan
+        self.value = value
+        self.output = None
+        self.error = None
+        self.elapsed = 0.0
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __str__(self):
+
+        status = "ok" if self.ok else "FAILED ({0})".format(self.error)
+        return "Segment {0:2d} (channel {1:2d}) offset {2}: {3} in {4:.3f}s".\
+            format(self.seg, self.chan, self.value, status, self.elapsed)
+
+def set_offsets(settings, chan_dict=None, workers=4):
+    """Program the ADC offsets of many segments concurrently.
+
+    Settings is either a list of offsets for segments 1, 2, ... or a
+    dictionary keyed by segment.  Every segment is attempted; if any fail
+    the first error is raised with the results of all segments stored in
+    its results attribute.  Returns a list of OffsetResult.
+    """
+
+    if chan_dict is None:
+        chan_dict = CHAN_DICT
+
+    if not isinstance(settings, dict):
+        settings = dict((i+1, value) for i, value in enumerate(settings))
+
+    results = [OffsetResult(seg, chan_dict[seg], settings[seg])
+               for seg in sorted(settings)]
+
+    def program(result):
+        start = time.time()
+        try:
+            result.output = backend.run(["offset", "{0}".format(result.chan),
+                                         "{0}".format(result.value)])
+        except (subprocess.CalledProcessError, OSError) as e:
+            result.error = e
+        result.elapsed = time.time() - start
+        return result
+
+    ## Each channel is set by an independent command
+    if workers > 1 and len(results) > 1:
+        pool = ThreadPool(min(workers, len(results)))
+        try:
+            pool.map(program, results)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for result in results:
+            program(result)
+
+    for result in results:
+        if not result.ok:
+            result.error.results = results
+            raise result.error
+
+    return results
+
 ## Ignore for now, not used
 def bbs(num):
     pass
@@ -128,7 +190,7 @@ def bbs(num):
 def ch_setup():
     """Set up for generic 16 channel readout"""
 
-    output = subprocess.check_output("16ch_setup")
+    output = backend.run("16ch_setup")
     print output
     return output
 
@@ -146,45 +208,14 @@ def sta3800_timing():
 def sta3800_channels():
     """Set up for 16 channel readout"""
     
-    output = subprocess.check_output("sta3800_channels")
+    output = backend.run("sta3800_channels")
     print output
     return output
 
 def sta3800_volts():
     """Set the default voltages for the STA3800 device"""
 
-    voltage.v_clk(0.0, 10.0)
-
-    ## For use with Kirk's switch BBS supply
-    sleep(0.5)
-    set_bbias("Off")
-    # bss(0.0) # For use with separate BSS supply
-
-    ## Set VDD
-    voltage.set_voltage(19.0, "vdd")
-    sleep(0.5)
-
-    ## Set VRD
-    voltage.set_voltage(13.0, "vrd")
-    sleep(0.5)
-    
-    ## Set VOD
-    voltage.set_voltage(25.00, "vod")
-    sleep(0.5)
-
-    ## Set VOG
-    voltage.set_voltage(0.0, "vog")
-    sleep(0.5)
-
-    ## Set clocks
-    voltage.par_clks(-8.00, 4.00)
-    voltage.ser_clks(-4.00, 6.00)
-    voltage.rg(-2.00, 8.00)
-    sleep(0.5)
-
-    ## For use with Kirk's switch BBS suply
-    set_bbias("On")
-    # bss(0.0) # For use with separate BSS supply
+    apply_voltages(sta3800_state()["voltages"])
 
     return
 
@@ -194,24 +225,34 @@ def sta3800_offset():
     setting_list = [4008, 3488, 3209, 4031, 4008, 4007, 3600, 136,
                     3993, 2703, 4002, 4012, 84, 4000, 3765, 4043]
 
-    for i in range(16):
-        seg_offset(i+1, setting_list[i])
+    try:
+        results = set_offsets(setting_list)
+    except (subprocess.CalledProcessError, OSError) as e:
+        for result in e.results:
+            print result
+        raise
 
-    return
+    for result in results:
+        print result
+
+    return results
 
 def gain(mode):
     """Set the gain of the SAO controller to either high or low mode"""
 
-    output = subprocess.check_output(["gain", "{0}".format(mode)])
+    output = backend.run(["gain", "{0}".format(mode)])
     print output
     return output
     
 
 def sta3800_setup(use_bash=True):
 
+    ## The bash script's values are not known here, so forget the state
     if use_bash:
-        output = subprocess.check_output("sta3800_setup")
+        output = backend.run("sta3800_setup")
         print output
+        get_setup().invalidate()
+        voltage.invalidate()
         return output
 
     ch_setup()
@@ -221,15 +262,277 @@ def sta3800_setup(use_bash=True):
     sta3800_volts()
     sta3800_offset()
     gain("high")
+    get_setup().record(sta3800_state())
 
 def sta3800_off(use_bash=True):
 
     if use_bash:
         print "Turning off the sta3800 system."
-        output = subprocess.check_output("sta3800_off")
+        output = backend.run("sta3800_off")
         print output
+        get_setup().invalidate()
+        voltage.invalidate()
         return
 
+###############################################################################
+##
+##  Incremental Set-up
+##
+###############################################################################
+
+## Last applied controller state, kept between program runs
+STATE_FILE = os.path.join(os.path.expanduser("~"), ".sta3800_state.json")
+
+## Set-up sections in the order they are applied; 16 channel readout set-up
+## resets the controller, so re-applying it re-applies every other section
+SECTIONS = ["readout", "timing", "channels", "voltages", "offsets", "gain"]
+
+def file_hash(filepath):
+    """MD5 hash of a timing file, or None if it cannot be read."""
+
+    try:
+        with open(filepath, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+    except IOError:
+        return None
+
+def sta3800_state():
+    """Desired controller state applied by sta3800_setup."""
+
+    return {"readout" : "16ch",
+            "timing" : {"par_speed" : 6,
+                        "sig_file" : "sta3800a.sig",
+                        "sig_hash" : file_hash("sta3800a.sig"),
+                        "pat_file" : "sta3800a.pat",
+                        "pat_hash" : file_hash("sta3800a.pat")},
+            "channels" : "sta3800",
+            "voltages" : {"VDD" : 19.0,
+                          "VRD" : 13.0,
+                          "VOD" : 25.0,
+                          "VOG" : 0.0,
+                          "PARLO" : -8.0,
+                          "PARHI" : 4.0,
+                          "SERLO" : -4.0,
+                          "SERHI" : 6.0,
+                          "RGLO" : -2.0,
+                          "RGHI" : 8.0},
+            "offsets" : [4008, 3488, 3209, 4031, 4008, 4007, 3600, 136,
+                         3993, 2703, 4002, 4012, 84, 4000, 3765, 4043],
+            "gain" : "high"}
+
+def apply_timing(timing, applied=None):
+    """Set parallel speed and load signal and pattern files that changed."""
+
+    if applied is None:
+        applied = {}
+
+    if timing["par_speed"] != applied.get("par_speed"):
+        par_speed(timing["par_speed"])
+
+    for kind, load in [("sig", sigload), ("pat", patload)]:
+        keys = [kind + "_file", kind + "_hash"]
+        if [timing[key] for key in keys] != [applied.get(key) for key in keys]:
+            load(timing[kind + "_file"])
+
+def apply_voltages(voltages, applied=None):
+    """Set rails that changed, with the back bias off while they change.
+
+    Without applied voltages the DC rails are powered up in order, each
+    settling before the next.  Otherwise changed rails are set together
+    and only the slowest is waited for.
+    """
+
+    power_up = applied is None
+    if power_up:
+        applied = {}
+
+    changed = dict((vname, value) for vname, value in voltages.items()
+                   if applied.get(vname) != value)
+
+    voltage.v_clk(0.0, 10.0)
+    settle.changed({"VCLK" : 10.0})
+
+    ## For use with Kirk's switch BBS supply
+    settle.wait()
+    set_bbias("Off")
+    # bss(0.0) # For use with separate BSS supply
+
+    for vname in ["VDD", "VRD", "VOD", "VOG"]:
+        if vname in changed:
+            voltage.set_voltage(changed[vname], vname)
+            if power_up:
+                settle.wait()
+
+    ## Clock rails are set in pairs
+    clocks = [("PAR", voltage.par_clks), ("SER", voltage.ser_clks), ("RG", voltage.rg)]
+    for prefix, set_clks in clocks:
+        if prefix + "LO" in changed or prefix + "HI" in changed:
+            set_clks(voltages[prefix + "LO"], voltages[prefix + "HI"])
+    settle.wait()
+
+    ## For use with Kirk's switch BBS suply
+    set_bbias("On")
+    # bss(0.0) # For use with separate BSS supply
+
+def apply_offsets(offsets, applied=None):
+    """Set ADC offsets of segments that changed."""
+
+    if applied is None:
+        applied = [None]*len(offsets)
+
+    changed = dict((i+1, value) for i, value in enumerate(offsets)
+                   if value != applied[i])
+    if changed:
+        set_offsets(changed)
+
+class ControllerSetup(object):
+    """Desired-state set-up of the controller.
+
+    The last applied state is recorded after each section is set, so a
+    reconcile only runs the commands for sections that differ.  Rails set
+    outside a reconcile are recorded too, so the next reconcile puts them
+    back.  An unknown state (no record, or after sta3800_off) is set up
+    from scratch.
+    """
+
+    def __init__(self, filepath=None):
+
+        self.filepath = filepath
+        self.applied = self.load()
+
+    def load(self):
+        """Read the last applied state, empty if unknown."""
+
+        if self.filepath is None:
+            return {}
+
+        try:
+            with open(self.filepath) as f:
+                applied = json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+        return applied if isinstance(applied, dict) else {}
+
+    def save(self):
+
+        if self.filepath is None:
+            return
+
+        tmppath = self.filepath + ".tmp"
+        with open(tmppath, 'w') as f:
+            json.dump(self.applied, f, indent=2, sort_keys=True)
+        os.rename(tmppath, self.filepath)
+
+    def record(self, state, sections=None):
+        """Record sections of a state as applied."""
+
+        if sections is None:
+            sections = SECTIONS
+        for section in sections:
+            self.applied[section] = state[section]
+        self.save()
+
+    def record_voltages(self, voltage_dict):
+        """Record rails set outside a reconcile, e.g. by a voltage scan.
+
+        Nothing is recorded while the applied voltages are unknown.
+        """
+
+        if "voltages" not in self.applied:
+            return
+
+        voltages = dict(self.applied["voltages"])
+        for vname, value in voltage_dict.items():
+            voltages[vname.upper()] = float(value)
+        self.applied["voltages"] = voltages
+        self.save()
+
+    def invalidate(self):
+        """Forget the applied state, e.g. after the controller is turned off."""
+
+        self.applied = {}
+        self.save()
+
+    def diff(self, state):
+        """Return the sections that need to be applied, in order."""
+
+        if self.applied.get("readout") != state["readout"]:
+            return list(SECTIONS)
+
+        return [section for section in SECTIONS
+                if self.applied.get(section) != state[section]]
+
+    def reconcile(self, state=None):
+        """Apply only the parts of a desired state that differ.
+
+        Returns the list of sections applied.
+        """
+
+        if state is None:
+            state = sta3800_state()
+
+        ## From an unknown state use the Python set-up, which records what it applied
+        if not self.applied:
+            sta3800_setup(use_bash=False)
+            return list(SECTIONS)
+
+        sections = self.diff(state)
+
+        ## Within a section only changed settings are applied, unless reset
+        for section in sections:
+
+            if "readout" in sections:
+                applied = None
+            else:
+                applied = self.applied.get(section)
+
+            if section == "readout":
+                ch_setup()
+            elif section == "timing":
+                apply_timing(state["timing"], applied)
+            elif section == "channels":
+                sta3800_channels()
+            elif section == "voltages":
+                apply_voltages(state["voltages"], applied)
+            elif section == "offsets":
+                apply_offsets(state["offsets"], applied)
+            elif section == "gain":
+                gain(state["gain"])
+
+            self.record(state, [section])
+
+        ## Rails are at the set-up values, including any left from a past run
+        voltage.seed(state["voltages"])
+
+        return sections
+
+_setup = None
+
+def get_setup():
+    """Return the controller set-up state for the current backend.
+
+    The state of a simulated controller is not kept between runs.
+    """
+
+    global _setup
+
+    if _setup is None:
+        if backend.get_backend().simulated:
+            _setup = ControllerSetup()
+        else:
+            _setup = ControllerSetup(STATE_FILE)
+
+    return _setup
+
+def sta3800_reconcile():
+    """Bring the controller to the STA3800 set-up, running only what changed."""
+
+    return get_setup().reconcile(sta3800_state())
+
+## Rails changed after set-up are put back by the next reconcile
+voltage.add_listener(lambda voltage_dict: get_setup().record_voltages(voltage_dict))
+
 
 ###############################################################################
 ##
@@ -189,6 +189,10 @@ class Ui_ccdcontroller(object):
         self.paramfileButton = QtGui.QPushButton(self.layoutWidget)
         self.paramfileButton.setObjectName(_fromUtf8("paramfileButton"))
         self.gridLayout.addWidget(self.paramfileButton, 10, 7, 1, 1)
+        self.resumeButton = QtGui.QPushButton(self.layoutWidget)
+        self.resumeButton.setEnabled(False)
+        self.resumeButton.setObjectName(_fromUtf8("resumeButton"))
+        self.gridLayout.addWidget(self.resumeButton, 8, 0, 1, 1)
         self.tabWidget.addTab(self.exposurePage, _fromUtf8(""))
         self.voltagePage = QtGui.QWidget()
         self.voltagePage.setObjectName(_fromUtf8("voltagePage"))
@@ -377,6 +381,7 @@ class Ui_ccdcontroller(object):
         self.directoryPushButton.setText(_translate("ccdcontroller", "Change Directory", None))
         self.paramfileLabel.setText(_translate("ccdcontroller", "Parameters File:", None))
         self.paramfileButton.setText(_translate("ccdcontroller", "Select File", None))
+        self.resumeButton.setText(_translate("ccdcontroller", "Resume Scan", None))
         self.tabWidget.setTabText(self.tabWidget.indexOf(self.exposurePage), _translate("ccdcontroller", "Exposure", None))
         self.vrdLabel.setText(_translate("ccdcontroller", "VRD", None))
         self.parhiLineEdit.setText(_translate("ccdcontroller", "0.00", None))
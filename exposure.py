@@ -14,6 +14,8 @@ import math
 import pytz
 
 import voltage
+import backend
+import fitsheader
 
 ## Import astropy.io.fits or pyfits
 try:
@@ -118,11 +120,11 @@ def im_acq(mode, filebase="test", exptime=0.00, seqnum=1,
 
     ## Do exposure depending on specified mode
     if mode in ["exp", "flat"]:
-        output = subprocess.check_output(["exp_acq", "{0}".format(exptime),
-                                          "{0}".format(filepath)])
-    elif mode in ['bias', 'dark', 'fe55']:
-        output = subprocess.check_output(["dark_acq", "{0}".format(exptime),
-                                          "{0}".format(filepath)])
+        output = backend.run(["exp_acq", "{0}".format(exptime),
+                              "{0}".format(filepath)])
+    elif mode in ['bias', 'dark', 'fe55', 'scan']:
+        output = backend.run(["dark_acq", "{0}".format(exptime),
+                              "{0}".format(filepath)])
 
     return filepath
 
@@ -180,13 +182,78 @@ def datetime_to_jd(date):
     
     return date_to_jd(date.year,date.month,days)
 
+## Rendered header cards shared between images
+_template = fitsheader.HeaderTemplate()
+_segment_cards = {}
+
+def segment_cards(naxis1=512, naxis2=2002):
+    """Return IRAF keywords for each segment header, keyed by extension.
+
+    Keywords depend only on the detector geometry, so they are computed
+    once per geometry.
+    """
+
+    geometry = (naxis1, naxis2)
+    if geometry in _segment_cards:
+        return _segment_cards[geometry]
+
+    cards = {}
+    for i in range(16):
+        imext = i+1
+
+        if i < 8:
+            ax1min = (i+1)*naxis1
+            ax1max = i*naxis1 + 1
+            ax2min = 1
+            ax2max = naxis2
+
+        else:
+            ax1min = (16-i)*naxis1
+            ax1max = (15-i)*naxis1+1
+            ax2min = naxis2*2
+            ax2max = naxis2 + 1
+
+        detsec = '[{0}:{1}, {2}:{3}]'.format(ax1min, ax1max, ax2min, ax2max)
+        cards[imext] = [('DETSIZE', '[1:{0}, 1:{1}]'.format(8*naxis1, 2*naxis2), None),
+                        ('DATASEC', '[11:{0}, 1:{1}]'.format(naxis1+10, naxis2), None),
+                        ('BIASSEC', '[{0}:{1}, 1:{2}]'.format(naxis1+11, naxis1+30, naxis2),
+                         None),
+                        ('DETSEC', detsec, None)]
+
+    _segment_cards[geometry] = cards
+    return cards
+
+def conditions_cards(**kwargs):
+    """Return CCD_COND keywords for the voltages in kwargs."""
+
+    cards = []
+    for i in range(16):
+        cards.append(('V_OD{0}'.format(i+1), kwargs.get('VOD', 0.0), None))
+        cards.append(('V_OG{0}'.format(i+1), kwargs.get('VOG', 0.0), None))
+        cards.append(('V_RD{0}'.format(i+1), kwargs.get('VRD', 0.0), None))
+
+        if i <= 3:
+            cards.append(('V_S{0}L'.format(i+1), kwargs.get('SERLO', 0.0), None))
+            cards.append(('V_S{0}H'.format(i+1), kwargs.get('SERHI', 0.0), None))
+            cards.append(('V_P{0}L'.format(i+1), kwargs.get('PARLO', 0.0), None))
+            cards.append(('V_P{0}H'.format(i+1), kwargs.get('PARHI', 0.0), None))
+
+    cards.append(('V_GD', kwargs.get('VGD', 0.0), None)) ## What is this? VDD?
+    cards.append(('V_BSS', kwargs.get('VBB', 0.0), None))
+    cards.append(('V_RGL', kwargs.get('RGLO', 0.0), None))
+    cards.append(('V_RGH', kwargs.get('RGHI', 0.0), None))
+
+    return cards
+
 def update_header(filepath, mode, exptime, seqnum, **kwargs):
 
     ## Exposure dependent kwargs
     filename = filepath
     if mode in ['bias', 'dark']:
         testtype = 'dark'
-    elif mode == "exp":
+    elif mode in ['flat', 'fe55']:
+        testtype = mode
+    else:
         testtype = 'obs'
     imgtype = mode.upper()
     seqnum = seqnum
@@ -226,62 +293,45 @@ def update_header(filepath, mode, exptime, seqnum, **kwargs):
     detsize = kwargs.get('detsize', "[1:4336,1:4044]")
     origin = kwargs.get('origin', "Stanford")
 
-    ## Construct ccd conditions extensions.  Requires astropy python package
-    ccdhdr = fits.Header()
-
-    for i in range(16):
-        ccdhdr['V_OD{0}'.format(i+1)] = kwargs.get('VOD', 0.0)
-        ccdhdr['V_OG{0}'.format(i+1)] = kwargs.get('VOG', 0.0)
-        ccdhdr['V_RD{0}'.format(i+1)] = kwargs.get('VRD', 0.0)
-
-        if i <= 3:
-            ccdhdr['V_S{0}L'.format(i+1)] = kwargs.get('SER LO', 0.0)
-            ccdhdr['V_S{0}H'.format(i+1)] = kwargs.get('SER HI', 0.0)
-            ccdhdr['V_P{0}L'.format(i+1)] = kwargs.get('PAR LO', 0.0)
-            ccdhdr['V_P{0}H'.format(i+1)] = kwargs.get('PAR HI', 0.0)
-                   
-    ccdhdr['V_GD'] = kwargs.get('VGD', 0.0) ## What is this? VDD?
-    ccdhdr['V_BSS'] = kwargs.get('VBB', 0.0)
-    ccdhdr['V_RGL'] = kwargs.get('RG LO', 0.0)
-    ccdhdr['V_RGH'] = kwargs.get('RG HI', 0.0)
-    
-    ccdhdu = fits.ImageHDU(data=None, header=ccdhdr, name='CCD_COND')
-    ccdhdu.add_checksum()
-
-    ## Update fits header
-    hdulist = fits.open(filepath, mode='update')
-    prihdr = hdulist[0].header
-    prihdr['IMAGETAG'] = (imagetag, 'Image tag (CCS/VST)')
-    prihdr['TSTAND'] = (tstand, 'Test stand used.')
-    prihdr['INSTRUME'] = (instrument, 'CCD Controller type')
-    prihdr['CONTROLL'] = (controller, 'Duplicates INSTRUME')
-    prihdr['CONTNUM'] = (int(contnum), 'CCD Controller Serial Number')
-    prihdr['CCD_MANU'] = (ccd_manu, 'CCD Manufacturer')
-    prihdr['CCD_TYPE'] = (ccd_type, 'CCD Model Number')
-    prihdr['CCD_SERN'] = (ccd_sern, "Manufacturers' CCD Serial Number")
-    prihdr['LSST_NUM']= (lsst_num, 'LSST Assigned CCD Number')
-    prihdr['TESTTYPE'] = (testtype, 'dark:fe55:flat:lambda:spot:sflat_nnn:trap')
-    prihdr['IMGTYPE'] = (imgtype, 'BIAS, DARK, ...')
-    prihdr['SEQNUM'] = (int(seqnum), 'Sequence number')
-    prihdr['TEMP_SET'] = (float(temp_set), 'Temperature set point')
-    prihdr['CCDTEMP'] = (float(ccdtemp), 'Measured temperature')
-    prihdr['MONDIODE'] = (float(mondiode), 'Current in monitoring diode')
-    prihdr['MONOWL'] = (float(monowl), 'Monochromator wavelength')
-    prihdr['FILTER'] = (filter_name, 'Name of the filter')
-    prihdr['EXPTIME'] = (float(exptime), 'Exposure Time in Seconds')
-    prihdr['SHUT_DEL'] = (float(shut_del), 'Shutter delay')
-    prihdr['CTRLCFG'] = (ctrlcfg, 'CCD controller configuration file')
-    prihdr['FILENAME'] = (os.path.split(filename)[1], 'Original name of the file')
-    prihdr['BINX'] = (binx, '[pixels] binning along X axis')
-    prihdr['BINY'] = (biny, '[pixels] binning along Y axis')
-    prihdr['HEADVER'] = (int(headver), 'Version number of header')
-    prihdr['CCDGAIN'] = (float(ccdgain), 'Rough guess at overall system gain')
-    prihdr['CCDNOISE'] = (float(ccdnoise), 'Rough guess at system noise')
-    prihdr['DETSIZE'] = (detsize, 'Unbinned det size')
-    prihdr['ORIGIN'] = (origin, 'Site where data acquired')
+    ## Construct ccd conditions extension from cached card images
+    ccdhdu = _template.extension(conditions_cards(**kwargs), 'CCD_COND')
+
+    ## Primary header keywords
+    prihdr_cards = [('IMAGETAG', imagetag, 'Image tag (CCS/VST)'),
+                    ('TSTAND', tstand, 'Test stand used.'),
+                    ('INSTRUME', instrument, 'CCD Controller type'),
+                    ('CONTROLL', controller, 'Duplicates INSTRUME'),
+                    ('CONTNUM', int(contnum), 'CCD Controller Serial Number'),
+                    ('CCD_MANU', ccd_manu, 'CCD Manufacturer'),
+                    ('CCD_TYPE', ccd_type, 'CCD Model Number'),
+                    ('CCD_SERN', ccd_sern, "Manufacturers' CCD Serial Number"),
+                    ('LSST_NUM', lsst_num, 'LSST Assigned CCD Number'),
+                    ('TESTTYPE', testtype, 'dark:fe55:flat:lambda:spot:sflat_nnn:trap'),
+                    ('IMGTYPE', imgtype, 'BIAS, DARK, ...'),
+                    ('SEQNUM', int(seqnum), 'Sequence number'),
+                    ('TEMP_SET', float(temp_set), 'Temperature set point'),
+                    ('CCDTEMP', float(ccdtemp), 'Measured temperature'),
+                    ('MONDIODE', float(mondiode), 'Current in monitoring diode'),
+                    ('MONOWL', float(monowl), 'Monochromator wavelength'),
+                    ('FILTER', filter_name, 'Name of the filter'),
+                    ('EXPTIME', float(exptime), 'Exposure Time in Seconds'),
+                    ('SHUT_DEL', float(shut_del), 'Shutter delay'),
+                    ('CTRLCFG', ctrlcfg, 'CCD controller configuration file'),
+                    ('FILENAME', os.path.split(filename)[1], 'Original name of the file'),
+                    ('BINX', binx, '[pixels] binning along X axis'),
+                    ('BINY', biny, '[pixels] binning along Y axis'),
+                    ('HEADVER', int(headver), 'Version number of header'),
+                    ('CCDGAIN', float(ccdgain), 'Rough guess at overall system gain'),
+                    ('CCDNOISE', float(ccdnoise), 'Rough guess at system noise'),
+                    ('DETSIZE', detsize, 'Unbinned det size'),
+                    ('ORIGIN', origin, 'Site where data acquired')]
+
+    ## Read headers without loading image data
+    with open(filepath, 'rb') as f:
+        headers = fitsheader.read_headers(f)
     
     ## Add properly formated Date information to FITs header
-    date_str = prihdr['DATE']
+    date_str = headers[0].header['DATE']
     dt = datetime.strptime(date_str, '%a %b %d %H:%M:%S %Z %Y')
     local = pytz.timezone('GMT')
     local_dt = local.localize(dt, is_dst=None)
@@ -292,40 +342,21 @@ def update_header(filepath, mode, exptime, seqnum, **kwargs):
     date_mjd = datetime_to_jd(utc_dt)
     date_obs_utc = utc_dt_obs.strftime('%Y-%m-%dT%H:%M:%S.000')
 
-    prihdr['DATE-OBS'] = (date_utc, 'Date of the observation')
-    prihdr['DATE'] = (date_obs_utc, 'Creation Date and Time of File')
-    prihdr['MJD'] = (float('{0:.5f}'.format(date_mjd)), 
-                     'Modified Julian Date of image acquisition')
-
-    ## Update IRAF keywords in each segment header
-    for i in range(16):
-        imext = i+1
-        naxis1 = 512
-        naxis2 = 2002
-
-        if i < 8:
-            ax1min = (i+1)*naxis1
-            ax1max = i*naxis1 + 1
-            ax2min = 1
-            ax2max = naxis2
+    prihdr_cards += [('DATE-OBS', date_utc, 'Date of the observation'),
+                     ('DATE', date_obs_utc, 'Creation Date and Time of File'),
+                     ('MJD', float('{0:.5f}'.format(date_mjd)),
+                      'Modified Julian Date of image acquisition')]
 
-        else:
-            ax1min = (16-i)*naxis1
-            ax1max = (15-i)*naxis1+1
-            ax2min = naxis2*2
-            ax2max = naxis2 + 1
+    updates = {0 : prihdr_cards}
+    removes = {}
 
-        hdu[imext].header['DETSIZE'] = '[1:4096, 1:4004]'
-        hdu[imext].header['DATASEC'] = '[11:522, 1:2002]'
-        hdu[imext].header['BIASSEC'] = '[523:542, 1:2002]'
-        detsec = '[{0}:{1}, {2}:{3}]'.format(ax1min, ax1max, ax2min, ax2max)
-        hdu[imext].header['DETSEC'] = detsec
-        hdu[imext].header.remove('CCDSEC')
-        hdu[imext].header.remove('TRIMSEC')
+    ## Update IRAF keywords in each segment header
+    for imext, cards in segment_cards().items():
+        updates[imext] = cards
+        removes[imext] = ['CCDSEC', 'TRIMSEC']
 
-    hdulist.append(ccdhdu)
-    hdulist.flush()
-    hdulist.close()
+    ## Patch headers in place, only rewriting the file if they do not fit
+    fitsheader.update(filepath, updates, removes, append=[ccdhdu], template=_template)
 
 ###############################################################################
 ##
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+"""This is a Python module to find Fe55 X-ray hits and measure gain and CTE.
+
+Each segment of an Fe55 image has its overscan bias subtracted and pixels
+above a multiple of the read noise are grouped into hits by connected
+component labelling.  The charge of compact hits is histogrammed to find
+the K-alpha and K-beta peaks, which give the gain, and the amplitude of
+single pixel K-alpha hits across the segment gives the serial and parallel
+charge transfer efficiency.  A 16 segment image is analysed in a fraction
+of a second, so gain can be followed during a run.
+
+Hits are labelled with scipy, which is only imported when an Fe55 image is
+analysed, so other acquisitions do not need it.
+"""
+
+import os
+import logging
+import argparse
+
+import numpy as np
+
+import fitsimage
+import quicklook
+
+## Fe55 X-ray charge in electrons, 5.9 and 6.5 keV at 3.65 eV per electron
+KALPHA_ELECTRONS = 1620.0
+KBETA_ELECTRONS = 1778.0
+
+## Pixels more than this many sigma of read noise above the bias are in hits
+THRESHOLD_SIGMA = 5.0
+
+## Hits larger than this many pixels are cosmic rays or overlapping hits
+MAX_HIT_PIXELS = 9
+
+## Fractional half width of the window around each peak
+PEAK_WINDOW = 0.05
+
+## Fewest single pixel K-alpha hits to fit CTE
+MIN_CTE_HITS = 20
+
+## Connectivity of pixels in a hit, including diagonals
+STRUCTURE = np.ones((3, 3), dtype=bool)
+
+###############################################################################
+##
+##  X-ray Hits
+##
+###############################################################################
+
+class Fe55Result(object):
+    """Fe55 analysis of one amplifier segment.
+
+    Peaks are in ADU and gain in e-/ADU; values that could not be measured
+    are None.
+    """
+
+    def __init__(self, extname, hits, kalpha=None, kbeta=None, serial_cte=None,
+                 parallel_cte=None):
+
+        self.extname = extname
+        self.hits = hits
+        self.kalpha = kalpha
+        self.kbeta = kbeta
+        self.serial_cte = serial_cte
+        self.parallel_cte = parallel_cte
+
+    @property
+    def gain(self):
+
+        if not self.kalpha:
+            return None
+        return KALPHA_ELECTRONS/self.kalpha
+
+    def as_dict(self):
+
+        return {"extname" : self.extname, "hits" : self.hits, "kalpha" : self.kalpha,
+                "kbeta" : self.kbeta, "gain" : self.gain, "serial_cte" : self.serial_cte,
+                "parallel_cte" : self.parallel_cte}
+
+    def __str__(self):
+
+        def show(value, form):
+            return "-" if value is None else form.format(value)
+
+        return "{0:>10s} hits {1:5d}  K-alpha {2:>7s}  K-beta {3:>7s}  gain {4:>6s}  " \
+            "CTE serial {5:>9s} parallel {6:>9s}".format(
+                self.extname, self.hits, show(self.kalpha, "{0:.1f}"),
+                show(self.kbeta, "{0:.1f}"), show(self.gain, "{0:.3f}"),
+                show(self.serial_cte, "{0:.6f}"), show(self.parallel_cte, "{0:.6f}"))
+
+def find_hits(image, noise, nsigma=THRESHOLD_SIGMA):
+    """Find X-ray hits in a bias subtracted image.
+
+    Returns arrays of the charge, number of pixels, peak value and peak
+    row and column of each hit.
+    """
+
+    from scipy import ndimage
+
+    mask = image > nsigma*max(noise, 1.0)
+    labels, num_hits = ndimage.label(mask, structure=STRUCTURE)
+
+    ## Only pixels in hits are used, sorted by hit and then by value
+    rows, cols = np.nonzero(mask)
+    hit = labels[rows, cols] - 1
+    values = image[rows, cols]
+
+    charge = np.bincount(hit, weights=values, minlength=num_hits)
+    npixels = np.bincount(hit, minlength=num_hits)
+
+    ## Brightest pixel of each hit is the last of its group
+    order = np.lexsort((values, hit))
+    last = order[np.cumsum(npixels) - 1]
+
+    return charge, npixels, values[last], rows[last], cols[last]
+
+def peak(values, low=None, high=None, bins=200):
+    """Position of the most populated peak of a histogram of values.
+
+    The histogram mode is refined with the median of values within
+    PEAK_WINDOW of it.  Returns None if there are no values.
+    """
+
+    if low is not None:
+        values = values[values >= low]
+    if high is not None:
+        values = values[values <= high]
+    if len(values) == 0:
+        return None
+
+    counts, edges = np.histogram(values, bins=bins)
+    mode = 0.5*(edges[counts.argmax()] + edges[counts.argmax()+1])
+    near = values[np.abs(values - mode) <= PEAK_WINDOW*mode]
+
+    return float(np.median(near)) if len(near) else float(mode)
+
+def transfer_efficiency(amplitudes, transfers):
+    """Charge transfer efficiency from hit amplitudes after a number of transfers.
+
+    Fits amplitude = A*(1 - CTI*transfers) and returns 1 - CTI, or None
+    with too few hits.
+    """
+
+    if len(amplitudes) < MIN_CTE_HITS or np.ptp(transfers) == 0:
+        return None
+
+    slope, intercept = np.polyfit(transfers, amplitudes, 1)
+    return float(1.0 + slope/intercept)
+
+def segment_fe55(image, noise, extname=""):
+    """Analyse the bias subtracted image area of one segment.
+
+    Pixel transfers are counted from the first row and column of the
+    image area, which are nearest the output amplifier.
+    """
+
+    charge, npixels, peaks, rows, cols = find_hits(image, noise)
+    compact = npixels <= MAX_HIT_PIXELS
+    result = Fe55Result(extname, int(compact.sum()))
+
+    ## K-alpha is the strongest line, K-beta is expected 10% above it
+    kalpha = peak(charge[compact], low=0.0)
+    if kalpha is None:
+        return result
+    result.kalpha = kalpha
+
+    ratio = KBETA_ELECTRONS/KALPHA_ELECTRONS
+    kbeta_low = kalpha*(1 + PEAK_WINDOW)
+    kbeta_high = kalpha*(2*ratio - 1 - PEAK_WINDOW)
+    if np.count_nonzero((charge >= kbeta_low) & (charge <= kbeta_high) & compact):
+        result.kbeta = peak(charge[compact], kbeta_low, kbeta_high, bins=20)
+
+    ## Single pixel K-alpha hits keep all their charge in one pixel
+    single = (npixels == 1) & (np.abs(peaks - kalpha) <= 2*PEAK_WINDOW*kalpha)
+    result.serial_cte = transfer_efficiency(peaks[single], cols[single] + 1)
+    result.parallel_cte = transfer_efficiency(peaks[single], rows[single] + 1)
+
+    return result
+
+def frame_fe55(filepath, stats=None):
+    """Analyse every segment of an Fe55 image.
+
+    Stats may give the quick-look statistics of the image, so the bias and
+    read noise are not measured again.
+    """
+
+    results = []
+    with fitsimage.FitsImage(filepath) as image:
+        segments = [segment for segment in image if 'BIASSEC' in segment.header]
+        if stats is None or len(stats) != len(segments):
+            stats = [quicklook.segment_stats(segment.pixels('DATASEC'),
+                                             segment.pixels('BIASSEC'), segment.extname)
+                     for segment in segments]
+
+        for segment, seg in zip(segments, stats):
+            data = segment.pixels('DATASEC').astype(np.float32) - np.float32(seg.bias)
+            results.append(segment_fe55(data, seg.noise, segment.extname))
+
+    return results
+
+def summarize(results):
+    """One line summary of a frame, with the median over segments."""
+
+    def middle(name):
+        values = [getattr(result, name) for result in results]
+        values = [value for value in values if value is not None]
+        return np.median(values) if values else float('nan')
+
+    return "{0} hits, gain {1:.3f} e-/ADU, CTE serial {2:.6f} parallel {3:.6f} " \
+        "({4} segments)".format(sum(result.hits for result in results), middle("gain"),
+                                middle("serial_cte"), middle("parallel_cte"), len(results))
+
+###############################################################################
+##
+##  Pipeline Stage
+##
+###############################################################################
+
+def fe55_stage(frame):
+    """Pipeline stage analysing the X-ray hits of an Fe55 image."""
+
+    logger = logging.getLogger("sLogger")
+
+    results = frame_fe55(frame.filepath, frame.results.get(quicklook.STAGE_NAME))
+    logger.info("Fe55 {0}: {1}".format(os.path.split(frame.filepath)[1],
+                                       summarize(results)))
+    for result in results:
+        logger.debug(str(result))
+
+    return results
+
+###############################################################################
+##
+##  Main Function and Argument Parser
+##
+###############################################################################
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Gain and CTE from Fe55 CCD images",
+                                     prog='CCD Fe55')
+    parser.add_argument("filepaths", nargs="+", help="FITs images")
+    args = parser.parse_args()
+
+    for filepath in args.filepaths:
+        results = frame_fe55(filepath)
+        print "{0}: {1}".format(filepath, summarize(results))
+        for result in results:
+            print result
+
+if __name__ == '__main__':
+
+    main()
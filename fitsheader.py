@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+
+"""This is a Python module to update FITs headers without rewriting images.
+
+Keywords are patched into the free space left in each header's 2880 byte
+blocks (blank cards and padding), and new HDUs are appended at the end of
+the file, so only a few kilobytes of the file are written.  Headers with
+no room left are updated by rewriting the file.  CHECKSUM keywords are
+kept valid either way.
+"""
+
+import os
+
+import numpy as np
+
+## Import astropy.io.fits or pyfits
+try:
+    from astropy.io import fits
+except ImportError:
+    import pyfits as fits
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+END_CARD = "END" + " "*(CARD_SIZE - 3)
+BLANK_CARD = " "*CARD_SIZE
+
+###############################################################################
+##
+##  Header Layout
+##
+###############################################################################
+
+class HeaderInfo(object):
+    """Location of one HDU's header and data within a FITs file."""
+
+    def __init__(self, offset, cards, nblocks):
+
+        self.offset = offset
+        self.cards = cards
+        self.nblocks = nblocks
+        self.header = fits.Header.fromstring("".join(cards))
+
+        self.data_offset = offset + nblocks*BLOCK_SIZE
+        self.data_size = data_size(self.header)
+
+    @property
+    def capacity(self):
+        """Number of cards, including END, that fit in the header blocks."""
+
+        return self.nblocks*BLOCK_SIZE//CARD_SIZE
+
+def data_size(header):
+    """Size in bytes of an HDU's data, including padding."""
+
+    naxis = header.get('NAXIS', 0)
+    if naxis == 0:
+        return 0
+
+    size = 1
+    for i in range(naxis):
+        size *= header['NAXIS{0}'.format(i+1)]
+    size = abs(header['BITPIX'])//8*header.get('GCOUNT', 1)*(header.get('PCOUNT', 0) + size)
+
+    return -(-size//BLOCK_SIZE)*BLOCK_SIZE
+
+def read_headers(f):
+    """Read the header cards and layout of every HDU in an open FITs file."""
+
+    infos = []
+    f.seek(0, os.SEEK_END)
+    file_size = f.tell()
+    offset = 0
+
+    while offset < file_size:
+
+        f.seek(offset)
+        cards = []
+        nblocks = 0
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if len(block) < BLOCK_SIZE:
+                raise IOError("Truncated FITs header at byte {0}.".format(offset))
+            nblocks += 1
+            block_cards = [block[i:i+CARD_SIZE] for i in range(0, BLOCK_SIZE, CARD_SIZE)]
+            if END_CARD in block_cards:
+                cards.extend(block_cards[:block_cards.index(END_CARD)])
+                break
+            cards.extend(block_cards)
+
+        info = HeaderInfo(offset, cards, nblocks)
+        infos.append(info)
+        offset = info.data_offset + info.data_size
+
+    return infos
+
+###############################################################################
+##
+##  In-place Header Updates
+##
+###############################################################################
+
+def card_images(key, value, comment=None):
+    """Format a keyword as one or more 80 character card images."""
+
+    image = str(fits.Card(key, value, comment).image)
+    return [image[i:i+CARD_SIZE] for i in range(0, len(image), CARD_SIZE)]
+
+###############################################################################
+##
+##  Header Templates
+##
+###############################################################################
+
+## Checksum encoding avoids these ASCII punctuation characters
+CHECKSUM_EXCLUDE = [0x3a, 0x3b, 0x3c, 0x3d, 0x3e, 0x3f, 0x40,
+                    0x5b, 0x5c, 0x5d, 0x5e, 0x5f, 0x60]
+
+def checksum(data, total=0):
+    """32-bit ones' complement sum of a string of FITs blocks.
+
+    Total may give the sum of other blocks of the HDU, e.g. its DATASUM.
+    """
+
+    words = np.frombuffer(data, dtype='>u4').astype(np.uint64)
+    total += int(words.sum())
+    while total >> 32:
+        total = (total & 0xffffffff) + (total >> 32)
+
+    return total
+
+def encode_checksum(value):
+    """Encode the complement of a checksum as 16 ASCII characters."""
+
+    value = ~value & 0xffffffff
+    asc = [0]*16
+
+    for i in range(4):
+        byte = (value >> (24 - 8*i)) & 0xff
+        quotient = byte//4 + ord('0')
+        remainder = byte % 4
+        ch = [quotient + remainder, quotient, quotient, quotient]
+
+        check = True
+        while check:
+            check = False
+            for x in CHECKSUM_EXCLUDE:
+                for j in [0, 2]:
+                    if ch[j] == x or ch[j+1] == x:
+                        ch[j] += 1
+                        ch[j+1] -= 1
+                        check = True
+
+        for j in range(4):
+            asc[4*j + i] = ch[j]
+
+    return "".join(chr(asc[(i + 15) % 16]) for i in range(16))
+
+class HeaderTemplate(object):
+    """Cache of rendered card images for headers repeated on every image.
+
+    Cards are only formatted again when their value or comment differs
+    from one already rendered.
+    """
+
+    def __init__(self, max_cards=4096):
+
+        self.max_cards = max_cards
+        self._images = {}
+
+    def images(self, key, value, comment=None):
+        """Return the card images for a keyword, rendering if needed."""
+
+        cache_key = (key, type(value), value, comment)
+        images = self._images.get(cache_key)
+
+        if images is None:
+            if len(self._images) >= self.max_cards:
+                self._images.clear()
+            images = card_images(key, value, comment)
+            self._images[cache_key] = images
+
+        return images
+
+    def extension(self, cards, name):
+        """Render a header-only image extension with a checksum.
+
+        Returns the header as a string of complete 2880 byte blocks.
+        """
+
+        images = []
+        for key, value, comment in [('XTENSION', 'IMAGE', 'Image extension'),
+                                    ('BITPIX', 8, 'array data type'),
+                                    ('NAXIS', 0, 'number of array dimensions'),
+                                    ('PCOUNT', 0, 'number of parameters'),
+                                    ('GCOUNT', 1, 'number of groups')]:
+            images.extend(self.images(key, value, comment))
+        for key, value, comment in cards:
+            images.extend(self.images(key, value, comment))
+        images.extend(self.images('EXTNAME', name, 'extension name'))
+
+        ## Checksum with a zeroed CHECKSUM card, then fill it in
+        images.extend(self.images('DATASUM', '0', 'data unit checksum'))
+        images.append(None)
+        images.append(END_CARD)
+        nblocks = -(-len(images)*CARD_SIZE//BLOCK_SIZE)
+        images += [BLANK_CARD]*(nblocks*BLOCK_SIZE//CARD_SIZE - len(images))
+
+        index = images.index(None)
+        images[index] = card_images('CHECKSUM', '0'*16, 'HDU checksum')[0]
+        value = encode_checksum(checksum("".join(images)))
+        images[index] = card_images('CHECKSUM', value, 'HDU checksum')[0]
+
+        return "".join(images)
+
+def keyword(card):
+    return card[:8].strip().upper()
+
+def patch_cards(cards, updates, removes=(), template=None):
+    """Return header cards with keywords updated, added and removed.
+
+    Updates is a list of (keyword, value, comment); existing keywords are
+    replaced where they are and new ones added after the last card.
+    """
+
+    if template is None:
+        render = card_images
+    else:
+        render = template.images
+
+    ## Drop blank cards after the last keyword, they are reserved space
+    cards = list(cards)
+    while cards and cards[-1] == BLANK_CARD:
+        cards.pop()
+
+    def find(key):
+        for i, card in enumerate(cards):
+            if keyword(card) == key:
+                end = i + 1
+                while end < len(cards) and keyword(cards[end]) == "CONTINUE":
+                    end += 1
+                return i, end
+        return None
+
+    for key in removes:
+        location = find(key.upper())
+        if location is not None:
+            del cards[location[0]:location[1]]
+
+    for key, value, comment in updates:
+        images = render(key, value, comment)
+        location = find(key.upper())
+        if location is None:
+            cards.extend(images)
+        else:
+            cards[location[0]:location[1]] = images
+
+    return cards
+
+def signed_cards(cards, capacity):
+    """Pad header cards to capacity with END, keeping any CHECKSUM valid.
+
+    CHECKSUM is recomputed from the header and the DATASUM of the data, so
+    the data is not read.  Without a DATASUM it cannot be, and is removed.
+    """
+
+    keys = [keyword(card) for card in cards]
+    if 'CHECKSUM' in keys and 'DATASUM' not in keys:
+        cards = [card for card in cards if keyword(card) != 'CHECKSUM']
+        keys = [keyword(card) for card in cards]
+    cards = cards + [BLANK_CARD]*(capacity - len(cards) - 1) + [END_CARD]
+
+    if 'CHECKSUM' in keys:
+        index = keys.index('CHECKSUM')
+        comment = fits.Card.fromstring(cards[index]).comment
+        datasum = int(fits.Card.fromstring(cards[keys.index('DATASUM')]).value or 0)
+
+        cards[index] = card_images('CHECKSUM', '0'*16, comment)[0]
+        value = encode_checksum(checksum("".join(cards), datasum))
+        cards[index] = card_images('CHECKSUM', value, comment)[0]
+
+    return cards
+
+def update_in_place(filepath, updates, removes=None, append=(), template=None):
+    """Patch FITs headers in place and append header-only HDUs to a file.
+
+    Updates and removes are dictionaries keyed by HDU index.  Appended HDUs
+    may be given as HDU objects or rendered header strings.  Returns False,
+    without modifying the file, if any patched header would no longer fit
+    in its existing blocks.
+    """
+
+    if removes is None:
+        removes = {}
+
+    with open(filepath, 'r+b') as f:
+
+        infos = read_headers(f)
+
+        ## Check every patched header fits before writing anything
+        patched = {}
+        for index in set(updates) | set(removes):
+            info = infos[index]
+            cards = patch_cards(info.cards, updates.get(index, []),
+                                removes.get(index, []), template)
+            if len(cards) + 1 > info.capacity:
+                return False
+            patched[index] = cards
+
+        ## Blank cards keep END in the last block, reserving the free space
+        for index, cards in patched.items():
+            info = infos[index]
+            f.seek(info.offset)
+            f.write("".join(signed_cards(cards, info.capacity)))
+
+        ## Append header-only HDUs after the last HDU's data
+        f.seek(infos[-1].data_offset + infos[-1].data_size)
+        for hdu in append:
+            if isinstance(hdu, basestring):
+                f.write(hdu)
+            elif hdu.data is not None:
+                raise ValueError("Only HDUs without data can be appended in place.")
+            else:
+                f.write(hdu.header.tostring())
+
+        f.truncate()
+
+    return True
+
+def update(filepath, updates, removes=None, append=(), template=None):
+    """Update FITs headers in place, or rewrite the file if they do not fit.
+
+    Arguments are as for update_in_place.  When the file is rewritten,
+    checksums of HDUs that have a CHECKSUM keyword are recomputed.
+    """
+
+    if update_in_place(filepath, updates, removes, append, template):
+        return
+
+    if removes is None:
+        removes = {}
+
+    hdulist = fits.open(filepath, mode='update', do_not_scale_image_data=True)
+    try:
+        for index in set(updates) | set(removes):
+            header = hdulist[index].header
+            for key, value, comment in updates.get(index, []):
+                header[key] = (value, comment)
+            for key in removes.get(index, []):
+                header.remove(key, ignore_missing=True)
+
+        for hdu in append:
+            if isinstance(hdu, basestring):
+                hdu = fits.ImageHDU(header=fits.Header.fromstring(hdu))
+            hdulist.append(hdu)
+
+        for hdu in hdulist:
+            if 'CHECKSUM' in hdu.header:
+                hdu.add_checksum()
+        hdulist.flush()
+    finally:
+        hdulist.close()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+"""This is a Python module to read multi-extension FITs images in place.
+
+An image file is memory-mapped once and each amplifier segment is a NumPy
+view into the mapping, so reading a segment, its image area (DATASEC) or
+overscan (BIASSEC) does not copy pixels.  Only the pages actually used are
+read from disk, instead of loading the whole 70 MB file.  A mosaic maps
+the segments onto the full detector using DETSEC, e.g.
+
+    with FitsImage("run1.bias.0.0s.1.fits") as image:
+        for segment in image:
+            overscan = segment.pixels('BIASSEC')
+        display = image.mosaic().array()
+"""
+
+import numpy as np
+
+import fitsheader
+
+## NumPy data type of FITs pixels for each BITPIX
+BITPIX_DTYPES = {8 : 'u1',
+                 16 : '>i2',
+                 32 : '>i4',
+                 64 : '>i8',
+                 -32 : '>f4',
+                 -64 : '>f8'}
+
+###############################################################################
+##
+##  Sections and Scaling
+##
+###############################################################################
+
+def parse_section(section):
+    """Convert an IRAF section such as [11:522, 1:2002] to array slices.
+
+    Returns (rows, columns) slices for a NumPy array of the segment.
+    Reversed ranges give the same slices as forward ones.
+    """
+
+    (x1, x2), (y1, y2) = section_ranges(section)
+
+    return (slice(min(y1, y2)-1, max(y1, y2)), slice(min(x1, x2)-1, max(x1, x2)))
+
+def section_ranges(section):
+    """Return the ((x1, x2), (y1, y2)) pixel ranges of an IRAF section."""
+
+    try:
+        xrange_, yrange_ = section.strip().strip("[]").split(",")
+        x1, x2 = [int(x) for x in xrange_.split(":")]
+        y1, y2 = [int(y) for y in yrange_.split(":")]
+    except ValueError:
+        raise ValueError("Invalid section {0}.".format(section))
+
+    return (x1, x2), (y1, y2)
+
+def scaled(data, bzero=0, bscale=1):
+    """Apply BZERO and BSCALE to raw pixels.
+
+    Unsigned 16-bit images are stored as signed integers with BZERO of
+    32768, which is undone by flipping the sign bit instead of converting
+    to floating point.  Unscaled pixels are returned as they are.
+    """
+
+    if bscale == 1 and bzero == 32768 and data.dtype.kind == 'i' and data.dtype.itemsize == 2:
+        return data.view(data.dtype.str.replace('i', 'u')) ^ np.uint16(0x8000)
+    elif bscale == 1 and bzero == 0:
+        return data
+
+    return data*np.float32(bscale) + np.float32(bzero)
+
+###############################################################################
+##
+##  Segments
+##
+###############################################################################
+
+class Segment(object):
+    """One image extension of a memory-mapped FITs file."""
+
+    def __init__(self, index, info, buffer):
+
+        header = info.header
+
+        self.index = index
+        self.header = header
+        self.extname = header.get('EXTNAME', "HDU{0}".format(index))
+        self.bzero = header.get('BZERO', 0)
+        self.bscale = header.get('BSCALE', 1)
+
+        ## Rows and columns of pixels, without copying the mapping
+        shape = (header['NAXIS2'], header['NAXIS1'])
+        dtype = np.dtype(BITPIX_DTYPES[header['BITPIX']])
+        self.raw = np.ndarray(shape, dtype, buffer, offset=info.data_offset)
+
+    @property
+    def shape(self):
+        return self.raw.shape
+
+    def section(self, keyword):
+        """Raw, unscaled view of a section keyword such as DATASEC."""
+
+        if keyword not in self.header:
+            raise KeyError("Keyword {0} not found in {1}.".format(keyword, self.extname))
+
+        return self.raw[parse_section(self.header[keyword])]
+
+    def pixels(self, keyword=None):
+        """Pixel values of the segment or of a section, with BZERO applied."""
+
+        if keyword is None:
+            data = self.raw
+        else:
+            data = self.section(keyword)
+
+        return scaled(data, self.bzero, self.bscale)
+
+    def detector_view(self):
+        """Image area oriented as it appears on the detector, with DETSEC slices.
+
+        Returns ((rows, columns), view) where the view of DATASEC is flipped,
+        without copying, to match reversed DETSEC ranges.
+        """
+
+        view = self.section('DATASEC')
+        (x1, x2), (y1, y2) = section_ranges(self.header['DETSEC'])
+        if x1 > x2:
+            view = view[:, ::-1]
+        if y1 > y2:
+            view = view[::-1, :]
+
+        return parse_section(self.header['DETSEC']), view
+
+###############################################################################
+##
+##  Images
+##
+###############################################################################
+
+class FitsImage(object):
+    """Memory-mapped multi-extension FITs image.
+
+    Segments are the two dimensional image extensions with a DATASEC
+    keyword, in file order.
+    """
+
+    def __init__(self, filepath):
+
+        self.filepath = filepath
+
+        with open(filepath, 'rb') as f:
+            self.infos = fitsheader.read_headers(f)
+        self.buffer = np.memmap(filepath, dtype=np.uint8, mode='r')
+
+        self.header = self.infos[0].header
+        self.segments = [Segment(i, info, self.buffer)
+                         for i, info in enumerate(self.infos)
+                         if info.header.get('NAXIS', 0) == 2 and 'DATASEC' in info.header]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Release the mapping; views already taken keep it open."""
+
+        self.segments = []
+        self.buffer = None
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __iter__(self):
+        return iter(self.segments)
+
+    def __getitem__(self, key):
+        """Return a segment by position or extension name."""
+
+        if isinstance(key, basestring):
+            for segment in self.segments:
+                if segment.extname == key:
+                    return segment
+            raise KeyError("Segment {0} not found in {1}.".format(key, self.filepath))
+
+        return self.segments[key]
+
+    def mosaic(self):
+        """Full detector mosaic of the segments' image areas."""
+
+        return Mosaic(self.segments)
+
+class Mosaic(object):
+    """Segments placed on the detector by their DETSEC keywords.
+
+    Tiles are views into the memory-mapped file; pixels are only copied
+    when an array of the detector, or a region of it, is assembled.
+    """
+
+    def __init__(self, segments):
+
+        self.tiles = [segment.detector_view() + (segment,) for segment in segments
+                      if 'DETSEC' in segment.header]
+        if not self.tiles:
+            raise ValueError("No segments have DETSEC keywords.")
+
+        self.shape = (max(rows.stop for (rows, cols), view, segment in self.tiles),
+                      max(cols.stop for (rows, cols), view, segment in self.tiles))
+
+    def array(self, rows=None, cols=None, dtype=np.float32, out=None):
+        """Assemble the detector, or a region of it, into one array.
+
+        Rows and cols are slices in detector pixels; out may be given to
+        reuse an array between images.
+        """
+
+        rows = slice(*(rows or slice(None)).indices(self.shape[0])[:2])
+        cols = slice(*(cols or slice(None)).indices(self.shape[1])[:2])
+        if out is None:
+            out = np.zeros((rows.stop - rows.start, cols.stop - cols.start), dtype)
+
+        for (trows, tcols), view, segment in self.tiles:
+
+            ## Overlap of the tile with the requested region
+            r0, r1 = max(trows.start, rows.start), min(trows.stop, rows.stop)
+            c0, c1 = max(tcols.start, cols.start), min(tcols.stop, cols.stop)
+            if r0 >= r1 or c0 >= c1:
+                continue
+
+            tile = view[r0-trows.start:r1-trows.start, c0-tcols.start:c1-tcols.start]
+            out[r0-rows.start:r1-rows.start, c0-cols.start:c1-cols.start] = \
+                scaled(tile, segment.bzero, segment.bscale)
+
+        return out
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""This is a Python module to pipeline post-acquisition processing of images.
+
+Finished images are handed to a background worker through a bounded queue,
+so the FITs header update of one image overlaps with readout of the next.
+"""
+
+import threading
+import Queue
+import logging
+import time
+
+import exposure
+
+###############################################################################
+##
+##  Frame Information
+##
+###############################################################################
+
+class Frame(object):
+    """Holds information about a single acquired image."""
+
+    def __init__(self, filepath, mode, exptime, seqnum, **kwargs):
+
+        self.filepath = filepath
+        self.mode = mode
+        self.exptime = exptime
+        self.seqnum = seqnum
+        self.header_kwargs = kwargs
+
+        ## Image title and acquisition start time, if known
+        self.filebase = None
+        self.acquired = None
+
+        ## Results and seconds taken by each stage, keyed by stage name
+        self.results = {}
+        self.timings = {}
+
+def header_stage(frame):
+    """Perform FITs header corrections for an acquired image."""
+
+    exposure.update_header(frame.filepath, frame.mode, frame.exptime,
+                           frame.seqnum, **frame.header_kwargs)
+
+###############################################################################
+##
+##  Frame Pipeline
+##
+###############################################################################
+
+class FramePipeline(object):
+    """Finalize acquired images on a background thread.
+
+    Each stage is a callable taking a Frame.  Stages run in order for every
+    image; an error in one stage is logged and does not stop the others.
+    If depth is 0, images are finalized on the calling thread instead.
+    """
+
+    _STOP = object()
+
+    def __init__(self, stages=None, depth=2, on_finalized=None):
+
+        if stages is None:
+            stages = [header_stage]
+
+        self.stages = list(stages)
+        self.depth = depth
+        self.on_finalized = on_finalized
+        self.logger = logging.getLogger("sLogger")
+
+        self.acquired = 0
+        self.finalized = 0
+
+        self._queue = Queue.Queue(maxsize=max(depth, 1))
+        self._thread = None
+
+    def add_stage(self, stage):
+        """Append a post-processing stage to the pipeline."""
+
+        self.stages.append(stage)
+
+    def start(self):
+        """Start the background finalize thread."""
+
+        if self.depth > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def submit(self, frame):
+        """Hand an acquired image to the pipeline.
+
+        Blocks while the queue is full, so acquisition never runs more than
+        depth images ahead of finalization.
+        """
+
+        self.acquired += 1
+
+        if self._thread is None:
+            self.process(frame)
+        else:
+            self._queue.put(frame)
+
+    def close(self):
+        """Wait for all queued images to be finalized and stop the thread."""
+
+        if self._thread is not None:
+            self._queue.put(self._STOP)
+            self._thread.join()
+            self._thread = None
+
+    def process(self, frame):
+        """Run every stage on a single image."""
+
+        for stage in self.stages:
+
+            name = getattr(stage, "__name__", stage.__class__.__name__)
+            start = time.time()
+            try:
+                frame.results[name] = stage(frame)
+            except IOError:
+                self.logger.exception("An error occurred while processing {0} ({1}).".\
+                                      format(frame.filepath, name))
+            except Exception as e:
+                self.logger.exception("{0}".format(e))
+            frame.timings[name] = time.time() - start
+
+        self.finalized += 1
+        if self.on_finalized is not None:
+            self.on_finalized(frame)
+
+    def _run(self):
+
+        while True:
+            frame = self._queue.get()
+            if frame is self._STOP:
+                break
+            self.process(frame)
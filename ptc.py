@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+"""This is a Python module to build photon transfer curves during a series.
+
+Each flat image of an exposure series gives the bias subtracted mean of
+every segment, and each pair of flats at the same exposure time gives the
+variance of their difference, free of fixed pattern noise.  Fits of
+variance against mean (gain and read noise) and of mean against exposure
+time (linearity) are updated for all segments at once as images land, so
+the gain of each amplifier is known when the series finishes.
+"""
+
+import os
+import json
+import logging
+
+import numpy as np
+
+import fitsimage
+import quicklook
+
+## Points above this bias subtracted signal, in ADU, are left out of the fits
+MAX_SIGNAL = 40000.0
+
+## Difference pixels further than this many sigma from the median are outliers
+CLIP_SIGMA = 5.0
+
+###############################################################################
+##
+##  Flat Pairs
+##
+###############################################################################
+
+def pair_variance(image1, image2, biases1, biases2):
+    """Mean signal and variance of each segment from a pair of flats.
+
+    The variance of the difference image, halved, is the variance of one
+    image without its fixed pattern.  Returns arrays of means and
+    variances in ADU, one per segment.
+    """
+
+    means = []
+    variances = []
+    for seg1, seg2, bias1, bias2 in zip(image1, image2, biases1, biases2):
+
+        data1 = seg1.pixels('DATASEC').astype(np.float32)
+        data2 = seg2.pixels('DATASEC').astype(np.float32)
+        means.append(0.5*(data1.mean(dtype=np.float64) - bias1 +
+                          data2.mean(dtype=np.float64) - bias2))
+
+        ## Clip cosmic rays using the interquartile range of the difference
+        diff = data1 - data2
+        q25, q50, q75 = np.percentile(diff, [25, 50, 75])
+        limit = CLIP_SIGMA*max(quicklook.IQR_TO_SIGMA*(q75 - q25), 1.0)
+        variances.append(0.5*diff[np.abs(diff - q50) <= limit].var(dtype=np.float64))
+
+    return np.array(means), np.array(variances)
+
+def line_fit(x, y):
+    """Least squares lines y = a + b*x for each column of y.
+
+    y has one row per point and x one row per point, or one value per
+    point shared by every column; NaN values of y are left out.  Returns
+    arrays of intercepts and slopes, NaN for columns with fewer than two
+    points.
+    """
+
+    y = np.asarray(y, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    if x.ndim == 1:
+        x = x[:, None]
+    x = np.broadcast_to(x, y.shape)
+    mask = np.isfinite(y)
+
+    n = mask.sum(axis=0)
+    sx = np.where(mask, x, 0).sum(axis=0)
+    sy = np.where(mask, y, 0).sum(axis=0)
+    sxx = np.where(mask, x**2, 0).sum(axis=0)
+    sxy = np.where(mask, x*y, 0).sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        denominator = n*sxx - sx**2
+        slope = np.where(n >= 2, (n*sxy - sx*sy)/denominator, np.nan)
+        intercept = np.where(n >= 2, (sy - slope*sx)/n, np.nan)
+
+    return intercept, slope
+
+###############################################################################
+##
+##  Photon Transfer Curve
+##
+###############################################################################
+
+class PhotonTransfer(object):
+    """Photon transfer and linearity points of every segment of a series."""
+
+    def __init__(self, extnames):
+
+        self.extnames = list(extnames)
+
+        ## Linearity points, (exptime, mean of each segment)
+        self.exptimes = []
+        self.signals = []
+
+        ## Photon transfer points from flat pairs, (means, variances)
+        self.means = []
+        self.variances = []
+
+    def add_image(self, exptime, means):
+        """Add the bias subtracted mean of each segment of one image."""
+
+        self.exptimes.append(float(exptime))
+        self.signals.append(np.asarray(means, dtype=np.float64))
+
+    def add_pair(self, means, variances):
+        """Add the mean and difference variance of each segment of a pair."""
+
+        self.means.append(np.asarray(means, dtype=np.float64))
+        self.variances.append(np.asarray(variances, dtype=np.float64))
+
+    def gain(self):
+        """Gain in e-/ADU and read noise in e- of each segment.
+
+        Fits variance = noise**2 + mean/gain, in ADU, to points below
+        MAX_SIGNAL.
+        """
+
+        nseg = len(self.extnames)
+        if not self.means:
+            return np.full(nseg, np.nan), np.full(nseg, np.nan)
+
+        means = np.array(self.means)
+        variances = np.where(means <= MAX_SIGNAL, np.array(self.variances), np.nan)
+        intercept, slope = line_fit(means, variances)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gains = np.where(slope > 0, 1.0/slope, np.nan)
+            noises = np.sqrt(np.maximum(intercept, 0.0))*gains
+
+        return gains, noises
+
+    def linearity(self):
+        """Signal rate in ADU/s and largest fractional residual of each segment."""
+
+        nseg = len(self.extnames)
+        if len(self.exptimes) < 2:
+            return np.full(nseg, np.nan), np.full(nseg, np.nan)
+
+        exptimes = np.array(self.exptimes)
+        signals = np.array(self.signals)
+        signals = np.where(signals <= MAX_SIGNAL, signals, np.nan)
+
+        intercept, slope = line_fit(exptimes, signals)
+        model = intercept + slope*exptimes[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            residuals = np.abs(signals - model)/model
+            residuals = np.where((model > 0) & np.isfinite(residuals), residuals,
+                                 -1.0).max(axis=0)
+
+        return slope, np.where(residuals >= 0, residuals, np.nan)
+
+    def summary(self):
+        """One line summary with the median over segments."""
+
+        gains, noises = self.gain()
+        rates, residuals = self.linearity()
+
+        def middle(values):
+            values = values[np.isfinite(values)]
+            return np.median(values) if len(values) else float('nan')
+
+        return "{0} images, {1} pairs: gain {2:.3f} e-/ADU, noise {3:.2f} e-, " \
+            "nonlinearity {4:.2%}".format(len(self.exptimes), len(self.means),
+                                          middle(gains), middle(noises),
+                                          middle(residuals))
+
+    def results(self):
+        """Fit results and points of each segment, as a dictionary."""
+
+        gains, noises = self.gain()
+        rates, residuals = self.linearity()
+
+        def values(array):
+            return [None if not np.isfinite(value) else float(value) for value in array]
+
+        return {"extnames" : self.extnames,
+                "gain" : values(gains),
+                "read_noise" : values(noises),
+                "signal_rate" : values(rates),
+                "nonlinearity" : values(residuals),
+                "exptimes" : self.exptimes,
+                "signals" : [values(signals) for signals in self.signals],
+                "means" : [values(means) for means in self.means],
+                "variances" : [values(variances) for variances in self.variances]}
+
+###############################################################################
+##
+##  Pipeline Stage
+##
+###############################################################################
+
+class PTCStage(object):
+    """Pipeline stage updating the photon transfer curve of a series.
+
+    Images at the same exposure time are paired as they land.  After the
+    last image the results are logged and written next to the series as
+    <title>.<mode>.<seqnum>.ptc.json, with the first sequence number.
+    """
+
+    def __init__(self, num_images):
+
+        self.num_images = num_images
+        self.count = 0
+        self.seqnum = None
+        self.curve = None
+        self.unpaired = {}
+        self.logger = logging.getLogger("sLogger")
+
+    def __call__(self, frame):
+
+        self.count += 1
+        image = fitsimage.FitsImage(frame.filepath)
+        try:
+            if self.curve is None:
+                self.seqnum = frame.seqnum
+                self.curve = PhotonTransfer([segment.extname for segment in image])
+
+            ## Overscan bias of each segment, from quick-look if available
+            stats = frame.results.get(quicklook.STAGE_NAME)
+            if stats and len(stats) == len(image):
+                biases = [seg.bias for seg in stats]
+                means = [seg.mean for seg in stats]
+            else:
+                biases = [quicklook.median(segment.pixels('BIASSEC')) for segment in image]
+                means = [segment.pixels('DATASEC').mean(dtype=np.float64) - bias
+                         for segment, bias in zip(image, biases)]
+            self.curve.add_image(frame.exptime, means)
+
+            ## Pair with the last unpaired image at the same exposure time
+            partner = self.unpaired.pop(frame.exptime, None)
+            if partner is None:
+                self.unpaired[frame.exptime] = (frame.filepath, biases)
+            else:
+                with fitsimage.FitsImage(partner[0]) as other:
+                    self.curve.add_pair(*pair_variance(other, image, partner[1], biases))
+                self.logger.info("PTC: {0}".format(self.curve.summary()))
+        finally:
+            image.close()
+
+        if self.count == self.num_images:
+            self.finish(frame)
+
+        return self.curve
+
+    def finish(self, frame):
+        """Log the gain of each segment and write the results."""
+
+        self.logger.info("PTC: {0}".format(self.curve.summary()))
+        if self.curve.means:
+            gains, noises = self.curve.gain()
+            for extname, gain, noise in zip(self.curve.extnames, gains, noises):
+                self.logger.info("{0:>10s} gain {1:6.3f} e-/ADU  noise {2:5.2f} e-".\
+                                 format(extname, gain, noise))
+
+        outpath = os.path.join(os.path.dirname(frame.filepath),
+                               "{0}.{1}.{2}.ptc.json".format(frame.filebase, frame.mode,
+                                                             self.seqnum))
+        with open(outpath, 'w') as f:
+            json.dump(self.curve.results(), f, indent=1)
+        self.logger.info("Photon transfer curve written to {0}.".format(outpath))
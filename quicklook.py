@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""This is a Python module to compute quick-look statistics of new images.
+
+Each amplifier segment is reduced to its overscan bias level, read noise
+from the overscan (BIASSEC), bias subtracted mean and median of the image
+area (DATASEC) and the fraction of saturated pixels.  Images are memory
+mapped with fitsimage and the statistics are vectorized, so a 16 segment
+frame is checked in a fraction of a second after readout.
+"""
+
+import os
+import logging
+import argparse
+
+import numpy as np
+
+import fitsimage
+
+## Pixel value of a saturated 16-bit ADC
+SATURATION = 65535
+
+## Scale of the interquartile range to the standard deviation of a Gaussian
+IQR_TO_SIGMA = 0.7413
+
+## Overscan pixels further than this many sigma from the bias are outliers
+CLIP_SIGMA = 5.0
+
+## Key of the quick-look statistics in the results of a pipeline frame
+STAGE_NAME = "quicklook_stage"
+
+###############################################################################
+##
+##  Segment Statistics
+##
+###############################################################################
+
+def median(pixels):
+    """Median of an array, using a histogram for integer pixel values."""
+
+    pixels = pixels.ravel()
+    if pixels.dtype.kind == 'u' and pixels.dtype.itemsize <= 2:
+        counts = np.cumsum(np.bincount(pixels))
+        lower = np.searchsorted(counts, (pixels.size-1)//2, side='right')
+        upper = np.searchsorted(counts, pixels.size//2, side='right')
+        return 0.5*(lower + upper)
+
+    return float(np.median(pixels))
+
+class SegmentStats(object):
+    """Quick-look statistics of one amplifier segment, in ADU."""
+
+    def __init__(self, extname, bias, noise, mean, median, saturated):
+
+        self.extname = extname
+        self.bias = bias
+        self.noise = noise
+        self.mean = mean
+        self.median = median
+        self.saturated = saturated
+
+    def as_dict(self):
+
+        return {"extname" : self.extname, "bias" : self.bias, "noise" : self.noise,
+                "mean" : self.mean, "median" : self.median, "saturated" : self.saturated}
+
+    def __str__(self):
+
+        return "{0:>10s} bias {1:8.1f}  noise {2:6.2f}  mean {3:9.1f}  " \
+            "median {4:9.1f}  saturated {5:6.2%}".format(self.extname, self.bias,
+                                                         self.noise, self.mean,
+                                                         self.median, self.saturated)
+
+def segment_stats(image, overscan, extname="", saturation=SATURATION):
+    """Compute quick-look statistics of a segment's image and overscan pixels.
+
+    The bias level is the overscan median and the read noise is the
+    overscan standard deviation, clipped using the interquartile range so
+    hot pixels and cosmic rays in the overscan do not inflate it.
+    """
+
+    bias = median(overscan)
+    q25, q75 = np.percentile(overscan, [25, 75])
+    limit = CLIP_SIGMA*max(IQR_TO_SIGMA*(q75 - q25), 1.0)
+    residuals = overscan.astype(np.float32) - np.float32(bias)
+    noise = residuals[np.abs(residuals) <= limit].std(dtype=np.float64)
+
+    mean = image.mean(dtype=np.float64) - bias
+    saturated = np.count_nonzero(image >= saturation)/float(image.size)
+
+    return SegmentStats(extname, float(bias), float(noise), float(mean),
+                        float(median(image) - bias), saturated)
+
+def frame_stats(filepath, saturation=SATURATION):
+    """Compute quick-look statistics of every segment of a FITs image.
+
+    Only image extensions with DATASEC and BIASSEC keywords are segments.
+    """
+
+    stats = []
+    with fitsimage.FitsImage(filepath) as image:
+        for segment in image:
+            if 'BIASSEC' not in segment.header:
+                continue
+            stats.append(segment_stats(segment.pixels('DATASEC'), segment.pixels('BIASSEC'),
+                                       segment.extname, saturation))
+
+    return stats
+
+def summarize(stats):
+    """One line summary of a frame, with the median over segments."""
+
+    if not stats:
+        return "no segments found"
+
+    def middle(name):
+        return np.median([getattr(seg, name) for seg in stats])
+
+    return "bias {0:.1f} ADU, noise {1:.2f} ADU, signal {2:.1f} ADU, " \
+        "{3:.2%} saturated ({4} segments)".format(middle("bias"), middle("noise"),
+                                                  middle("median"),
+                                                  max(seg.saturated for seg in stats),
+                                                  len(stats))
+
+###############################################################################
+##
+##  Pipeline Stage
+##
+###############################################################################
+
+def quicklook_stage(frame):
+    """Pipeline stage computing quick-look statistics of a finalized image."""
+
+    logger = logging.getLogger("sLogger")
+
+    stats = frame_stats(frame.filepath)
+    logger.info("Quick-look {0}: {1}".format(os.path.split(frame.filepath)[1],
+                                             summarize(stats)))
+    for seg in stats:
+        logger.debug(str(seg))
+
+    return stats
+
+###############################################################################
+##
+##  Main Function and Argument Parser
+##
+###############################################################################
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Quick-look statistics of CCD images",
+                                     prog='CCD Quick-look')
+    parser.add_argument("filepaths", nargs="+", help="FITs images")
+    parser.add_argument("-s", "--saturation", type=int, default=SATURATION, metavar='',
+                        help="Saturated pixel value in ADU")
+    args = parser.parse_args()
+
+    for filepath in args.filepaths:
+        stats = frame_stats(filepath, args.saturation)
+        print "{0}: {1}".format(filepath, summarize(stats))
+        for seg in stats:
+            print seg
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+
+"""This is a Python module to plan the order of points in a voltage scan.
+
+Orderings that change fewer rails by smaller steps between neighbouring
+points reduce the voltage slew and settle time of a scan.  Grid points are
+computed on demand, so large scans use constant memory.
+"""
+
+import os
+import json
+import threading
+from itertools import product
+from decimal import Decimal, ROUND_CEILING
+
+from settle import settle_time
+
+## Orderings of scan points that can be planned
+ORDERS = ["lexicographic", "serpentine", "gray", "weighted"]
+
+###############################################################################
+##
+##  Scan Axes and Parameter File
+##
+###############################################################################
+
+class Axis(object):
+    """Evenly spaced values of one voltage, computed exactly on demand.
+
+    Like numpy.arange the stop value is excluded, but the number of values
+    is found with decimal arithmetic so float steps never drop or add an
+    endpoint.
+    """
+
+    def __init__(self, vname, start, stop, step):
+
+        self.vname = vname
+        self.start = Decimal(str(start))
+        self.stop = Decimal(str(stop))
+        self.step = Decimal(str(step))
+
+        if self.step == 0:
+            raise ValueError("Step for {0} must not be 0.".format(vname))
+
+        count = ((self.stop - self.start)/self.step).to_integral_value(rounding=ROUND_CEILING)
+        self.count = max(int(count), 0)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("Axis index out of range.")
+
+        return float(self.start + i*self.step)
+
+    def __iter__(self):
+
+        for i in range(self.count):
+            yield self[i]
+
+def read_paramfile(paramfile):
+    """Read scan axes from a parameter file.
+
+    Each line holds a voltage name, start, stop and step.
+    """
+
+    axes = []
+
+    with open(paramfile) as f:
+
+        for line in f:
+            params = line.split()
+            if not params:
+                continue
+
+            axes.append(Axis(params[0], params[1], params[2], params[3]))
+
+    return axes
+
+###############################################################################
+##
+##  Index Orderings
+##
+###############################################################################
+
+def lexicographic_indices(shape):
+    """Iterate indices with the last axis changing fastest."""
+
+    return product(*[range(n) for n in shape])
+
+def serpentine_indices(shape):
+    """Iterate indices with the last axis reversing direction each pass."""
+
+    if not shape:
+        yield ()
+        return
+
+    inner = shape[-1]
+    for k, outer in enumerate(lexicographic_indices(shape[:-1])):
+        if k % 2 == 0:
+            inner_range = range(inner)
+        else:
+            inner_range = range(inner-1, -1, -1)
+        for j in inner_range:
+            yield outer + (j,)
+
+def gray_indices(shape, reverse=False):
+    """Iterate indices as a reflected mixed-radix Gray code.
+
+    Exactly one axis moves by one step between neighbouring points.
+    """
+
+    if not shape:
+        yield ()
+        return
+
+    if reverse:
+        outer_range = range(shape[0]-1, -1, -1)
+    else:
+        outer_range = range(shape[0])
+
+    for i in outer_range:
+        for rest in gray_indices(shape[1:], (i % 2 == 1) != reverse):
+            yield (i,) + rest
+
+###############################################################################
+##
+##  Scan Plan
+##
+###############################################################################
+
+class ScanPlan(object):
+    """Ordered grid of voltage points for a scan, generated lazily."""
+
+    def __init__(self, axes, order="lexicographic"):
+
+        if order not in ORDERS:
+            raise ValueError("Unknown scan order {0}.".format(order))
+
+        self.axes = list(axes)
+        self.vnames = [axis.vname for axis in self.axes]
+        self.order = order
+
+    @classmethod
+    def from_file(cls, paramfile, order="lexicographic"):
+        """Build a scan plan from a parameter file."""
+
+        return cls(read_paramfile(paramfile), order)
+
+    def __len__(self):
+
+        num_points = 1
+        for axis in self.axes:
+            num_points *= len(axis)
+        return num_points
+
+    def __iter__(self):
+
+        for indices in self.indices():
+            yield tuple(axis[i] for axis, i in zip(self.axes, indices))
+
+    def axis_weights(self):
+        """Predicted settle time of a single step along each axis."""
+
+        return [settle_time(axis.vname, float(axis.step)) for axis in self.axes]
+
+    def permutation(self):
+        """Axes from outermost to innermost in iteration order."""
+
+        if self.order != "weighted":
+            return list(range(len(self.axes)))
+
+        weights = self.axis_weights()
+        return sorted(range(len(self.axes)), key=lambda j: -weights[j])
+
+    def indices(self):
+        """Iterate grid indices in the planned order."""
+
+        shape = tuple(len(axis) for axis in self.axes)
+
+        if self.order == "lexicographic":
+            return lexicographic_indices(shape)
+        elif self.order == "serpentine":
+            return serpentine_indices(shape)
+        elif self.order == "gray":
+            return gray_indices(shape)
+        else:
+            return self._weighted_indices(shape)
+
+    def _weighted_indices(self, shape):
+        """Gray code ordering with the slowest rails on the outermost axes."""
+
+        perm = self.permutation()
+
+        for permuted in gray_indices(tuple(shape[j] for j in perm)):
+            indices = [0]*len(shape)
+            for j, i in zip(perm, permuted):
+                indices[j] = i
+            yield tuple(indices)
+
+    def steps(self):
+        """Classify the steps between neighbouring points of the plan.
+
+        Returns a list of (number of steps, {axis: voltage change}), found
+        from the grid shape alone without iterating over the points.
+        """
+
+        perm = self.permutation()
+        shape = [len(self.axes[j]) for j in perm]
+        step = [float(self.axes[j].step) for j in perm]
+        ndim = len(perm)
+
+        ## Each step advances one axis k, with axes inside k wrapping back
+        ## to their start (lexicographic) or reversing in place (Gray code)
+        classes = []
+        passes = 1
+        for k in range(ndim):
+            count = (shape[k] - 1)*passes
+            passes *= shape[k]
+            if count <= 0:
+                continue
+
+            deltas = {perm[k] : step[k]}
+            if self.order == "lexicographic":
+                wraps = range(k+1, ndim)
+            elif self.order == "serpentine":
+                wraps = range(k+1, ndim-1)
+            else:
+                wraps = []
+            for m in wraps:
+                if shape[m] > 1:
+                    deltas[perm[m]] = (shape[m] - 1)*step[m]
+
+            classes.append((count, deltas))
+
+        return classes
+
+    def cost(self, start=None):
+        """Return total voltage travel per rail and predicted settle time.
+
+        If a start dictionary of voltages is given, the move to the first
+        point is included.
+        """
+
+        travel = dict((vname, 0.0) for vname in self.vnames)
+        settle = 0.0
+
+        for count, deltas in self.steps():
+            step_settle = 0.0
+            for j, delta in deltas.items():
+                vname = self.vnames[j]
+                travel[vname] += count*abs(delta)
+                step_settle = max(step_settle, settle_time(vname, delta))
+            settle += count*step_settle
+
+        ## Rails missing from the start dictionary are assumed to start in place
+        if start is not None and len(self) > 0:
+            first = next(iter(self))
+            step_settle = 0.0
+            for vname, value in zip(self.vnames, first):
+                delta = value - start.get(vname, value)
+                if delta != 0.0:
+                    travel[vname] += abs(delta)
+                    step_settle = max(step_settle, settle_time(vname, delta))
+            settle += step_settle
+
+        return travel, settle
+
+    def summary(self, start=None):
+        """Describe the plan, its voltage travel and predicted settle time."""
+
+        travel, settle = self.cost(start)
+        travel_str = ", ".join("{0} {1:.2f}V".format(vname, travel[vname])
+                               for vname in self.vnames)
+
+        return "Scan of {0} points ({1} order): travel {2}; predicted settle {3:.1f}s.".\
+            format(len(self), self.order, travel_str, settle)
+
+###############################################################################
+##
+##  Scan Journal
+##
+###############################################################################
+
+class ScanJournal(object):
+    """Append-only record of completed scan points, used to resume a scan.
+
+    The first line describes the scan plan; each further line records one
+    completed grid point and the FITs file taken there.
+    """
+
+    def __init__(self, filepath, plan):
+
+        self.filepath = filepath
+        self.plan = plan
+        self.completed = {}
+        self.lock = threading.Lock()
+
+    def description(self):
+        """Describe the plan axes and order, used to check a journal matches a scan.
+
+        Sequence numbers follow the traversal order, so resuming in another
+        order would renumber the remaining points over images already taken.
+        """
+
+        return {"axes" : [[axis.vname, str(axis.start), str(axis.stop), str(axis.step)]
+                          for axis in self.plan.axes],
+                "order" : self.plan.order}
+
+    def key(self, point):
+        """Key identifying a grid point independent of float formatting."""
+
+        return tuple("{0:.6f}".format(value) for value in point)
+
+    def start(self):
+        """Begin a new journal, discarding any previous record."""
+
+        with open(self.filepath, 'w') as f:
+            f.write(json.dumps(self.description()) + "\n")
+        self.completed = {}
+
+    def resume(self):
+        """Load completed points from an existing journal.
+
+        If no journal exists a new one is started.  Returns the number of
+        completed points.
+        """
+
+        if not os.path.isfile(self.filepath):
+            self.start()
+            return 0
+
+        with open(self.filepath) as f:
+            lines = f.readlines()
+
+        if not lines or json.loads(lines[0]) != self.description():
+            raise ValueError("Scan journal {0} does not match the scan parameters.".\
+                             format(self.filepath))
+
+        ## Terminate a partially written last line before appending
+        if not lines[-1].endswith("\n"):
+            with open(self.filepath, 'a') as f:
+                f.write("\n")
+
+        self.completed = {}
+        for line in lines[1:]:
+
+            ## A partially written last line means the scan was interrupted
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            self.completed[self.key(entry["point"])] = entry["filepath"]
+
+        return len(self.completed)
+
+    def is_done(self, point):
+        """Check if a grid point was completed."""
+
+        return self.key(point) in self.completed
+
+    def record(self, frame):
+        """Pipeline stage recording a finalized scan image.
+
+        Images whose header update failed are not recorded, so a resumed
+        scan takes them again.
+        """
+
+        if "header_stage" not in frame.results:
+            return
+
+        point = [frame.header_kwargs[vname] for vname in self.plan.vnames]
+        entry = {"point" : point, "filepath" : frame.filepath}
+
+        with self.lock:
+            with open(self.filepath, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.completed[self.key(point)] = frame.filepath
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+"""This is a Python module to build response surfaces of voltage scans.
+
+As each scan point is finalized its quick-look statistics are stored in a
+dense array indexed by the scan axes, then by metric and segment.  Two
+dimensional slices of the array can be shown as heatmaps while the scan
+runs, and the best operating point found so far can be looked up, e.g.
+
+    surface.slice2d("noise", "VOD", "VRD")
+    surface.optimum("noise")
+
+The surface is saved next to the scan images as <title>.scan.npz after
+every point, so a resumed scan keeps the points already taken.
+"""
+
+import os
+import logging
+
+import numpy as np
+
+import quicklook
+
+## Quick-look statistics stored for each segment at each point
+METRICS = ["bias", "noise", "mean", "median", "saturated"]
+
+## Key of the response surface in the results of a pipeline frame
+STAGE_NAME = "SurfaceStage"
+
+###############################################################################
+##
+##  Response Surface
+##
+###############################################################################
+
+class ResponseSurface(object):
+    """Per-segment metrics at every point of a voltage scan grid.
+
+    Values is an array of shape (axis lengths..., metrics, segments); points
+    not yet taken are NaN.
+    """
+
+    def __init__(self, vnames, axis_values, nsegments, metrics=METRICS):
+
+        self.vnames = list(vnames)
+        self.axis_values = [np.asarray(values, dtype=np.float64) for values in axis_values]
+        self.metrics = list(metrics)
+
+        shape = tuple(len(values) for values in self.axis_values)
+        self.values = np.full(shape + (len(self.metrics), nsegments), np.nan, np.float32)
+        self.last = None
+
+    @classmethod
+    def from_plan(cls, plan, nsegments, metrics=METRICS):
+        """Empty surface for the grid of a scan plan."""
+
+        return cls(plan.vnames, [list(axis) for axis in plan.axes], nsegments, metrics)
+
+    @classmethod
+    def load(cls, filepath):
+        """Read a surface saved with save()."""
+
+        archive = np.load(filepath)
+        axis_values = [archive["axis{0}".format(i)] for i in range(len(archive["vnames"]))]
+        surface = cls([str(vname) for vname in archive["vnames"]], axis_values,
+                      archive["values"].shape[-1], [str(name) for name in archive["metrics"]])
+        surface.values[...] = archive["values"]
+
+        return surface
+
+    def save(self, filepath):
+        """Write the surface atomically as a NumPy archive."""
+
+        arrays = dict(("axis{0}".format(i), values)
+                      for i, values in enumerate(self.axis_values))
+        tmppath = filepath + ".tmp"
+        with open(tmppath, 'wb') as f:
+            np.savez(f, vnames=np.array(self.vnames), metrics=np.array(self.metrics),
+                     values=self.values, **arrays)
+        os.rename(tmppath, filepath)
+
+    def matches(self, other):
+        """Check two surfaces cover the same scan grid."""
+
+        return (self.vnames == other.vnames and self.metrics == other.metrics and
+                self.values.shape == other.values.shape and
+                all(np.allclose(a, b) for a, b in zip(self.axis_values, other.axis_values)))
+
+    def copy(self):
+        """Copy of the surface, e.g. to display while the scan adds points."""
+
+        surface = ResponseSurface(self.vnames, self.axis_values, self.values.shape[-1],
+                                  self.metrics)
+        surface.values[...] = self.values
+        surface.last = self.last
+
+        return surface
+
+    @property
+    def shape(self):
+        """Number of points along each scan axis."""
+
+        return self.values.shape[:len(self.vnames)]
+
+    def index(self, point):
+        """Grid indices of a scan point, matched to the nearest axis values."""
+
+        return tuple(int(np.abs(values - value).argmin())
+                     for values, value in zip(self.axis_values, point))
+
+    def add(self, point, stats):
+        """Store the quick-look statistics of each segment at a scan point."""
+
+        index = self.index(point)
+        for i, name in enumerate(self.metrics):
+            self.values[index + (i,)] = [getattr(seg, name) for seg in stats]
+        self.last = index
+
+    def filled(self):
+        """Number of scan points taken."""
+
+        if self.values.shape[-1] == 0 or not self.metrics:
+            return 0
+        return int(np.count_nonzero(~np.isnan(self.values[..., 0, 0])))
+
+    def metric(self, name, segment=None):
+        """Metric at every grid point, for one segment or the median of all."""
+
+        values = self.values[..., self.metrics.index(name), :]
+        if segment is not None:
+            return values[..., segment]
+        if values.shape[-1] == 0:
+            return np.full(values.shape[:-1], np.nan, np.float32)
+
+        ## Median over segments, NaN where a point is not taken yet
+        taken = ~np.isnan(values[..., 0])
+        result = np.full(taken.shape, np.nan, np.float32)
+        result[taken] = np.median(values[taken], axis=-1)
+
+        return result
+
+    def slice2d(self, name, xname, yname=None, segment=None, fixed=None):
+        """Two dimensional slice of a metric against two scan axes.
+
+        Other axes are held at the indices in fixed, a dictionary keyed by
+        voltage name, or at the last point taken.  Returns an array of shape
+        (y values, x values); with no y axis it has a single row.
+        """
+
+        if fixed is None:
+            fixed = {}
+        values = self.metric(name, segment)
+        last = self.last or (0,)*len(self.vnames)
+
+        xaxis = self.vnames.index(xname)
+        yaxis = None if yname is None else self.vnames.index(yname)
+        if xaxis == yaxis:
+            raise ValueError("Slice axes must be different.")
+
+        index = []
+        for i, vname in enumerate(self.vnames):
+            if i in [xaxis, yaxis]:
+                index.append(slice(None))
+            else:
+                index.append(fixed.get(vname, last[i]))
+        values = values[tuple(index)]
+
+        ## Remaining axes are in grid order, put y first
+        if yaxis is None:
+            return values[np.newaxis, :]
+        elif yaxis > xaxis:
+            return values.T
+        return values
+
+    def optimum(self, name, segment=None, maximize=False):
+        """Voltages and value of the best point taken so far, or None."""
+
+        values = self.metric(name, segment)
+        if np.all(np.isnan(values)):
+            return None
+
+        flat = np.nanargmax(values) if maximize else np.nanargmin(values)
+        index = np.unravel_index(flat, values.shape)
+        point = dict((vname, float(axis[i]))
+                     for vname, axis, i in zip(self.vnames, self.axis_values, index))
+
+        return point, float(values[index])
+
+def indexed_colors(values, levels=256):
+    """Scale an array to 8-bit levels for display, NaN as 0.
+
+    Returns the levels, as a C-contiguous uint8 array, and the (low, high)
+    range of the values.
+    """
+
+    finite = values[np.isfinite(values)]
+    if len(finite) == 0:
+        return np.zeros(values.shape, np.uint8), (np.nan, np.nan)
+
+    low, high = float(finite.min()), float(finite.max())
+    scale = (levels - 2)/(high - low) if high > low else 0.0
+    scaled = np.where(np.isfinite(values), 1 + (values - low)*scale, 0)
+
+    return np.ascontiguousarray(np.clip(scaled, 0, levels-1).astype(np.uint8)), (low, high)
+
+###############################################################################
+##
+##  Pipeline Stage
+##
+###############################################################################
+
+class SurfaceStage(object):
+    """Pipeline stage adding each scan point to a response surface.
+
+    The surface is saved after every point and a resumed scan continues
+    from the saved surface.
+    """
+
+    def __init__(self, plan, filepath, resume=False):
+
+        self.plan = plan
+        self.filepath = filepath
+        self.resume = resume
+        self.surface = None
+        self.reported = False
+        self.logger = logging.getLogger("sLogger")
+
+    def _open(self, nsegments):
+
+        surface = ResponseSurface.from_plan(self.plan, nsegments)
+        if self.resume and os.path.isfile(self.filepath):
+            saved = ResponseSurface.load(self.filepath)
+            if saved.matches(surface):
+                return saved
+            self.logger.warning("Saved scan surface {0} does not match the scan. "
+                                "Starting a new one.".format(self.filepath))
+        return surface
+
+    def __call__(self, frame):
+
+        stats = frame.results.get(quicklook.STAGE_NAME)
+        if not stats:
+            stats = quicklook.frame_stats(frame.filepath)
+        if self.surface is None:
+            self.surface = self._open(len(stats))
+
+        point = [frame.header_kwargs[vname] for vname in self.plan.vnames]
+        self.surface.add(point, stats)
+        self.surface.save(self.filepath)
+
+        best = self.surface.optimum("noise")
+        if not self.reported and self.surface.filled() == len(self.plan) and best:
+            self.reported = True
+            point, value = best
+            self.logger.info("Scan surface written to {0}, lowest noise {1:.2f} ADU at {2}.".\
+                             format(self.filepath, value,
+                                    ", ".join("{0}={1}".format(vname, point[vname])
+                                              for vname in self.plan.vnames)))
+
+        return self.surface
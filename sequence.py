@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+"""This is a Python module to run sequences of acquisitions back-to-back.
+
+A sequence file lists ordered steps (bias and dark stacks, exposure and
+dark series, flats, Fe55 and voltage scans) in JSON, e.g.
+
+    {"filename" : "run1",
+     "steps" : [{"type" : "stack", "mode" : "bias", "count" : 10, "combine" : "median"},
+                {"type" : "series", "mode" : "dark", "min" : 0, "max" : 60, "step" : 10},
+                {"type" : "series", "mode" : "exp", "min" : 1, "max" : 10, "step" : 1,
+                 "pairs" : true},
+                {"type" : "scan", "paramfile" : "scan_test1.txt", "exptime" : 1.0}]}
+
+Steps may override filename, exptime and the other step options.  The
+run time of the whole sequence is estimated before it starts.
+"""
+
+import json
+import logging
+
+import scanplan
+import acquisition
+import stacking
+
+## Time to read out an image and write it to disk, in seconds
+READOUT_TIME = 4.0
+
+## Step types and the options each needs
+STEP_OPTIONS = {"stack" : ["mode", "count"],
+                "series" : ["mode", "min", "max", "step"],
+                "scan" : ["paramfile"]}
+
+## Modes allowed for each step type
+STEP_MODES = {"stack" : ["exp", "dark", "bias", "flat", "fe55"],
+              "series" : ["exp", "dark"]}
+
+###############################################################################
+##
+##  Sequence Files
+##
+###############################################################################
+
+class Step(object):
+    """One acquisition of a sequence."""
+
+    def __init__(self, kind, filename, exptime=0.0, **options):
+
+        if kind not in STEP_OPTIONS:
+            raise ValueError("Unknown step type {0}.".format(kind))
+        for option in STEP_OPTIONS[kind]:
+            if option not in options:
+                raise ValueError("Step type {0} needs option {1}.".format(kind, option))
+        if kind in STEP_MODES and options["mode"] not in STEP_MODES[kind]:
+            raise ValueError("Mode {0} not allowed for step type {1}.".\
+                             format(options["mode"], kind))
+        if options.get("combine") not in [None] + stacking.METHODS:
+            raise ValueError("Unknown combine method {0}.".format(options["combine"]))
+
+        self.kind = kind
+        self.filename = filename
+        self.exptime = 0.0 if options.get("mode") == "bias" else float(exptime)
+        self.options = options
+
+        ## Check the scan parameter file can be read before the sequence starts
+        if kind == "scan":
+            self.plan()
+
+    def exptimes(self):
+        """Exposure time of each image taken by the step."""
+
+        if self.kind == "stack":
+            return [self.exptime]*int(self.options["count"])
+        elif self.kind == "series":
+            if self.options.get("pairs", False):
+                return [exptime for exptime in self.series_exptimes() for i in range(2)]
+            return self.series_exptimes()
+        else:
+            return [self.exptime]*len(self.plan())
+
+    def series_exptimes(self):
+        """Exposure times of a series step, once each."""
+
+        return acquisition.series_exptimes(float(self.options["min"]),
+                                           float(self.options["max"]),
+                                           float(self.options["step"]))
+
+    def plan(self, order="weighted"):
+        """Scan plan of a voltage scan step."""
+
+        try:
+            return scanplan.ScanPlan.from_file(self.options["paramfile"], order)
+        except IOError as e:
+            raise ValueError("Unable to read scan parameter file {0}: {1}".\
+                             format(self.options["paramfile"], e.strerror))
+
+    def num_seqnums(self):
+        """Number of sequence numbers used by the step."""
+
+        if self.kind == "series":
+            return 2 if self.options.get("pairs", False) else 1
+        return len(self.exptimes())
+
+    def estimate(self, readout_time=READOUT_TIME, start_voltages=None, order="weighted"):
+        """Predicted run time of the step in seconds."""
+
+        exptimes = self.exptimes()
+        seconds = sum(exptimes) + readout_time*len(exptimes)
+        if self.kind == "scan":
+            travel, settle = self.plan(order).cost(start_voltages)
+            seconds += settle
+
+        return seconds
+
+    def describe(self):
+
+        if self.kind == "scan":
+            what = "scan {0}".format(self.options["paramfile"])
+        else:
+            what = "{0} {1}".format(self.options["mode"], self.kind)
+        return "{0}, {1} images as {2}".format(what, len(self.exptimes()), self.filename)
+
+class Sequence(object):
+    """Ordered steps read from a sequence file."""
+
+    def __init__(self, steps, readout_time=READOUT_TIME):
+
+        self.steps = steps
+        self.readout_time = readout_time
+
+    @classmethod
+    def from_file(cls, filepath):
+        """Read and check a JSON sequence file."""
+
+        with open(filepath) as f:
+            try:
+                config = json.load(f)
+            except ValueError as e:
+                raise ValueError("Invalid sequence file {0}: {1}".format(filepath, e))
+
+        defaults = dict((key, value) for key, value in config.items()
+                        if key not in ["steps", "readout_time"])
+        defaults.setdefault("filename", "test")
+
+        steps = []
+        for i, entry in enumerate(config.get("steps", [])):
+            options = dict(defaults)
+            options.update(entry)
+            try:
+                kind = options.pop("type")
+            except KeyError:
+                raise ValueError("Step {0} of {1} has no type.".format(i+1, filepath))
+            try:
+                steps.append(Step(kind, **options))
+            except ValueError as e:
+                raise ValueError("Step {0} of {1}: {2}".format(i+1, filepath, e))
+
+        return cls(steps, config.get("readout_time", READOUT_TIME))
+
+    def __len__(self):
+        return len(self.steps)
+
+    def estimates(self, start_voltages=None, order="weighted"):
+        """Predicted run time of each step in seconds."""
+
+        return [step.estimate(self.readout_time, start_voltages, order)
+                for step in self.steps]
+
+    def summary(self, start_voltages=None, order="weighted"):
+        """Describe each step and the predicted total run time."""
+
+        estimates = self.estimates(start_voltages, order)
+        lines = ["Step {0}: {1} (~{2:.0f}s)".format(i+1, step.describe(), seconds)
+                 for i, (step, seconds) in enumerate(zip(self.steps, estimates))]
+        lines.append("Sequence of {0} steps, {1} images, estimated {2:.1f} min.".\
+                     format(len(self.steps),
+                            sum(len(step.exptimes()) for step in self.steps),
+                            sum(estimates)/60.0))
+
+        return "\n".join(lines)
+
+###############################################################################
+##
+##  Batch Scheduler
+##
+###############################################################################
+
+class SequenceRunner(object):
+    """Runs the steps of a sequence back-to-back with one acquisition engine.
+
+    Sequence numbers continue from one step to the next.  The sequence stops
+    at the first step that fails or is canceled.
+    """
+
+    def __init__(self, engine):
+
+        self.engine = engine
+        self.logger = logging.getLogger("sLogger")
+
+    def run(self, sequence, seq_num, data_dir, start_voltages=None, **kwargs):
+        """Run every step; returns the number of steps completed."""
+
+        self.engine.cancelled = False
+        order = self.engine.scan_order
+        try:
+            estimates = sequence.estimates(start_voltages, order)
+        except ValueError:
+            self.logger.exception("Invalid sequence step. Sequence not started.")
+            return 0
+        self.logger.info(sequence.summary(start_voltages, order))
+
+        for i, step in enumerate(sequence.steps):
+
+            if self.engine.cancelled:
+                self.logger.info("Sequence canceled.")
+                return i
+
+            self.logger.info("Starting step {0} of {1}: {2}, ~{3:.1f} min remaining.".\
+                             format(i+1, len(sequence), step.describe(),
+                                    sum(estimates[i:])/60.0))
+
+            step_kwargs = dict(kwargs)
+            step_kwargs['is_test'] = step.filename == 'test'
+            options = step.options
+
+            if step.kind == "stack":
+                completed = self.engine.stack(options["mode"], step.filename, step.exptime,
+                                              int(options["count"]), seq_num, data_dir,
+                                              combine=options.get("combine"),
+                                              **step_kwargs)
+            elif step.kind == "series":
+                completed = self.engine.series(options["mode"], step.filename,
+                                               step.series_exptimes(), seq_num, data_dir,
+                                               pairs=options.get("pairs", False),
+                                               **step_kwargs)
+            else:
+                completed = self.engine.scan(options["paramfile"], step.filename,
+                                             step.exptime, seq_num, data_dir,
+                                             resume=options.get("resume", False),
+                                             start_voltages=start_voltages,
+                                             **step_kwargs)
+
+            if not completed:
+                self.logger.warning("Step {0} of {1} did not complete. Sequence stopped.".\
+                                    format(i+1, len(sequence)))
+                return i
+
+            seq_num += step.num_seqnums()
+
+        self.logger.info("Sequence of {0} steps finished successfully.".format(len(sequence)))
+        return len(sequence)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+"""This is a Python module to wait for voltage rails to settle.
+
+Each rail settles in a base time plus a time per volt changed.  Rails
+changed together settle concurrently, so a scheduler only waits for the
+slowest pending rail instead of a fixed worst-case sleep after each one.
+"""
+
+import time
+import threading
+from ConfigParser import RawConfigParser
+
+import backend
+
+## Default settle time model per rail, (seconds per change, seconds per volt)
+DEFAULT_MODEL = {"VDD" : (0.05, 0.025),
+                 "VOD" : (0.05, 0.025),
+                 "VRD" : (0.05, 0.025),
+                 "VOG" : (0.05, 0.025),
+                 "RGHI" : (0.02, 0.02),
+                 "RGLO" : (0.02, 0.02),
+                 "PARHI" : (0.02, 0.02),
+                 "PARLO" : (0.02, 0.02),
+                 "SERHI" : (0.02, 0.02),
+                 "SERLO" : (0.02, 0.02),
+                 "VCLK" : (0.5, 0.0)}
+
+## Model used for rails missing from the settle time model
+UNKNOWN_RAIL = (0.5, 0.025)
+
+###############################################################################
+##
+##  Settle Time Model
+##
+###############################################################################
+
+class SettleModel(object):
+    """Predicted settle time of each rail, scaled by the voltage change."""
+
+    def __init__(self, model=None):
+
+        self.model = dict(DEFAULT_MODEL)
+        if model is not None:
+            self.model.update(model)
+
+    @classmethod
+    def from_settings(cls, filepath, section="Settle"):
+        """Read rail settle times from an INI file section.
+
+        Each key is a rail name with the seconds per change and seconds per
+        volt, e.g. VDD=0.05 0.025.  Rails not in the file keep their default.
+        """
+
+        parser = RawConfigParser()
+        parser.read(filepath)
+
+        model = {}
+        if parser.has_section(section):
+            for vname, value in parser.items(section):
+                try:
+                    base, per_volt = [float(x) for x in value.replace(",", " ").split()]
+                except ValueError:
+                    raise ValueError("Invalid settle time {0}={1} in {2}.".\
+                                     format(vname.upper(), value, filepath))
+                model[vname.upper()] = (base, per_volt)
+
+        return cls(model)
+
+    def settle_time(self, vname, delta):
+        """Predicted time for a rail to settle after a change of delta volts."""
+
+        base, per_volt = self.model.get(vname.upper(), UNKNOWN_RAIL)
+        return base + per_volt*abs(delta)
+
+_model = SettleModel()
+
+def get_model():
+    """Return the settle time model in use."""
+
+    return _model
+
+def set_model(model):
+    """Select the settle time model used by all schedulers."""
+
+    global _model
+    _model = model
+
+def load_settings(filepath, section="Settle"):
+    """Use the settle time model from an INI file."""
+
+    set_model(SettleModel.from_settings(filepath, section))
+
+def settle_time(vname, delta):
+    """Predicted time for a rail to settle with the current model."""
+
+    return _model.settle_time(vname, delta)
+
+###############################################################################
+##
+##  Settle Scheduler
+##
+###############################################################################
+
+class SettleScheduler(object):
+    """Tracks when rails that were changed will have settled.
+
+    Waiting only lasts until the last pending rail has settled, so rails
+    changed together overlap their settle times.
+    """
+
+    def __init__(self, model=None):
+
+        self.model = model
+        self.deadlines = {}
+        self.lock = threading.Lock()
+
+    def changed(self, voltage_dict, previous=None):
+        """Record rails set to new values.
+
+        Rails missing from the previous dictionary are assumed to change
+        from 0 V.
+        """
+
+        if previous is None:
+            previous = {}
+        model = self.model if self.model is not None else _model
+        now = time.time()
+
+        with self.lock:
+            for vname, value in voltage_dict.items():
+                vname = vname.upper()
+                delta = float(value) - float(previous.get(vname, 0.0))
+                deadline = now + model.settle_time(vname, delta)
+                self.deadlines[vname] = max(deadline, self.deadlines.get(vname, 0.0))
+
+    def pending(self):
+        """Seconds until every changed rail has settled."""
+
+        with self.lock:
+            if not self.deadlines:
+                return 0.0
+            return max(max(self.deadlines.values()) - time.time(), 0.0)
+
+    def wait(self):
+        """Wait for every changed rail to settle and return the time waited."""
+
+        with self.lock:
+            if not self.deadlines:
+                return 0.0
+            target = max(self.deadlines.values())
+
+        remaining = max(target - time.time(), 0.0)
+        if remaining > 0:
+            backend.get_backend().sleep(remaining)
+
+        ## Rails changed again while waiting stay pending
+        with self.lock:
+            for vname, deadline in self.deadlines.items():
+                if deadline <= target:
+                    del self.deadlines[vname]
+
+        return remaining
+
+## Rails are shared by everything talking to the controller
+_scheduler = SettleScheduler()
+
+def changed(voltage_dict, previous=None):
+    """Record rails set to new values with the shared scheduler."""
+
+    _scheduler.changed(voltage_dict, previous)
+
+def pending():
+    """Seconds until every rail changed has settled."""
+
+    return _scheduler.pending()
+
+def wait():
+    """Wait for every rail changed to settle."""
+
+    return _scheduler.wait()
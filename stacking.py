@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+"""This is a Python module to combine stacks of images into master frames.
+
+Images are combined segment by segment in blocks of rows read from the
+memory-mapped files, so memory use is bounded by MAX_CHUNK_BYTES however
+deep the stack is.  Each image has its overscan bias level subtracted
+before combining with a median or a sigma-clipped mean.  The master frame
+is written in place, one block at a time, with the segment layout and
+section keywords of the stack.
+"""
+
+import os
+import logging
+import argparse
+
+import numpy as np
+
+## Import astropy.io.fits or pyfits
+try:
+    from astropy.io import fits
+except ImportError:
+    import pyfits as fits
+
+import fitsheader
+import fitsimage
+import quicklook
+
+## Combine methods
+METHODS = ["median", "mean"]
+
+## Largest block of stacked pixels held in memory, in bytes
+MAX_CHUNK_BYTES = 64*1024*1024
+
+## Median absolute deviation of a Gaussian in standard deviations
+MAD_TO_SIGMA = 1.4826
+
+## Keywords copied from each segment of the stack to the master frame
+SEGMENT_KEYWORDS = ['EXTNAME', 'DETSIZE', 'DATASEC', 'BIASSEC', 'DETSEC']
+
+###############################################################################
+##
+##  Combine Methods
+##
+###############################################################################
+
+def median_combine(stack, nsigma=None):
+    """Median of a (images, rows, columns) block along the image axis."""
+
+    return np.median(stack, axis=0)
+
+def clipped_mean_combine(stack, nsigma=3.0):
+    """Mean along the image axis of pixels within nsigma of the median.
+
+    The scatter is the median absolute deviation of each pixel, so cosmic
+    rays in one image do not widen the clipping of the others.
+    """
+
+    center = np.median(stack, axis=0)
+    deviation = np.abs(stack - center)
+    sigma = MAD_TO_SIGMA*np.median(deviation, axis=0)
+
+    keep = deviation <= nsigma*np.maximum(sigma, 0.5)
+    count = keep.sum(axis=0)
+    total = np.where(keep, stack, 0.0).sum(axis=0)
+
+    return np.where(count > 0, total/np.maximum(count, 1), center)
+
+COMBINERS = {"median" : median_combine,
+             "mean" : clipped_mean_combine}
+
+###############################################################################
+##
+##  Master Frames
+##
+###############################################################################
+
+def overscan_bias(segment):
+    """Overscan bias level of a segment, 0 if it has no overscan."""
+
+    if 'BIASSEC' not in segment.header:
+        return 0.0
+    return quicklook.median(segment.pixels('BIASSEC'))
+
+def chunk_rows(num_images, ncols, max_bytes=MAX_CHUNK_BYTES):
+    """Rows per block so a block of float32 pixels fits in max_bytes."""
+
+    return max(1, max_bytes//(4*num_images*ncols))
+
+def create_master(outpath, template, cards):
+    """Write the headers of a float32 master frame with the template's segments.
+
+    The data areas are allocated but not written.  Returns the header
+    layout of the new file.
+    """
+
+    primary = fits.Header()
+    primary['SIMPLE'] = True
+    primary['BITPIX'] = 8
+    primary['NAXIS'] = 0
+    primary['EXTEND'] = True
+    for key, value, comment in cards:
+        primary[key] = (value, comment)
+
+    headers = [primary]
+    for segment in template:
+        header = fits.Header()
+        header['XTENSION'] = ('IMAGE', 'Image extension')
+        header['BITPIX'] = -32
+        header['NAXIS'] = 2
+        header['NAXIS1'] = segment.shape[1]
+        header['NAXIS2'] = segment.shape[0]
+        header['PCOUNT'] = 0
+        header['GCOUNT'] = 1
+        for key in SEGMENT_KEYWORDS:
+            if key in segment.header:
+                header[key] = segment.header[key]
+        headers.append(header)
+
+    with open(outpath, 'wb') as f:
+        for header in headers:
+            f.write(header.tostring())
+            size = fitsheader.data_size(header)
+            if size:
+                f.seek(size-1, os.SEEK_CUR)
+                f.write('\0')
+
+    with open(outpath, 'rb') as f:
+        return fitsheader.read_headers(f)
+
+def combine(filepaths, outpath, method="median", nsigma=3.0, max_bytes=MAX_CHUNK_BYTES,
+            biases=None):
+    """Combine a stack of images into a master frame, one block at a time.
+
+    Biases may give the overscan bias level of each image's segments, as
+    computed when the images were taken; otherwise they are measured.
+    Returns the master frame path.
+    """
+
+    if method not in COMBINERS:
+        raise ValueError("Unknown combine method {0}.".format(method))
+    if len(filepaths) == 0:
+        raise ValueError("No images to combine.")
+    combiner = COMBINERS[method]
+
+    images = [fitsimage.FitsImage(filepath) for filepath in filepaths]
+    try:
+        template = images[0]
+        for image in images[1:]:
+            if [segment.shape for segment in image] != [segment.shape for segment in template]:
+                raise ValueError("Image {0} does not match the segments of {1}.".\
+                                 format(image.filepath, template.filepath))
+
+        if biases is None or \
+                [len(levels) for levels in biases] != [len(image) for image in images]:
+            biases = [[overscan_bias(segment) for segment in image] for image in images]
+
+        cards = [('NCOMBINE', len(images), 'Number of images combined'),
+                 ('COMBMETH', method, 'Combine method'),
+                 ('OVERSCAN', True, 'Overscan bias subtracted')]
+        for key in ['IMGTYPE', 'TESTTYPE', 'EXPTIME', 'LSST_NUM', 'CCD_SERN', 'FILTER',
+                    'MONOWL']:
+            if key in template.header:
+                cards.append((key, template.header[key], None))
+        if method == "mean":
+            cards.append(('NSIGMA', nsigma, 'Clipping threshold in sigma'))
+
+        infos = create_master(outpath, template, cards)
+        output = np.memmap(outpath, dtype=np.uint8, mode='r+')
+
+        for i, segment in enumerate(template):
+            info = infos[i+1]
+            master = np.ndarray(segment.shape, '>f4', output, offset=info.data_offset)
+            nrows, ncols = segment.shape
+            step = chunk_rows(len(images), ncols, max_bytes)
+
+            stack = np.empty((len(images), step, ncols), np.float32)
+            for row in range(0, nrows, step):
+                rows = min(step, nrows - row)
+                block = stack[:, :rows]
+                for j, image in enumerate(images):
+                    source = image[i]
+                    block[j] = fitsimage.scaled(source.raw[row:row+rows], source.bzero,
+                                                source.bscale)
+                    block[j] -= biases[j][i]
+                master[row:row+rows] = combiner(block, nsigma)
+
+        output.flush()
+        del output
+    finally:
+        for image in images:
+            image.close()
+
+    return outpath
+
+def master_filepath(filepaths, method):
+    """Master frame path next to a stack, e.g. run1.bias.0.0s.1-10.median.fits."""
+
+    first = os.path.split(filepaths[0])[1][:-len(".fits")]
+    last = os.path.split(filepaths[-1])[1][:-len(".fits")]
+    base, seqnum = first.rsplit(".", 1)
+    last_seqnum = last.rsplit(".", 1)[1]
+
+    return os.path.join(os.path.dirname(filepaths[0]),
+                        "{0}.{1}-{2}.{3}.fits".format(base, seqnum, last_seqnum, method))
+
+###############################################################################
+##
+##  Pipeline Stage
+##
+###############################################################################
+
+class StackStage(object):
+    """Pipeline stage combining a stack once its last image lands.
+
+    Overscan bias levels are taken from the quick-look statistics of each
+    image as it is finalized, so only the combine is left for the end.
+    """
+
+    def __init__(self, num_images, method="median", nsigma=3.0):
+
+        self.num_images = num_images
+        self.method = method
+        self.nsigma = nsigma
+        self.filepaths = []
+        self.biases = []
+        self.logger = logging.getLogger("sLogger")
+
+    def __call__(self, frame):
+
+        stats = frame.results.get(quicklook.STAGE_NAME)
+        self.filepaths.append(frame.filepath)
+        if stats is None:
+            self.biases.append(None)
+        else:
+            self.biases.append([seg.bias for seg in stats])
+
+        if len(self.filepaths) < self.num_images:
+            return None
+
+        biases = self.biases
+        if None in biases:
+            biases = None
+
+        outpath = master_filepath(self.filepaths, self.method)
+        self.logger.info("Combining {0} images into {1}.".\
+                         format(len(self.filepaths), os.path.split(outpath)[1]))
+        return combine(self.filepaths, outpath, self.method, self.nsigma, biases=biases)
+
+###############################################################################
+##
+##  Main Function and Argument Parser
+##
+###############################################################################
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Combine a stack of CCD images",
+                                     prog='CCD Stacking')
+    parser.add_argument("filepaths", nargs="+", help="FITs images of the stack")
+    parser.add_argument("-o", "--output", default=None, metavar='',
+                        help="Master frame path (named after the stack if not given)")
+    parser.add_argument("-m", "--method", default="median", choices=METHODS,
+                        help="Combine method")
+    parser.add_argument("-n", "--nsigma", type=float, default=3.0, metavar='',
+                        help="Clipping threshold for the mean")
+    args = parser.parse_args()
+
+    outpath = args.output or master_filepath(args.filepaths, args.method)
+    combine(args.filepaths, outpath, args.method, args.nsigma)
+    print outpath
+
+if __name__ == '__main__':
+
+    main()
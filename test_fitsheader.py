@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""Tests of FITs header updates, in place and by rewriting the file."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+## Import astropy.io.fits or pyfits
+try:
+    from astropy.io import fits
+except ImportError:
+    import pyfits as fits
+
+import fitsheader
+
+def write_image(filepath, spare_cards):
+    """Write a primary header and one 16-bit segment with checksums.
+
+    The primary header is filled with keywords until spare_cards blank
+    cards are left in its last block.
+    """
+
+    primary = fits.PrimaryHDU()
+    num_fill = fitsheader.BLOCK_SIZE//fitsheader.CARD_SIZE - len(primary.header) - 3
+    for i in range(num_fill - spare_cards):
+        primary.header['FILL{0}'.format(i)] = (i, 'Filler keyword')
+
+    data = np.arange(200*100, dtype=np.uint16).reshape(200, 100)
+    segment = fits.ImageHDU(data, name='Segment10')
+    segment.header['DATASEC'] = '[11:100,1:200]'
+
+    fits.HDUList([primary, segment]).writeto(filepath, checksum=True)
+
+class UpdateTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, "test.fits")
+
+    def tearDown(self):
+
+        shutil.rmtree(self.directory)
+
+    def check_file(self):
+        """Check the updates were made, checksums verify and data is unchanged."""
+
+        hdulist = fits.open(self.filepath, checksum=True)
+        try:
+            self.assertEqual(hdulist[0].header['SEQNUM'], 7)
+            self.assertEqual(hdulist[1].header['DETSEC'], '[1:90,1:200]')
+            self.assertNotIn('CCDSEC', hdulist[1].header)
+            self.assertEqual(hdulist[2].header['EXTNAME'], 'CCD_COND')
+            self.assertEqual(hdulist[1].data[-1, -1], 200*100 - 1)
+            for hdu in hdulist:
+                if 'CHECKSUM' in hdu.header:
+                    self.assertEqual(hdu.verify_checksum(), 1)
+                    self.assertEqual(hdu.verify_datasum(), 1)
+        finally:
+            hdulist.close()
+
+    def update(self):
+
+        template = fitsheader.HeaderTemplate()
+        ccdhdu = template.extension([('CCDTEMP', -100.0, 'Measured temperature')],
+                                    'CCD_COND')
+        fitsheader.update(self.filepath, {0 : [('SEQNUM', 7, 'Sequence number')],
+                                          1 : [('DETSEC', '[1:90,1:200]', None)]},
+                          {1 : ['CCDSEC']}, append=[ccdhdu], template=template)
+
+    def test_in_place(self):
+
+        write_image(self.filepath, spare_cards=10)
+        size = os.path.getsize(self.filepath)
+        self.update()
+
+        self.check_file()
+        self.assertEqual(os.path.getsize(self.filepath), size + fitsheader.BLOCK_SIZE)
+
+    def test_no_spare_cards(self):
+
+        write_image(self.filepath, spare_cards=0)
+        with open(self.filepath, 'rb') as f:
+            primary = fitsheader.read_headers(f)[0]
+        self.assertEqual(len(primary.cards) + 1, primary.capacity)
+
+        self.assertFalse(fitsheader.update_in_place(self.filepath, {0 : [('SEQNUM', 7, None)]}))
+        self.update()
+        self.check_file()
+
+    def test_in_place_without_datasum(self):
+
+        write_image(self.filepath, spare_cards=10)
+
+        ## Blank the primary DATASUM card, leaving its CHECKSUM
+        with open(self.filepath, 'r+b') as f:
+            header = f.read(fitsheader.BLOCK_SIZE)
+            f.seek(header.index("DATASUM "))
+            f.write(fitsheader.BLANK_CARD)
+        self.update()
+
+        ## A checksum that cannot be recomputed is removed
+        with open(self.filepath, 'rb') as f:
+            self.assertNotIn('CHECKSUM', fitsheader.read_headers(f)[0].header)
+        self.check_file()
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -7,7 +7,16 @@ Currently bash scripts for voltage control are called, and output returned.
 This will allow the easy ability to parse output to command line or GUI.
 """
 
+import os
 import subprocess
+import threading
+import errno
+import pipes
+import select
+import time
+
+import backend
+import settle
 
 ## For Python 2.6 need to monkey patch check_output()
 if "check_output" not in dir( subprocess ):
@@ -27,6 +36,361 @@ if "check_output" not in dir( subprocess ):
         return output
     subprocess.check_output = f
 
+## Voltages set individually by an executable of the same name
+DC_RAILS = ["VDD", "VOD", "VOG", "VRD"]
+
+## Clock rails are set in LO/HI pairs by a single executable
+CLOCK_RAILS = {"PAR" : "par_clks",
+               "SER" : "ser_clks",
+               "RG" : "rg"}
+
+## Longest time to wait for one voltage executable, in seconds
+COMMAND_TIMEOUT = 30.0
+
+###############################################################################
+##
+##  Voltage State Cache
+##
+###############################################################################
+
+class VoltageState(object):
+    """Write-through cache of the rail values last set on the controller.
+
+    Rails missing from the cache are unknown and are always written.  Rail
+    names are upper case in the cache and in the dictionaries returned.
+    """
+
+    def __init__(self, tolerance=0.005):
+
+        self.tolerance = tolerance
+        self.values = {}
+
+    def changed(self, new_voltage_dict, force=False):
+        """Return the subset of a voltage dictionary that needs writing."""
+
+        if force:
+            return dict((vname.upper(), value) for vname, value in new_voltage_dict.items())
+
+        pending = {}
+        for vname, value in new_voltage_dict.items():
+            vname = vname.upper()
+            old = self.values.get(vname)
+            if old is None or abs(float(value) - old) > self.tolerance:
+                pending[vname] = value
+
+        return pending
+
+    def update(self, voltage_dict):
+        """Record rail values that were successfully set."""
+
+        for vname, value in voltage_dict.items():
+            self.values[vname.upper()] = float(value)
+
+    def invalidate(self, vnames=None):
+        """Forget cached values so the next write is forced."""
+
+        if vnames is None:
+            self.values.clear()
+        else:
+            for vname in vnames:
+                self.values.pop(vname.upper(), None)
+
+###############################################################################
+##
+##  Persistent Voltage Session
+##
+###############################################################################
+
+class VoltageSession(object):
+    """Long-lived shell used to run voltage executables.
+
+    Commands are streamed over the shell's stdin and their output read back
+    from stdout, so changing a rail does not cost a fork/exec of a new
+    Python subprocess each time.  A command that does not finish within
+    timeout seconds kills the shell, which is restarted for the next batch.
+    """
+
+    _SENTINEL = "__VOLTAGE_SESSION_DONE__"
+
+    def __init__(self, shell="/bin/bash", tolerance=0.005, state=None,
+                 timeout=COMMAND_TIMEOUT):
+
+        self.shell = shell
+        self.timeout = timeout
+        self.process = None
+        self.buffer = ""
+        self.lock = threading.Lock()
+        self.state = state if state is not None else VoltageState(tolerance)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        """Start the shell process if it is not already running."""
+
+        if self.process is None or self.process.poll() is not None:
+            self.process = subprocess.Popen([self.shell], stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT,
+                                            universal_newlines=True)
+            self.buffer = ""
+
+    def close(self):
+        """Exit the shell process."""
+
+        if self.process is not None and self.process.poll() is None:
+            self.process.stdin.write("exit\n")
+            self.process.stdin.flush()
+            self.process.wait()
+        self.process = None
+
+    def _readline(self, deadline):
+        """Read a line of shell output, or None if the deadline passes.
+
+        Reads the pipe directly, as buffered reads would hide pending
+        output from select.  Returns an empty string if the shell exited.
+        """
+
+        fd = self.process.stdout.fileno()
+        while "\n" not in self.buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                return None
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                line, self.buffer = self.buffer, ""
+                return line
+            self.buffer += chunk
+
+        line, self.buffer = self.buffer.split("\n", 1)
+        return line + "\n"
+
+    def run(self, args):
+        """Run a single command and return its output."""
+
+        return self.run_batch([args])[0]
+
+    def run_batch(self, commands):
+        """Run a list of commands in one round trip and return their outputs.
+
+        Commands after a failing command are not run.  The failure is raised
+        as CalledProcessError (or OSError if the executable is not found),
+        with the outputs of the commands that succeeded stored in its
+        completed attribute.
+        """
+
+        ## Simulated controllers do not need a shell
+        if backend.get_backend().simulated:
+            with self.lock:
+                return backend.get_backend().run_batch(commands)
+
+        ## Build script, skipping remaining commands after a failure; commands
+        ## must not read the rest of the script from the shell's stdin, and
+        ## the sentinel starts a new line even if their output does not end one
+        script = ["__vs_ok=1"]
+        for args in commands:
+            cmdline = " ".join(pipes.quote(str(arg)) for arg in args)
+            script.append('if [ $__vs_ok = 1 ]; then {0} </dev/null 2>&1; __vs_rc=$?; '
+                          '[ $__vs_rc = 0 ] || __vs_ok=0; else __vs_rc=skip; fi; '
+                          'printf \'\\n%s %s\\n\' {1} "$__vs_rc"'.\
+                          format(cmdline, self._SENTINEL))
+
+        with self.lock:
+            self.open()
+            self.process.stdin.write("\n".join(script) + "\n")
+            self.process.stdin.flush()
+
+            results = []
+            for args in commands:
+                lines = []
+                deadline = time.time() + self.timeout
+                while True:
+                    line = self._readline(deadline)
+                    if line is None:
+                        self.process.kill()
+                        self.process.wait()
+                        self.process = None
+                        error = OSError(errno.ETIMEDOUT, "Executable {0} timed out after "
+                                        "{1:.0f}s.".format(args[0], self.timeout))
+                        error.completed = [output for a, retcode, output in results
+                                           if retcode == "0"]
+                        raise error
+                    if not line:
+                        self.process = None
+                        raise OSError(errno.EPIPE, "Voltage session closed unexpectedly.")
+                    if line.startswith(self._SENTINEL):
+                        break
+                    lines.append(line)
+
+                ## Drop the newline printed before the sentinel
+                results.append((args, line.split()[1], "".join(lines)[:-1]))
+
+        ## Check return codes in order
+        completed = []
+        for args, retcode, output in results:
+            if retcode == "0":
+                completed.append(output)
+                continue
+            elif retcode == "127":
+                error = OSError(errno.ENOENT, "Executable {0} not found.".format(args[0]))
+            else:
+                error = subprocess.CalledProcessError(int(retcode), args)
+                error.output = output
+            error.completed = completed
+            raise error
+
+        return completed
+
+    def apply(self, new_voltage_dict, current_voltage_dict=None, force=False):
+        """Set all rails in a voltage dictionary in one round trip.
+
+        Rails already at the requested value (within the state tolerance)
+        are skipped unless force is True.  Returns a list of
+        (rail names, output) for each executable called.
+        """
+
+        pending = self.state.changed(new_voltage_dict, force)
+        if not pending:
+            return []
+
+        ## Cached values take priority for the other half of clock pairs
+        known = dict(current_voltage_dict or {})
+        known.update(self.state.values)
+        commands = rail_commands(pending, known)
+
+        try:
+            outputs = self.run_batch([args for vnames, args in commands])
+        except (subprocess.CalledProcessError, OSError) as e:
+            e.completed = [(commands[i][0], output)
+                           for i, output in enumerate(getattr(e, 'completed', []))]
+            self._record(e.completed, pending)
+            raise
+
+        results = [(commands[i][0], output) for i, output in enumerate(outputs)]
+        self._record(results, pending)
+
+        return results
+
+    def _record(self, results, voltage_dict):
+        """Update the state cache for rails that were set."""
+
+        previous = dict(self.state.values)
+        for vnames, output in results:
+            rails = dict((vname, voltage_dict[vname]) for vname in vnames)
+            self.state.update(rails)
+            settle.changed(rails, previous)
+            _notify(rails)
+
+_session = None
+
+## Rail values last set through this module, shared with the session so
+## settle times are modelled from the previous values with or without it
+_state = VoltageState()
+
+def open_session(shell="/bin/bash"):
+    """Route module voltage functions through a persistent session."""
+
+    global _session
+
+    if _session is None:
+        _session = VoltageSession(shell, state=_state)
+    _session.open()
+
+    return _session
+
+def close_session():
+    """Close the persistent session, if open."""
+
+    global _session
+
+    if _session is not None:
+        _session.close()
+        _session = None
+
+## Functions called with each dictionary of rail values set
+_listeners = []
+
+def add_listener(callback):
+    """Call callback(voltage_dict) whenever rails are set."""
+
+    _listeners.append(callback)
+
+def _notify(voltage_dict):
+
+    for callback in _listeners:
+        callback(voltage_dict)
+
+def invalidate():
+    """Forget the rail values last set, e.g. after the controller is reset."""
+
+    _state.invalidate()
+
+def seed(voltage_dict):
+    """Record rail values known to be set, e.g. by an earlier set-up."""
+
+    _state.update(voltage_dict)
+
+def _run(args, voltage_dict=None):
+    """Run a voltage executable, using the persistent session if open."""
+
+    if _session is None:
+        output = backend.run(args)
+        state = _state
+    else:
+        output = _session.run(args)
+        state = _session.state
+
+    if voltage_dict is not None:
+        settle.changed(voltage_dict, state.values)
+        state.update(voltage_dict)
+        _notify(voltage_dict)
+    return output
+
+def rail_commands(new_voltage_dict, current_voltage_dict=None):
+    """Build the executable commands needed to set new rail values.
+
+    Clock rails are set in pairs, so the missing half of a pair is taken
+    from the current voltage dictionary.  Returns a list of
+    (rail names, command arguments).
+    """
+
+    if current_voltage_dict is None:
+        current_voltage_dict = {}
+
+    commands = []
+    clocks = {}
+
+    for vname in sorted(new_voltage_dict):
+
+        value = new_voltage_dict[vname]
+
+        if vname in DC_RAILS:
+            commands.append(([vname], [vname.lower(), "{0}".format(value)]))
+            continue
+
+        for prefix in CLOCK_RAILS:
+            if vname in [prefix + "LO", prefix + "HI"]:
+                clocks.setdefault(prefix, []).append(vname)
+                break
+        else:
+            raise KeyError("Voltage name {0} not found.".format(vname))
+
+    ## One command per pair of clock rails
+    for prefix, vnames in sorted(clocks.items()):
+
+        lo_name = prefix + "LO"
+        hi_name = prefix + "HI"
+        lo = new_voltage_dict.get(lo_name, current_voltage_dict.get(lo_name, 0.0))
+        hi = new_voltage_dict.get(hi_name, current_voltage_dict.get(hi_name, 0.0))
+        commands.append((vnames, [CLOCK_RAILS[prefix], "{0}".format(lo),
+                                  "{0}".format(hi)]))
+
+    return commands
+
 ###############################################################################
 ##
 ##  Voltage controls
@@ -36,16 +400,15 @@ if "check_output" not in dir( subprocess ):
 def v_clk(V_lo, V_hi):
     """Set limits for bbs switch"""
     
-    output = subprocess.check_output(["v_clk", "{0}".format(V_lo),
-                                      "{0}".format(V_hi)])
+    output = _run(["v_clk", "{0}".format(V_lo), "{0}".format(V_hi)])
     return output
 
 def set_voltage(V, vname):
     """Set a particular voltage to specified value"""
 
     ## List of acceptable voltage names
-    if vname in ["VDD", "VOD", "VOG", "VRD"]:
-        output = subprocess.check_output([vname.lower(), "{0}".format(V)])
+    if vname.upper() in DC_RAILS:
+        output = _run([vname.lower(), "{0}".format(V)], {vname : V})
         return output
     else:
         raise KeyError("Voltage name not found.")
@@ -53,22 +416,22 @@ def set_voltage(V, vname):
 def rg(rg_lo, rg_hi):
     """Set reset gate voltages"""
     
-    output = subprocess.check_output(["rg", "{0}".format(rg_lo),
-                                      "{0}".format(rg_hi)])
+    output = _run(["rg", "{0}".format(rg_lo), "{0}".format(rg_hi)],
+                  {"RGLO" : rg_lo, "RGHI" : rg_hi})
     return output
 
 def par_clks(par_lo, par_hi):
     """Set parallel clock rails to specified voltages"""
     
-    output = subprocess.check_output(["par_clks", "{0}".format(par_lo),
-                                      "{0}".format(par_hi)])
+    output = _run(["par_clks", "{0}".format(par_lo), "{0}".format(par_hi)],
+                  {"PARLO" : par_lo, "PARHI" : par_hi})
     return output
 
 def ser_clks(ser_lo, ser_hi):
     """Set parallel clock rails to specified voltages"""
     
-    output = subprocess.check_output(["ser_clks", "{0}".format(ser_lo),
-                                      "{0}".format(ser_hi)])
+    output = _run(["ser_clks", "{0}".format(ser_lo), "{0}".format(ser_hi)],
+                  {"SERLO" : ser_lo, "SERHI" : ser_hi})
     return output
 
 ###############################################################################